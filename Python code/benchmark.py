@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+# Please see Readme for more info
+
+# This code measures how the database build, the ingest of new stays, and a fixed set of queries scale with the number of
+# hospital stays. For each number of stays given, it generates that many made-up stays with generate_stay_data.py, builds a
+# database from them with create_db.py (timing each phase of the build and counting its CPU time and rows), builds it again
+# from the cleaned data cache the first build saved, adds a further batch of made-up stays to it with the --ingest code, and
+# times each query in BENCHMARK_QUERIES. All of this is done in a temporary folder, so the real database and CSVs are left
+# alone.
+
+# The results are saved to a JSON report (benchmark_report.json by default) along with the Python, SQLite, pandas, and NumPy
+# versions and the git commit the code is at. To see whether a change made anything slower, run the benchmark before and
+# after the change and compare the reports with --compare, which lists every phase and query that got more than
+# REGRESSION_THRESHOLD slower.
+
+# Example: python benchmark.py 100000 1000000 --output after.json --compare before.json
+
+# Import packages - sqlite3 for running the database, time for timing the queries, os, tempfile, and shutil for the temporary
+# folder, json, datetime, platform, and subprocess for the report, copy for keeping each step's phase statistics, argparse for
+# reading the command line options, pandas and NumPy for their versions, and create_db, generate_stay_data, and
+# index_advisor for building the databases, generating the stays, and the readme and billing example queries
+import sqlite3
+import time
+import os
+import tempfile
+import shutil
+import json
+import datetime as dt
+import platform
+import subprocess
+import copy
+import argparse
+import pandas as pd
+import numpy as np
+import create_db
+from generate_stay_data import save_generated_stay_data
+from index_advisor import README_EXAMPLE_QUERIES, BILLING_EXAMPLE_QUERIES
+
+
+
+# Part 1: Describe the benchmark
+
+# Numbers of hospital stays to benchmark with when none are given
+DEFAULT_STAY_COUNTS = [100000, 1000000]
+
+# Number of new stays to add with the ingest code, as a share of the stays the database is built with
+INGEST_SHARE = 0.01
+
+# Seed for generating the stays added with the ingest code, so that they differ from those the database is built with
+INGEST_RANDOM_SEED = create_db.RANDOM_SEED+1
+
+# Number of times each query is run when timing it (the fastest and the median run are reported), and number of rows fetched
+# at a time, so that queries returning every stay do not need all of them in memory at once
+TIMING_RUNS = 3
+FETCH_SIZE = 10000
+
+# A phase or query counts as slower in --compare if it took more than this share longer than in the earlier report (and at
+# least MIN_REGRESSION_SECONDS longer, so that tiny timings going up and down do not count)
+REGRESSION_THRESHOLD = 0.2
+MIN_REGRESSION_SECONDS = 0.005
+
+# Queries to time, each with a name that stays the same between versions so that reports can be compared: the readme
+# examples, date range billing totals, and billing totals per payer
+BENCHMARK_QUERIES = ([('readme_example_'+str(query_number+1), query) for query_number, query in
+                      enumerate(README_EXAMPLE_QUERIES)]+
+                     [('quarter_billing_total', BILLING_EXAMPLE_QUERIES[0]),
+                      ('payer_billing_totals_by_discharge_year', BILLING_EXAMPLE_QUERIES[1]),
+                      ('month_billing_total', 'SELECT SUM(billing_amt) FROM hospital_stay WHERE admission_date BETWEEN '+
+                       '\'2022-06-01\' AND \'2022-06-30\';'),
+                      ('payer_billing_totals', 'SELECT i.insurance_provider_name, COUNT(*), SUM(hs.billing_amt) FROM '+
+                       'hospital_stay hs INNER JOIN insurance i ON hs.insurance_provider_id = i.insurance_provider_id '+
+                       'GROUP BY i.insurance_provider_name;'),
+                      ('payer_billing_totals_by_quarter', 'SELECT i.insurance_provider_name, d.date_quarter_in_year, '+
+                       'SUM(hs.billing_amt) FROM hospital_stay hs INNER JOIN insurance i ON hs.insurance_provider_id = '+
+                       'i.insurance_provider_id INNER JOIN date d ON hs.admission_date = d.date_id GROUP BY '+
+                       'i.insurance_provider_name, d.date_quarter_in_year;'),
+                      ('payer_billing_totals_by_quarter_from_view', 'SELECT insurance_provider_name, date_quarter_in_year, '+
+                       'SUM(total_billing_amt) FROM billing_by_insurance_month GROUP BY insurance_provider_name, '+
+                       'date_quarter_in_year;'),
+                      ('hospital_billing_totals_by_admission_type', 'SELECT h.hospital_name, a.adm_type, '+
+                       'SUM(hs.billing_amt) FROM hospital_stay hs INNER JOIN hospital h ON hs.hospital_id = h.hospital_id '+
+                       'INNER JOIN admission_type a ON hs.adm_type_id = a.adm_type_id WHERE hs.admission_date >= '+
+                       '\'2023-01-01\' GROUP BY h.hospital_name, a.adm_type;')])
+
+# Function to time a query, returning the fastest and the median of TIMING_RUNS runs in seconds along with the number of rows
+# it returned
+def time_query(connection, query, timing_runs=TIMING_RUNS):
+    run_times = []
+    for run in range(timing_runs):
+        start_time = time.perf_counter()
+        cursor = connection.execute(query)
+        row_count = 0
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            row_count += len(rows)
+        run_times.append(time.perf_counter()-start_time)
+    return min(run_times), float(np.median(run_times)), row_count
+
+# Function to get the git commit the code is at, or None if it is not in a git repository
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+# Part 2: Run the benchmark
+
+# Function to benchmark the build, a rebuild from the cleaned data cache, the ingest, and the queries with the given number
+# of stays in the given folder, returning a dictionary with the time each step took in seconds, the wall clock time, CPU
+# time, and number of rows of each phase of the builds and the ingest, the number of rows loaded into each table, the size of
+# the database, and the timings of each query
+def benchmark_stay_count(stay_count, work_folder, like_csv_path=None, chunk_size=create_db.CHUNK_SIZE):
+    stay_data_file = os.path.join(work_folder, 'stays_'+str(stay_count)+'.csv')
+    cleaned_stay_data_file = os.path.join(work_folder, 'stays_'+str(stay_count)+'_cleaned.csv')
+    cleaned_stay_data_cache_file = os.path.join(work_folder, 'stays_'+str(stay_count)+'_cleaned.npz')
+    ingest_stay_data_file = os.path.join(work_folder, 'new_stays_'+str(stay_count)+'.csv')
+    cleaned_ingest_stay_data_file = os.path.join(work_folder, 'new_stays_'+str(stay_count)+'_cleaned.csv')
+    database_file = os.path.join(work_folder, 'hospital_stay_database_'+str(stay_count)+'.db')
+    ingest_stay_count = max(1, round(stay_count*INGEST_SHARE))
+    result = {'stays': stay_count, 'ingest_stays': ingest_stay_count}
+
+    start_time = time.perf_counter()
+    save_generated_stay_data(stay_count, stay_data_file, like_csv_path, chunk_size)
+    save_generated_stay_data(ingest_stay_count, ingest_stay_data_file, like_csv_path, chunk_size, INGEST_RANDOM_SEED)
+    # Only fully cleaned stays can be ingested, so the new stays are cleaned along with being generated
+    create_db.clean_stay_data_file(ingest_stay_data_file, cleaned_ingest_stay_data_file, chunk_size)
+    result['generate_seconds'] = time.perf_counter()-start_time
+
+    start_time = time.perf_counter()
+    load_counts = create_db.build_database(database_file, chunk_size, stay_data_file, cleaned_stay_data_file,
+                                           cleaned_stay_data_cache_file)
+    result['build'] = {'seconds': time.perf_counter()-start_time, 'phases': copy.deepcopy(create_db.phase_stats),
+                       'rows_loaded': load_counts, 'database_bytes': os.path.getsize(database_file),
+                       'cache_bytes': os.path.getsize(cleaned_stay_data_cache_file)}
+
+    # Build the database again, this time from the cleaned data cache the first build saved
+    start_time = time.perf_counter()
+    create_db.build_database(database_file, chunk_size, stay_data_file, cleaned_stay_data_file, cleaned_stay_data_cache_file)
+    result['cached_build'] = {'seconds': time.perf_counter()-start_time, 'phases': copy.deepcopy(create_db.phase_stats)}
+
+    connection = sqlite3.connect(database_file)
+    start_time = time.perf_counter()
+    load_counts, skipped_stay_count = create_db.ingest_stays(connection, cleaned_ingest_stay_data_file, chunk_size)
+    result['ingest'] = {'seconds': time.perf_counter()-start_time, 'phases': copy.deepcopy(create_db.phase_stats),
+                        'rows_loaded': load_counts, 'stays_skipped': skipped_stay_count}
+
+    result['queries'] = {}
+    for query_name, query in BENCHMARK_QUERIES:
+        fastest_seconds, median_seconds, row_count = time_query(connection, query)
+        result['queries'][query_name] = {'query': query, 'fastest_seconds': fastest_seconds,
+                                         'median_seconds': median_seconds, 'rows': row_count}
+    connection.close()
+    return result
+
+# Function to run the benchmark for each of the given numbers of stays, returning the report as a dictionary
+def run_benchmark(stay_counts, like_csv_path=None, chunk_size=create_db.CHUNK_SIZE, work_folder=None):
+    report = {'created': dt.datetime.now().isoformat(timespec='seconds'),
+              'environment': {'git_commit': get_git_commit(), 'python': platform.python_version(),
+                              'sqlite': sqlite3.sqlite_version, 'pandas': pd.__version__, 'numpy': np.__version__,
+                              'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+              'settings': {'chunk_size': chunk_size, 'like_csv': like_csv_path, 'timing_runs': TIMING_RUNS},
+              'results': []}
+    temporary_folder = tempfile.mkdtemp(dir=work_folder)
+    try:
+        for stay_count in stay_counts:
+            report['results'].append(benchmark_stay_count(stay_count, temporary_folder, like_csv_path, chunk_size))
+    finally:
+        shutil.rmtree(temporary_folder)
+    return report
+
+# Function to list the timings in a report that are slower than in an earlier report, matching them by number of stays and
+# by phase or query name, and returning (stay count, timing name, earlier seconds, new seconds) tuples
+def compare_reports(earlier_report, report):
+    def list_timings(result):
+        timings = {step: result[step]['seconds'] for step in ['build', 'cached_build', 'ingest'] if step in result}
+        for step in timings.copy():
+            timings.update({step+': '+phase: phase_stat['wall_seconds']
+                            for phase, phase_stat in result[step].get('phases', {}).items()})
+        timings.update({'query: '+query_name: query_result['fastest_seconds']
+                        for query_name, query_result in result['queries'].items()})
+        return timings
+
+    earlier_results = {result['stays']: result for result in earlier_report['results']}
+    slower_timings = []
+    for result in report['results']:
+        if result['stays'] not in earlier_results:
+            continue
+        earlier_timings = list_timings(earlier_results[result['stays']])
+        for timing_name, seconds in list_timings(result).items():
+            earlier_seconds = earlier_timings.get(timing_name)
+            if (earlier_seconds is not None and seconds > earlier_seconds*(1+REGRESSION_THRESHOLD) and
+                    seconds-earlier_seconds >= MIN_REGRESSION_SECONDS):
+                slower_timings.append((result['stays'], timing_name, earlier_seconds, seconds))
+    return slower_timings
+
+
+
+# Part 3: Run the benchmark from the command line
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Time the database build, ingest, and example queries with '+
+                                              'made-up hospital stays.')
+    argument_parser.add_argument('stay_counts', type=int, nargs='*', default=DEFAULT_STAY_COUNTS, help='numbers of '+
+                                 'hospital stays to benchmark with (default: %(default)s)')
+    argument_parser.add_argument('--output', default='benchmark_report.json', help='JSON file to save the report to '+
+                                 '(default: %(default)s)')
+    argument_parser.add_argument('--compare', metavar='REPORT_FILE', help='earlier report to compare the timings with')
+    argument_parser.add_argument('--like', metavar='CSV_FILE', help='generate stays that match this CSV of hospital stays '+
+                                 'instead of the Kaggle dataset')
+    argument_parser.add_argument('--chunk-size', type=int, default=create_db.CHUNK_SIZE, help='number of hospital stays '+
+                                 'to generate, clean, and load at a time (default: %(default)s)')
+    argument_parser.add_argument('--work-folder', help='folder to create the temporary folder in (default: the system\'s '+
+                                 'temporary folder)')
+    arguments = argument_parser.parse_args()
+
+    report = run_benchmark(arguments.stay_counts, arguments.like, arguments.chunk_size, arguments.work_folder)
+    with open(arguments.output, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    for result in report['results']:
+        print(str(result['stays'])+' stays: built in '+format(result['build']['seconds'], '.1f')+' s ('+
+              format(result['build']['database_bytes']/1000000, '.1f')+' MB), ingested '+str(result['ingest_stays'])+
+              ' more in '+format(result['ingest']['seconds'], '.1f')+' s; rebuilt from the cleaned data cache in '+
+              format(result['cached_build']['seconds'], '.1f')+' s')
+        for phase, phase_stat in result['build']['phases'].items():
+            print('    '+phase+': '+format(phase_stat['wall_seconds'], '.2f')+' s ('+
+                  format(phase_stat['cpu_seconds'], '.2f')+' s CPU, '+str(phase_stat['rows'])+' rows)')
+        for query_name, query_result in result['queries'].items():
+            print('    '+query_name+': '+format(query_result['fastest_seconds']*1000, '.1f')+' ms')
+    print('Report saved to '+arguments.output)
+
+    if arguments.compare:
+        with open(arguments.compare) as earlier_report_file:
+            earlier_report = json.load(earlier_report_file)
+        slower_timings = compare_reports(earlier_report, report)
+        earlier_stay_counts = {result['stays'] for result in earlier_report['results']}
+        if not earlier_stay_counts & {result['stays'] for result in report['results']}:
+            print('No numbers of stays in common with '+arguments.compare+', so nothing was compared')
+        elif not slower_timings:
+            print('Nothing is more than '+format(REGRESSION_THRESHOLD, '.0%')+' slower than in '+arguments.compare)
+        for stay_count, timing_name, earlier_seconds, seconds in slower_timings:
+            print('Slower with '+str(stay_count)+' stays - '+timing_name+': '+format(earlier_seconds, '.3f')+' s -> '+
+                  format(seconds, '.3f')+' s')
@@ -21,332 +21,1205 @@
 # If you get a "database is locked" error message, restart the kernel and, once it's done, delete the database file. Then run
 # this code to rebuild the database.
 
+# The database is rebuilt in a temporary file next to it (hospital_stay_database.db.building) with settings that make bulk
+# loading fast, and the temporary file only replaces the database once it is complete. This means the database can still be
+# queried while it is being rebuilt. On Windows, a file that is open in another program cannot be replaced, so close any
+# program using the database before the rebuild finishes.
+
+# The finished database uses write-ahead logging (WAL), so many programs (e.g. query_server.py) can read it at once, even
+# while new stays are being ingested. Once a database is in WAL mode, a rebuild copies the new database into it with SQLite's
+# backup instead of replacing the file, so programs reading it simply see the new data from their next query on.
+
+# To add new hospital stays to an already built database without rebuilding it, run this code with the --ingest option and
+# the path of a CSV of new stays, e.g. python create_db.py --ingest new_stays.csv. Only stays that are not already in the
+# database are added, along with only the new patients, doctors, dates, etc. they involve. The CSV must be fully cleaned
+# (with a Date of Birth column, like hosp_stay_dataset_fully_cleaned.csv): cleaning picks random names and dates of birth,
+# and picks them differently depending on where each stay is in the CSV, so the same partially cleaned stays ingested twice
+# would be added twice. To clean a partially cleaned CSV (with an Age column, like hosp_stay_dataset_dr_names_cleaned.csv)
+# once, run this code with the --clean option, e.g. python create_db.py --clean new_stays.csv new_stays_cleaned.csv, and
+# ingest the cleaned CSV as many times as needed.
+
+# Along with the tables, the database has billing summary tables (exposed as views) that hold the number of stays and the
+# billing total for each insurance provider and month, each hospital and quarter, and each medical condition and year, by
+# admission date. They are brought up to date with only the new stays whenever stays are loaded, including with --ingest.
+
+# The data is read, cleaned, and loaded CHUNK_SIZE rows at a time so that memory use stays flat no matter how big the CSV is.
+# Use the --chunk-size option to change this, e.g. to a smaller number on a computer with little memory.
+
+# Along with the fully cleaned CSV, the cleaned data is saved to a compressed columnar cache
+# (hosp_stay_dataset_fully_cleaned.npz) with each column stored in its own type: dates as dates, billing amounts and room
+# numbers as numbers, and the other columns as a list of their distinct values plus a small integer code per row. The cache
+# can be loaded in well under a second with load_cleaned_stay_data, e.g. from create_db import load_cleaned_stay_data, or
+# with numpy.load. It also records a hash of the stay data it was cleaned from (along with the name dataset, the hospital
+# list, the seed, and CLEANED_DATA_VERSION), so a rebuild with the same stay data skips reading and cleaning the CSV and
+# loads the database straight from the cache instead. Use the --no-cache option to read and clean the CSV anyway.
+
+# To build a smaller database, use the --compact option, which stores dates in the hospital stay fact table as integer day
+# numbers and billing amounts as integer cents behind views that look like the usual tables (see COMPACT_TABLES), and use
+# --compare-layouts to see how much smaller and faster it is than the usual layout.
+
+# To find out where a build or ingest spends its time, use the --log-file option (or set the HOSPITAL_STAY_LOG_FILE
+# environment variable) to log the wall clock time, CPU time, and number of rows of each phase, and the time and number of
+# rows of each SQL statement, to a file; see instrumentation.py for more info.
+
 
 
 # Part 1: Import and clean the data
 
-# Import packages - sqlite3 for running the database, pandas for importing and manipulating the data, datetime for working
-# with dates and their components (days/months/years), warnings for displaying a warning, and random for randomized data
-# replacement (make patient names and hospital names more realistic, and replace ages with dates of birth)
+# Import packages - sqlite3 for running the database, pandas for importing and manipulating the data, NumPy for randomized
+# data replacement done on all rows at once (make patient names and hospital names more realistic, and replace ages with dates
+# of birth) and for making the whole calendar of dates and their components (days/months/years) at once, warnings for
+# displaying a warning, os for replacing the database file, argparse for reading the command line options, time and
+# contextlib for timing each phase of the build, instrumentation for logging the phases and SQL statements, hashlib, json, and
+# zipfile for the cleaned data cache, and tempfile and shutil for the temporary folder used to compare the database layouts
 import sqlite3
 import pandas as pd
-import datetime as dt
+import numpy as np
 import warnings
-from random import randint, seed
+import os
+import argparse
+import time
+import contextlib
+import instrumentation
+import hashlib
+import json
+import zipfile
+import tempfile
+import shutil
+
+# Seed for the random data replacement, for reproducibility; the same seed always gives the same cleaned data, so feel free to
+# change it to a different seed, or set it to None to get different random data every time the code is run
+RANDOM_SEED = 100
+
+# Number of hospital stays to read, clean, and load at a time; memory use depends on this rather than on the size of the CSV,
+# and the database ends up the same whatever the chunk size is
+CHUNK_SIZE = 100000
 
-# Import partially cleaned hospital stay data from CSV
-stay_data = pd.read_csv('Data files/hosp_stay_dataset_dr_names_cleaned.csv')
+# File paths of the partially cleaned stay data, the name dataset, the fully cleaned stay data, and the database
+STAY_DATA_FILE = 'Data files/hosp_stay_dataset_dr_names_cleaned.csv'
+NAME_DATA_FILE = 'Data files/name_dataset.csv'
+CLEANED_STAY_DATA_FILE = 'Data files/hosp_stay_dataset_fully_cleaned.csv'
+CLEANED_STAY_DATA_CACHE_FILE = 'Data files/hosp_stay_dataset_fully_cleaned.npz'
+DATABASE_FILE = 'hospital_stay_database.db'
 
-# Insert Date of Birth column
-stay_data.insert(loc=2, column='Date of Birth', value=['']*stay_data.shape[0])
+# Version of the cleaning code and of the cleaned data cache's format, which is part of the hash the cache is checked against;
+# increase it whenever the cleaning or the cache format changes, so that a cache made the old way is not used
+CLEANED_DATA_VERSION = 1
 
-# Insert index column
-stay_data.insert(loc=0, column='Index', value=range(1, stay_data.shape[0]+1))
+# Wall clock time and CPU time (in seconds) spent in each phase of the most recent build or ingest (reading the CSV, cleaning
+# the data, loading each table, etc.), and the number of rows it handled, which benchmark.py reports and --log-file logs
+phase_stats = {}
 
-# Import first name, last name, and gender columns from name dataset
-name_gender_data = pd.read_csv('Data files/name_dataset.csv')
+# Function to use in a with statement to add the wall clock time and CPU time spent running the statements in it to the given
+# phase's time; the statements can set the 'rows' item of the dictionary it gives to the number of rows they handled
+@contextlib.contextmanager
+def timed_phase(phase):
+    phase_rows = {'rows': 0}
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    try:
+        yield phase_rows
+    finally:
+        phase_stat = phase_stats.setdefault(phase, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'rows': 0})
+        phase_stat['wall_seconds'] += time.perf_counter()-start_time
+        phase_stat['cpu_seconds'] += time.process_time()-start_cpu_time
+        phase_stat['rows'] += phase_rows['rows']
+
+# Function to log the statistics of each phase of the most recent build or ingest, and of each SQL statement run on its
+# connection, if the instrumentation is on
+def log_phase_stats(connection, step):
+    for phase, phase_stat in phase_stats.items():
+        instrumentation.log_event('phase', step=step, phase=phase, **phase_stat)
+    instrumentation.log_statement_stats(connection, step=step)
 
 # Create list of hospitals to choose from
 hospital_list = ['Northwestern Hospital', 'Central DuPage Hospital', 'LaGrange Hospital', 'Elmhurst Hospital',
                  'Swedish Hospital', 'Good Samaritan Hospital', 'Saint Joseph Hospital', 'Resurrection Hospital',
                  'Hinsdale Hospital', 'Edward Hospital', 'Alexian Bros. Hospital', 'Mercy Hospital', 'Palos Hospital']
 
-# Function to change each age to date of birth
-def change_age_to_db(age, admission_date):
-    adm_date_year = dt.datetime.strptime(admission_date, '%Y-%m-%d').strftime('%Y')
+# Function to check which years in an array of years are leap years
+def is_leap_year(years):
+    return (years % 400 == 0) | ((years % 4 == 0) & (years % 100 != 0))
+
+# Function to change every age to a date of birth at once, given the ages, the admission dates, and the number of days
+# (0 to 364) to go back from each latest possible birth date
+def change_ages_to_dbs(ages, admission_dates, birth_date_offsets):
+    # Split the 'YYYY-MM-DD' admission dates into year, month, and day numbers by reading the digits of each date directly
+    adm_date_digits = np.asarray(admission_dates, dtype='S10').view(np.uint8).reshape(-1, 10).astype(int) - ord('0')
+    adm_date_years = adm_date_digits[:, 0]*1000 + adm_date_digits[:, 1]*100 + adm_date_digits[:, 2]*10 + adm_date_digits[:, 3]
+    adm_date_months = adm_date_digits[:, 5]*10 + adm_date_digits[:, 6]
+    adm_date_days = adm_date_digits[:, 8]*10 + adm_date_digits[:, 9]
+    birth_date_years = adm_date_years - np.asarray(ages, dtype=int)
     
     # If admission date is not on Feb 29th, latest possible birth date is the same day as admission date <Age> years prior
-    if not(dt.datetime.strptime(admission_date, '%Y-%m-%d').strftime('%m') == '02' and dt.datetime.strptime(
-           admission_date, '%Y-%m-%d').strftime('%d') == '29'):
-        latest_possible_birth_date = str(int(adm_date_year)-age)+admission_date[admission_date.find('-'):]
-    
-    # If admission date is a Leap Day in a leap year, check whether <Age> years prior was also a leap year
-    elif int(adm_date_year) % 400 == 0 or (int(adm_date_year) % 4 == 0 and int(adm_date_year) % 100 != 0):
-        
-        # If so, latest possible birth date is Leap Day <Age> years prior
-        if int(adm_date_year)-age % 400 == 0 or (int(adm_date_year)-age % 4 == 0 and int(adm_date_year)-age % 100 != 0):
-            latest_possible_birth_date = str(int(adm_date_year)-age)+'-02-29'
-        
-        # If <Age> years prior was not a leap year, latest possible birth date is Feb 28th
-        else:
-            latest_possible_birth_date = str(int(adm_date_year)-age)+'-02-28'
+    latest_birth_date_days = adm_date_days.copy()
+    leap_day_admissions = (adm_date_months == 2) & (adm_date_days == 29)
     
     # If admission date is Feb 29th but not in a leap year, warn the user
-    else:
+    if (leap_day_admissions & ~is_leap_year(adm_date_years)).any():
         warnings.warn('One of your admission dates is February 29th in a non-leap year! Please ensure the data is accurate.')
-        latest_possible_birth_date = str(int(adm_date_year)-age)+'-02-28'
     
-    # Pick any random day between latest possible birth date and 364 days before that
+    # If admission date is a Leap Day in a leap year, latest possible birth date is Leap Day <Age> years prior if that was also
+    # a leap year, and Feb 28th if not (or if the admission date itself was not in a leap year)
+    latest_birth_date_days[leap_day_admissions & ~(is_leap_year(adm_date_years) & is_leap_year(birth_date_years))] = 28
+    
+    # Build the latest possible birth dates with NumPy date arithmetic (years since 1970, then months, then days)
+    latest_possible_birth_dates = ((birth_date_years-1970).astype('datetime64[Y]').astype('datetime64[M]') +
+                                   (adm_date_months-1).astype('timedelta64[M]')).astype('datetime64[D]') + \
+                                  (latest_birth_date_days-1).astype('timedelta64[D]')
+    
+    # Go back the given random number of days (0 to 364) from each latest possible birth date
     # Note: earliest possible birth date will be 1 day later than it really should be if a Leap Day falls within this range
-    birth_date = (dt.datetime.strptime(latest_possible_birth_date, '%Y-%m-%d') - dt.timedelta(days=randint(0, 364)))\
-                 .strftime('%Y-%m-%d')
-    return birth_date
+    birth_dates = latest_possible_birth_dates - np.asarray(birth_date_offsets, dtype=int).astype('timedelta64[D]')
+    return np.datetime_as_string(birth_dates, unit='D')
 
-# Replace original patient names and genders and hospital names with more realistic ones, and change each age to date of birth
-seed(100) # For reproducibility; feel free to change to a different seed
-for df_row in range(0, stay_data.shape[0]):
+# Function to replace original patient names and genders and hospital names with more realistic ones, and change each age to
+# date of birth, for all rows at once
+# All random choices come from the given NumPy generator, which draws 4 random numbers per row (first name, last name, birth
+# date, and hospital), so cleaning the rows chunk by chunk with the same generator gives the same result as cleaning them all
+# at once
+def clean_stay_data(stay_data, name_gender_data, hospital_list, random_generator):
+    random_draws = random_generator.random((stay_data.shape[0], 4))
+    
     # Use the selected first name's gender by pulling it from the same row as the first name
-    first_name_gender_row = randint(name_gender_data.index.start, name_gender_data.index.stop-1)
-    first_name = name_gender_data.loc[first_name_gender_row, 'First Name']
-    gender = name_gender_data.loc[first_name_gender_row, 'Gender']
+    first_name_gender_rows = (random_draws[:, 0]*name_gender_data.shape[0]).astype(int)
+    genders = name_gender_data['Gender'].to_numpy()[first_name_gender_rows]
     # Choose any last name
-    last_name = name_gender_data.loc[randint(name_gender_data.index.start, name_gender_data.index.stop-1), 'Last Name']
-    # Join first name, space, and last name
-    stay_data.loc[df_row, 'Name'] = first_name+' '+last_name
-    # Convert age (assumed to be at time of admission) to date of birth
-    stay_data.loc[df_row, 'Date of Birth'] = change_age_to_db(stay_data.loc[df_row, 'Age'],
-                                                              stay_data.loc[df_row, 'Date of Admission'])
+    last_name_rows = (random_draws[:, 1]*name_gender_data.shape[0]).astype(int)
+    # Join first name, space, and last name; every possible full name is built once and then looked up for each row, which is
+    # much faster than joining the names row by row
+    full_names = (name_gender_data['First Name'].to_numpy()[:, None] + ' ' +
+                  name_gender_data['Last Name'].to_numpy()[None, :]).ravel()
+    stay_data['Name'] = full_names[first_name_gender_rows*name_gender_data.shape[0] + last_name_rows]
+    # Convert age (assumed to be at time of admission) to date of birth, picking any day between the latest possible birth
+    # date and 364 days before that
+    stay_data['Date of Birth'] = change_ages_to_dbs(stay_data['Age'], stay_data['Date of Admission'],
+                                                    (random_draws[:, 2]*365).astype(int))
     # Change gender to the correct gender (if applicable)
-    stay_data.loc[df_row, 'Gender'] = gender
+    stay_data['Gender'] = genders
     # Pick a random name from the hospital list
-    stay_data.loc[df_row, 'Hospital'] = hospital_list[randint(0, len(hospital_list)-1)]
+    stay_data['Hospital'] = np.array(hospital_list, dtype=object)[(random_draws[:, 3]*len(hospital_list)).astype(int)]
+    return stay_data
+
+# Function to import hospital stay data from a CSV and clean it, yielding one chunk of chunk_size rows at a time
+# Partially cleaned data (with an Age column) has its patient names, genders, and hospital names replaced with more realistic
+# ones and each age changed to date of birth, while fully cleaned data (with a Date of Birth column) is used as is
+def read_stay_data(csv_path, chunk_size=CHUNK_SIZE, random_seed=RANDOM_SEED):
+    # Import first name, last name, and gender columns from name dataset
+    name_gender_data = pd.read_csv(NAME_DATA_FILE)
+    # Create one random generator for the whole CSV so that the cleaned data does not depend on the chunk size
+    random_generator = np.random.default_rng(random_seed)
+    
+    # Import hospital stay data from CSV
+    stay_data_reader = pd.read_csv(csv_path, chunksize=chunk_size)
+    while True:
+        with timed_phase('read csv') as phase_rows:
+            stay_data = next(stay_data_reader, None)
+            if stay_data is None:
+                break
+            phase_rows['rows'] = stay_data.shape[0]
+        if 'Date of Birth' in stay_data.columns:
+            yield stay_data
+            continue
+        
+        # Insert Date of Birth column
+        stay_data.insert(loc=2, column='Date of Birth', value=['']*stay_data.shape[0])
+        
+        # Replace original patient names and genders and hospital names with more realistic ones, and change each age to date
+        # of birth
+        with timed_phase('clean data') as phase_rows:
+            stay_data = clean_stay_data(stay_data, name_gender_data, hospital_list, random_generator)
+            phase_rows['rows'] = stay_data.shape[0]
+        
+        # Remove Age column
+        yield stay_data.drop('Age', axis=1)
 
-# Remove Age column
-stay_data = stay_data.drop('Age', axis=1)    
+# Function to save each chunk of cleaned hospital stay data to a CSV as it passes through, so the whole CSV never has to be
+# kept in memory
+def save_stay_data(stay_data_chunks, csv_path):
+    for chunk_number, stay_data in enumerate(stay_data_chunks):
+        with timed_phase('save csv') as phase_rows:
+            stay_data.to_csv(csv_path, index=False, mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0)
+            phase_rows['rows'] = stay_data.shape[0]
+        yield stay_data
 
-# Now that the data has been fully cleaned, save it to a CSV so other data analysts can use it for various purposes
-stay_data.iloc[:, 1:].to_csv('Data files/hosp_stay_dataset_fully_cleaned.csv', index=False)
+# Columns of the cleaned hospital stay data that hold dates, which the cleaned data cache stores as dates and the date table
+# covers
+DATE_COLUMNS = ['Date of Birth', 'Date of Admission', 'Discharge Date']
+
+# Function to get a hash of everything the cleaned data depends on (the stay data CSV, the name dataset, the hospital list,
+# the seed, and the version of the cleaning code), or None if the seed is None, since the cleaned data is then different every
+# time
+def get_stay_data_hash(csv_path, random_seed=RANDOM_SEED):
+    if random_seed is None:
+        return None
+    stay_data_hash = hashlib.sha256(repr((CLEANED_DATA_VERSION, random_seed, hospital_list)).encode())
+    for file_path in [csv_path, NAME_DATA_FILE]:
+        with open(file_path, 'rb') as data_file:
+            for data_block in iter(lambda: data_file.read(1048576), b''):
+                stay_data_hash.update(data_block)
+    return stay_data_hash.hexdigest()
+
+# Function to write an array to the cleaned data cache (a ZIP file of NumPy arrays like numpy.savez_compressed makes)
+def write_cache_array(cache, array_name, array):
+    with cache.open(array_name+'.npy', 'w', force_zip64=True) as array_file:
+        np.lib.format.write_array(array_file, array, allow_pickle=False)
+
+# Function to read an array from the cleaned data cache
+def read_cache_array(cache, array_name):
+    with cache.open(array_name+'.npy') as array_file:
+        return np.lib.format.read_array(array_file, allow_pickle=False)
+
+# Function to read the description of the cleaned data cache (its columns, number of chunks and rows, and the hash of the
+# stay data it was cleaned from), or None if there is no cache
+def read_stay_data_cache_metadata(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with zipfile.ZipFile(cache_path) as cache:
+            return json.loads(cache.read('metadata.json'))
+    except (zipfile.BadZipFile, KeyError, ValueError):
+        return None
+
+# Function to save each chunk of cleaned hospital stay data to the cleaned data cache as it passes through, with the given
+# hash of the stay data it was cleaned from
+# Each chunk's columns are stored as separate compressed arrays (the dates as dates, the text columns as their distinct
+# values and a code per row), so memory use stays flat; the cache is written to a temporary file that only replaces the cache
+# once every chunk has been saved, so an interrupted build never leaves a cache that looks complete, and that is deleted if
+# the build fails
+def save_stay_data_cache(stay_data_chunks, cache_path, stay_data_hash):
+    building_cache_path = cache_path+'.building'
+    chunk_count = 0
+    row_count = 0
+    try:
+        with zipfile.ZipFile(building_cache_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as cache:
+            for stay_data in stay_data_chunks:
+                with timed_phase('save cache') as phase_rows:
+                    for column in stay_data.columns:
+                        array_name = 'chunk_'+str(chunk_count)+'/'+column
+                        if column in DATE_COLUMNS:
+                            write_cache_array(cache, array_name, pd.to_datetime(stay_data[column], format='%Y-%m-%d')
+                                              .to_numpy().astype('datetime64[D]'))
+                        elif not pd.api.types.is_numeric_dtype(stay_data[column]):
+                            value_codes, values = pd.factorize(stay_data[column])
+                            write_cache_array(cache, array_name+'.values', values.to_numpy().astype(str))
+                            write_cache_array(cache, array_name+'.codes',
+                                              value_codes.astype(np.min_scalar_type(max(values.shape[0]-1, 0))))
+                        else:
+                            write_cache_array(cache, array_name, stay_data[column].to_numpy())
+                    chunk_count += 1
+                    row_count += stay_data.shape[0]
+                    phase_rows['rows'] = stay_data.shape[0]
+                yield stay_data
+            cache.writestr('metadata.json', json.dumps({'columns': list(stay_data.columns) if chunk_count > 0 else [],
+                                                        'chunk_count': chunk_count, 'row_count': row_count,
+                                                        'stay_data_hash': stay_data_hash}))
+        os.replace(building_cache_path, cache_path)
+    except BaseException:
+        if os.path.exists(building_cache_path):
+            os.remove(building_cache_path)
+        raise
+
+# Function to read the cleaned hospital stay data from the cleaned data cache, yielding one chunk (as saved) at a time
+# By default, dates are datetime64 columns and text columns are categorical; with csv_types, every column has the type it has
+# when read from the fully cleaned CSV (i.e., text for dates), which is what the database load expects
+def read_stay_data_cache(cache_path=CLEANED_STAY_DATA_CACHE_FILE, csv_types=False):
+    with zipfile.ZipFile(cache_path) as cache:
+        cache_metadata = json.loads(cache.read('metadata.json'))
+        for chunk_number in range(cache_metadata['chunk_count']):
+            with timed_phase('read cache') as phase_rows:
+                stay_data = {}
+                for column in cache_metadata['columns']:
+                    array_name = 'chunk_'+str(chunk_number)+'/'+column
+                    if array_name+'.codes.npy' in cache.NameToInfo:
+                        values = read_cache_array(cache, array_name+'.values')
+                        value_codes = read_cache_array(cache, array_name+'.codes')
+                        if csv_types:
+                            stay_data[column] = values.astype(object)[value_codes]
+                        else:
+                            stay_data[column] = pd.Categorical.from_codes(value_codes.astype('int64'), values)
+                    elif column in DATE_COLUMNS and csv_types:
+                        stay_data[column] = np.datetime_as_string(read_cache_array(cache, array_name)).astype(object)
+                    else:
+                        stay_data[column] = read_cache_array(cache, array_name)
+                stay_data = pd.DataFrame(stay_data)
+                phase_rows['rows'] = stay_data.shape[0]
+            yield stay_data
+
+# Function to load the whole cleaned hospital stay data from the cleaned data cache into one DataFrame, with dates as
+# datetime64 columns and text columns as categorical ones, for anyone who needs the cleaned data in Python
+def load_cleaned_stay_data(cache_path=CLEANED_STAY_DATA_CACHE_FILE):
+    stay_data_chunks = list(read_stay_data_cache(cache_path))
+    if len(stay_data_chunks) == 0:
+        return pd.DataFrame()
+    # Combine each text column's chunks so that the whole column has one list of distinct values
+    return pd.DataFrame({column: pd.api.types.union_categoricals([stay_data[column] for stay_data in stay_data_chunks])
+                         if isinstance(stay_data_chunks[0][column].dtype, pd.CategoricalDtype)
+                         else np.concatenate([stay_data[column].to_numpy() for stay_data in stay_data_chunks])
+                         for column in stay_data_chunks[0].columns})
 
 
 
 
 # Part 2: Create the database and load it with data
 
-# Create connection to the database hospital_stay_database, or create the database if it does not already exist
-connection = sqlite3.connect('hospital_stay_database.db') 
-# Also create a cursor from this connection to collect query results (for finding foreign key IDs when adding the data)
-cursor = connection.cursor()
+# Number of hospital stays to insert into the fact table per executemany call
+FACT_BATCH_SIZE = 50000
 
+# Number of days after the latest discharge date that the date table covers, so that loading stays admitted or discharged a
+# little later does not need any new dates
+DATE_RANGE_MARGIN_DAYS = 366
 
-# Drop tables if they already exist so we can run the CREATE TABLE command
-for table in ['date', 'patient', 'doctor', 'hospital', 'insurance', 'admission_type', 'medication', 'test_results',
-              'hospital_stay']:
-    try:
-        connection.execute('DROP TABLE '+table+';')
-        connection.commit()
-    except sqlite3.OperationalError:
-        pass
-
-
-# Create date dimension table and define its column structure
-# Dimension table stores data related to people, objects, or entities involved in the fact table below
-connection.execute('CREATE TABLE date (date_id DATE PRIMARY KEY, '+
-                   'date_year INT NOT NULL, '+
-                   'date_quarter INT NOT NULL, '+
-                   'date_month INT NOT NULL, '+
-                   'date_day INT NOT NULL, '+
-                   'date_month_name CHARACTER(9) NOT NULL, '+
-                   'date_quarter_in_year CHARACTER(7) NOT NULL, '+
-                   'date_day_of_week CHARACTER(9) NOT NULL);')
-connection.commit()
-
-# Load each unique patient date of birth, admission date, and discharge date into the table
-# The set function gets the unique values of these columns and allows them to all be merged into one large list
-date_list = list(set(stay_data['Date of Birth']) | set(stay_data['Date of Admission']) | set(stay_data['Discharge Date']))
-for date in date_list:
-    date_year = int(dt.datetime.strptime(date, '%Y-%m-%d').strftime('%Y'))
-    date_month = int(dt.datetime.strptime(date, '%Y-%m-%d').strftime('%m'))
-    date_day = int(dt.datetime.strptime(date, '%Y-%m-%d').strftime('%d'))
-    date_quarter = pd.Timestamp(date_year, date_month, date_day).quarter
-    connection.execute('INSERT INTO date VALUES ("'+date+'", '+ # date_id
-                       str(date_year)+', '+ # date_year
-                       str(date_quarter)+', '+ # date_quarter
-                       str(date_month)+', '+ # date_month
-                       str(date_day)+', '+ # date_day
-                       '"'+dt.datetime.strptime(date, '%Y-%m-%d').strftime('%B')+'", '+ # date_month_name
-                       '"Q'+str(date_quarter)+' '+str(date_year)+'", '+ # date_quarter_in_year
-                       '"'+dt.datetime.strptime(date, '%Y-%m-%d').strftime('%A')+'");') # date_day_of_week
-connection.commit()
-
-
-# Create patient dimension table and define its column structure
-connection.execute('CREATE TABLE patient (patient_id INT PRIMARY KEY,'+
-                   'patient_name TEXT NOT NULL, '+
-                   'patient_birth_date DATE NOT NULL, '+
-                   'patient_gender CHARACTER(6) NOT NULL, '+
-                   'patient_blood_type CHARACTER(3) NOT NULL, '+
-                   'patient_medical_condition TEXT NOT NULL, '+
-                   'FOREIGN KEY (patient_birth_date) REFERENCES date(date_id), '+
-                   'UNIQUE(patient_name, patient_birth_date, patient_gender, '+
-                   'patient_blood_type, patient_medical_condition));')
-connection.commit()
-
-# Load each unique patient's data into the table
-id_num = 1
-for df_row in range(0, stay_data.shape[0]):
-    connection.execute('INSERT INTO patient VALUES ('+str(id_num)+', '+ # patient_id
-                       '"'+stay_data.loc[df_row, 'Name']+'", '+ # patient_name
-                       '"'+stay_data.loc[df_row, 'Date of Birth']+'", '+ # patient_birth_date
-                       '"'+stay_data.loc[df_row, 'Gender']+'", '+ # patient_gender
-                       '"'+stay_data.loc[df_row, 'Blood Type']+'", '+ # patient_blood_type
-                       '"'+stay_data.loc[df_row, 'Medical Condition']+'");') # patient_medical_condition
-    id_num += 1
-connection.commit()
-
-
-# Create doctor dimension table and define its column structure
-connection.execute('CREATE TABLE doctor (doctor_id INT PRIMARY KEY, doctor_name TEXT NOT NULL UNIQUE);')
-connection.commit()
-
-# Load each unique doctor's data into the table
-id_num = 1
-doctor_list = list(set(stay_data['Doctor']))
-for doctor_name in doctor_list:
-    connection.execute('INSERT INTO doctor VALUES ('+str(id_num)+', "'+doctor_name+'");')
-    id_num += 1
-connection.commit()
-
-
-# Create hospital dimension table and define its column structure
-connection.execute('CREATE TABLE hospital (hospital_id INT PRIMARY KEY, hospital_name TEXT NOT NULL, '+
-                   'hospital_room INT NOT NULL, UNIQUE(hospital_name, hospital_room));')
-connection.commit()
-
-# Load each unique hospital name and room number combination into the table
-id_num = 1
-for row in stay_data.groupby(['Hospital', 'Room Number']):
-    connection.execute('INSERT INTO hospital VALUES ('+str(id_num)+', "'+row[0][0]+'", '+str(row[0][1])+');')
-    id_num += 1
-
-
-# Create insurance dimension table and define its column structure
-connection.execute('CREATE TABLE insurance (insurance_provider_id INT PRIMARY KEY, insurance_provider_name TEXT NOT NULL '+
-                   'UNIQUE);')
-connection.commit()
-
-# Load each unique insurance provider's name into the table
-id_num = 1
-provider_list = list(set(stay_data['Insurance Provider']))
-for provider_name in provider_list:
-    connection.execute('INSERT INTO insurance VALUES ('+str(id_num)+', "'+provider_name+'");')
-    id_num += 1
-connection.commit()
-
-
-# Create admission_type dimension table and define its column structure
-connection.execute('CREATE TABLE admission_type (adm_type_id INT PRIMARY KEY, adm_type TEXT NOT NULL UNIQUE);')
-connection.commit()
-
-# Load each unique admission type into the table
-id_num = 1
-adm_type_list = list(set(stay_data['Admission Type']))
-for adm_type in adm_type_list:
-    connection.execute('INSERT INTO admission_type VALUES ('+str(id_num)+', "'+adm_type+'");')
-    id_num += 1
-connection.commit()
-
-
-# Create medication dimension table and define its column structure
-connection.execute('CREATE TABLE medication (medication_id INT PRIMARY KEY, medication_name TEXT NOT NULL UNIQUE);')
-connection.commit()
-
-# Load each unique medication into the table
-id_num = 1
-med_list = list(set(stay_data['Medication']))
-for med in med_list:
-    connection.execute('INSERT INTO medication VALUES ('+str(id_num)+', "'+med+'");')
-    id_num += 1
-connection.commit()
-
-
-# Create test_results dimension table and define its column structure
-connection.execute('CREATE TABLE test_results (test_results_id INT PRIMARY KEY, test_results TEXT NOT NULL UNIQUE);')
-connection.commit()
-
-# Load each unique test result into the table
-id_num = 1
-result_list = list(set(stay_data['Test Results']))
-for result in result_list:
-    connection.execute('INSERT INTO test_results VALUES ('+str(id_num)+', "'+result+'");')
-    id_num += 1
-connection.commit()
-
-
-# Create hospital stay fact table
-# Fact table stores quantitative data about a business/organizational event
-connection.execute('CREATE TABLE hospital_stay (stay_id INT PRIMARY KEY, '+
-                   'patient_id INT NOT NULL, '+
-                   'doctor_id INT NOT NULL, '+
-                   'hospital_id INT NOT NULL, '+
-                   'insurance_provider_id INT NOT NULL, '+
-                   'adm_type_id INT NOT NULL, '+
-                   'medication_id INT NOT NULL, '+
-                   'test_results_id INT NOT NULL, '+
-                   'admission_date DATE NOT NULL, '+
-                   'discharge_date DATE NOT NULL, '+
-                   'billing_amt NUMERIC NOT NULL, '+
-                   'FOREIGN KEY (patient_id) REFERENCES patient(patient_id), '+
-                   'FOREIGN KEY (doctor_id) REFERENCES doctor(doctor_id), '+
-                   'FOREIGN KEY (hospital_id) REFERENCES hospital(hospital_id), '+
-                   'FOREIGN KEY (insurance_provider_id) REFERENCES insurance(insurance_provider_id), '+
-                   'FOREIGN KEY (adm_type_id) REFERENCES admission_type(adm_type_id), '+
-                   'FOREIGN KEY (medication_id) REFERENCES medication(medication_id), '+
-                   'FOREIGN KEY (test_results_id) REFERENCES test_results(test_results_id), '+
-                   'FOREIGN KEY (admission_date) REFERENCES date(date_id), '+
-                   'FOREIGN KEY (discharge_date) REFERENCES date(date_id), '+
-                   'UNIQUE(patient_id, doctor_id, hospital_id, insurance_provider_id, adm_type_id, medication_id, '+
-                   'test_results_id, admission_date, discharge_date, billing_amt));')
-connection.commit()
-
-
-# Load the hospital stay data into the database row by row
-for df_row in range(0, stay_data.shape[0]):
+# Names of the months and days of the week for the date table
+MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November',
+               'December']
+DAY_OF_WEEK_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Dimension tables (other than date) with their ID column, the columns whose combination must be unique in each row (the
+# natural key), and the matching columns of the cleaned hospital stay data
+DIMENSION_TABLES = [('patient', 'patient_id', ['patient_name', 'patient_birth_date', 'patient_gender', 'patient_blood_type',
+                                               'patient_medical_condition'],
+                     ['Name', 'Date of Birth', 'Gender', 'Blood Type', 'Medical Condition']),
+                    ('doctor', 'doctor_id', ['doctor_name'], ['Doctor']),
+                    ('hospital', 'hospital_id', ['hospital_name', 'hospital_room'], ['Hospital', 'Room Number']),
+                    ('insurance', 'insurance_provider_id', ['insurance_provider_name'], ['Insurance Provider']),
+                    ('admission_type', 'adm_type_id', ['adm_type'], ['Admission Type']),
+                    ('medication', 'medication_id', ['medication_name'], ['Medication']),
+                    ('test_results', 'test_results_id', ['test_results'], ['Test Results'])]
+
+# Settings for building the database in its temporary file: a page size chosen before any table is created, a large page
+# cache (a negative cache_size is in KiB, so this is 256 MB), and no rollback journal or waiting for the disk after each write
+# N.B.: Without a journal, a build that is interrupted leaves a broken temporary file, which is simply deleted by the next build
+BUILD_PRAGMAS = ['PRAGMA page_size = 8192;', 'PRAGMA cache_size = -262144;', 'PRAGMA journal_mode = OFF;',
+                 'PRAGMA synchronous = OFF;', 'PRAGMA temp_store = MEMORY;', 'PRAGMA locking_mode = EXCLUSIVE;']
+
+# Settings for the finished database: write-ahead logging (WAL), in which a write goes to a separate file first, so that any
+# number of connections (e.g. query_server.py's pool) can read the database at once while stays are being ingested, without
+# waiting for each other or getting "database is locked" errors
+# N.B.: The exclusive locking mode used for the build has to be turned off first, or WAL mode would need no other connections
+WAL_PRAGMAS = ['PRAGMA locking_mode = NORMAL;', 'PRAGMA journal_mode = WAL;']
+
+# Secondary indexes on the hospital stay fact table (index name, table, and columns), which are created once all the data has
+# been loaded since building an index in one go is much faster than updating it for every row inserted
+# Each foreign key gets an index so that a query filtering on a dimension (e.g. one insurance provider) only reads the
+# matching stays instead of the whole fact table; the dates and billing amounts are added to the indexes most often used for
+# billing totals, so those queries can be answered from the index alone. The insurance index keeps each provider's stays in
+# patient order so that joining them to the patient table reads it in order too. The admission and discharge date indexes
+# serve date range queries, including billing totals per insurance provider, hospital, or admission type over a date range;
+# their billing amounts come last, since with the billing amount second SQLite would skip-scan them (go through every date)
+# for a filter on the billing amount alone, which is slower than reading the table.
+# patient_id needs no index of its own since the table's UNIQUE index already starts with it.
+INDEXES = [('hospital_stay_doctor_idx', 'hospital_stay', ['doctor_id']),
+           ('hospital_stay_hospital_idx', 'hospital_stay', ['hospital_id', 'admission_date', 'billing_amt']),
+           ('hospital_stay_insurance_idx', 'hospital_stay', ['insurance_provider_id', 'patient_id', 'admission_date',
+                                                              'billing_amt']),
+           ('hospital_stay_adm_type_idx', 'hospital_stay', ['adm_type_id', 'admission_date', 'billing_amt']),
+           ('hospital_stay_medication_idx', 'hospital_stay', ['medication_id']),
+           ('hospital_stay_test_results_idx', 'hospital_stay', ['test_results_id']),
+           ('hospital_stay_admission_date_idx', 'hospital_stay', ['admission_date', 'insurance_provider_id', 'hospital_id',
+                                                                   'adm_type_id', 'billing_amt']),
+           ('hospital_stay_discharge_date_idx', 'hospital_stay', ['discharge_date', 'insurance_provider_id', 'hospital_id',
+                                                                   'adm_type_id', 'billing_amt'])]
+
+# Name search tables: FTS5 full-text indexes over the patient and doctor names, as (name search table, dimension table, ID
+# column, name column) tuples
+# Each name is split into trigrams (every run of 3 characters), so a search for any part of a name that is at least 3
+# characters long (e.g. 'derk' for 'Rebecca Derkins') only reads the names containing it instead of scanning the whole
+# dimension table, upper or lower case alike. The tables only hold the index, reading the names from their dimension table
+# (FTS5's external content) and leaving out the name lengths used for ranking matches (columnsize=0), and triggers on the
+# dimension tables keep them up to date with any change to the names.
+NAME_SEARCH_TABLES = [('patient_name_search', 'patient', 'patient_id', 'patient_name'),
+                      ('doctor_name_search', 'doctor', 'doctor_id', 'doctor_name')]
+
+# Billing summary tables and the views that show them
+SUMMARY_TABLES = ['billing_insurance_month_summary', 'billing_hospital_quarter_summary', 'billing_condition_year_summary',
+                  'billing_summary_state']
+SUMMARY_VIEWS = ['billing_by_insurance_month', 'billing_by_hospital_quarter', 'billing_by_condition_year']
+
+# Billing summary tables, each with the columns it is keyed by, the tables (other than hospital_stay and date) its groups
+# come from, and the statement adding the hospital stays that meet a condition to it; with a minus sign, the statement takes
+# those stays away from it instead. The billing amounts are added up in cents so that the totals stay exact
+# N.B.: SQLite needs the WHERE clause for it to tell the ON CONFLICT clause apart from a join condition
+SUMMARY_STATEMENTS = [('billing_insurance_month_summary', ['insurance_provider_id', 'date_year', 'date_month'], [],
+                       'INSERT INTO billing_insurance_month_summary '+
+                       'SELECT hs.insurance_provider_id, d.date_year, d.date_month, d.date_month_name, '+
+                       'd.date_quarter, d.date_quarter_in_year, {sign}COUNT(*), '+
+                       '{sign}SUM(CAST(ROUND(hs.billing_amt*100) AS INT)) '+
+                       'FROM hospital_stay hs JOIN date d ON d.date_id = hs.admission_date '+
+                       'WHERE {condition} GROUP BY hs.insurance_provider_id, d.date_year, d.date_month '+
+                       'ON CONFLICT DO UPDATE SET stay_count = stay_count+excluded.stay_count, '+
+                       'billing_cents = billing_cents+excluded.billing_cents;'),
+                      ('billing_hospital_quarter_summary', ['hospital_name', 'date_year', 'date_quarter'], ['hospital'],
+                       'INSERT INTO billing_hospital_quarter_summary '+
+                       'SELECT h.hospital_name, d.date_year, d.date_quarter, d.date_quarter_in_year, {sign}COUNT(*), '+
+                       '{sign}SUM(CAST(ROUND(hs.billing_amt*100) AS INT)) '+
+                       'FROM hospital_stay hs JOIN date d ON d.date_id = hs.admission_date '+
+                       'JOIN hospital h ON h.hospital_id = hs.hospital_id '+
+                       'WHERE {condition} GROUP BY h.hospital_name, d.date_year, d.date_quarter '+
+                       'ON CONFLICT DO UPDATE SET stay_count = stay_count+excluded.stay_count, '+
+                       'billing_cents = billing_cents+excluded.billing_cents;'),
+                      ('billing_condition_year_summary', ['patient_medical_condition', 'date_year'], ['patient'],
+                       'INSERT INTO billing_condition_year_summary '+
+                       'SELECT p.patient_medical_condition, d.date_year, {sign}COUNT(*), '+
+                       '{sign}SUM(CAST(ROUND(hs.billing_amt*100) AS INT)) '+
+                       'FROM hospital_stay hs JOIN date d ON d.date_id = hs.admission_date '+
+                       'JOIN patient p ON p.patient_id = hs.patient_id '+
+                       'WHERE {condition} GROUP BY p.patient_medical_condition, d.date_year '+
+                       'ON CONFLICT DO UPDATE SET stay_count = stay_count+excluded.stay_count, '+
+                       'billing_cents = billing_cents+excluded.billing_cents;')]
+
+# Tables whose rows the billing summaries are made from, each with its name in the compact layout (see COMPACT_TABLES), the
+# column of the hospital stay table that refers to its rows, the column of its own that column refers to, and the columns of
+# its own that the summaries use
+# The rows of the date table are only ever added by the load, but their changes are followed like the others'
+SUMMARY_SOURCE_TABLES = [('hospital_stay', 'hospital_stay_compact', 'stay_id', 'stay_id',
+                          ['stay_id', 'patient_id', 'hospital_id', 'insurance_provider_id', 'admission_date', 'billing_amt']),
+                         ('patient', 'patient', 'patient_id', 'patient_id', ['patient_id', 'patient_medical_condition']),
+                         ('hospital', 'hospital', 'hospital_id', 'hospital_id', ['hospital_id', 'hospital_name']),
+                         ('date', 'date_compact', 'admission_date', 'date_id',
+                          ['date_id', 'date_year', 'date_quarter', 'date_quarter_in_year', 'date_month', 'date_month_name'])]
+
+# Triggers keeping the billing summaries up to date with each change to the rows they are made from, as (name, when the
+# trigger runs, the row whose stays are added or taken away, the sign of the change, and the change to billing_summary_state
+# for a change to a hospital stay): the stays a row involves are taken away from the summaries before the row is changed
+# or deleted and added back after it is changed or inserted
+SUMMARY_TRIGGERS = [('insert', 'AFTER INSERT', 'new', '', 'last_stay_id = MAX(last_stay_id, new.stay_id), '+
+                     'stay_count = stay_count+1'),
+                    ('delete', 'BEFORE DELETE', 'old', '-', 'stay_count = stay_count-1'),
+                    ('update_old', 'BEFORE UPDATE OF {columns}', 'old', '-', None),
+                    ('update_new', 'AFTER UPDATE OF {columns}', 'new', '', 'last_stay_id = MAX(last_stay_id, new.stay_id)')]
+
+# Columns of the hospital stay fact table whose combination must be unique in each row
+FACT_KEY_COLUMNS = ['patient_id', 'doctor_id', 'hospital_id', 'insurance_provider_id', 'adm_type_id', 'medication_id',
+                    'test_results_id', 'admission_date', 'discharge_date', 'billing_amt']
+
+# The compact layout (built with the --compact option) stores the hospital stay fact table and the date dimension in the
+# hospital_stay_compact and date_compact tables, with every date in the fact table as an integer day number (the number of
+# days since 1970-01-01, which is what NumPy dates count and date(day_number*86400, 'unixepoch') turns back into
+# 'YYYY-MM-DD' text) and every billing amount as an integer number of cents. This makes each stay's row smaller, date range
+# filters compare numbers instead of text, and billing totals exact. The hospital_stay and date views show these tables with
+# the usual columns and formats, so every query written for the usual layout works on the compact one too (but stays can
+# only be changed through the tables).
+COMPACT_TABLES = ['date_compact', 'hospital_stay_compact']
+COMPACT_VIEWS = ['date', 'hospital_stay']
+
+# Columns of the hospital stay fact table that the compact layout stores differently, and their names in it
+COMPACT_COLUMNS = {'admission_date': 'admission_day', 'discharge_date': 'discharge_day', 'billing_amt': 'billing_cents'}
+COMPACT_FACT_KEY_COLUMNS = [COMPACT_COLUMNS.get(column, column) for column in FACT_KEY_COLUMNS]
+
+# Queries that scan the hospital stay fact table, as (name, query on the usual tables or the views, the same query on the
+# compact tables) tuples, timed on both layouts by the --compare-layouts option
+LAYOUT_SCAN_QUERIES = [('all stays', 'SELECT * FROM hospital_stay;', 'SELECT * FROM hospital_stay_compact;'),
+                       ('billing total', 'SELECT SUM(billing_amt) FROM hospital_stay;',
+                        'SELECT SUM(billing_cents)/100.0 FROM hospital_stay_compact;'),
+                       ('2020 admissions', 'SELECT COUNT(*), SUM(billing_amt) FROM hospital_stay '+
+                        'WHERE admission_date BETWEEN \'2020-01-01\' AND \'2020-12-31\';',
+                        'SELECT COUNT(*), SUM(billing_cents)/100.0 FROM hospital_stay_compact '+
+                        'WHERE admission_day BETWEEN unixepoch(\'2020-01-01\')/86400 AND unixepoch(\'2020-12-31\')/86400;'),
+                       ('stays longer than 20 days', 'SELECT COUNT(*) FROM hospital_stay '+
+                        'WHERE julianday(discharge_date)-julianday(admission_date) > 20;',
+                        'SELECT COUNT(*) FROM hospital_stay_compact WHERE discharge_day-admission_day > 20;'),
+                       ('billing total by year', 'SELECT d.date_year, SUM(hs.billing_amt) FROM hospital_stay hs '+
+                        'JOIN date d ON d.date_id = hs.admission_date GROUP BY d.date_year;',
+                        'SELECT d.date_year, SUM(hs.billing_cents)/100.0 FROM hospital_stay_compact hs '+
+                        'JOIN date_compact d ON d.date_number = hs.admission_day GROUP BY d.date_year;')]
+
+# Number of times each scan query is run by --compare-layouts (the fastest run counts)
+LAYOUT_TIMING_RUNS = 3
+
+# Function to drop all the tables if they already exist and then create them again, in the compact layout if compact is True
+def create_tables(connection, compact=False):
+    # Drop tables and views if they already exist so we can run the CREATE TABLE and CREATE VIEW commands (hospital_stay and
+    # date are views in the compact layout, so dropping them as views fails in the usual layout and vice versa)
+    for view in SUMMARY_VIEWS+COMPACT_VIEWS:
+        try:
+            connection.execute('DROP VIEW IF EXISTS '+view+';')
+        except sqlite3.OperationalError:
+            pass
+    for table in ['date', 'patient', 'doctor', 'hospital', 'insurance', 'admission_type', 'medication', 'test_results',
+                  'hospital_stay']+SUMMARY_TABLES+COMPACT_TABLES+[name_search[0] for name_search in NAME_SEARCH_TABLES]:
+        try:
+            connection.execute('DROP TABLE '+table+';')
+            connection.commit()
+        except sqlite3.OperationalError:
+            pass
+    
+    
+    # Create date dimension table and define its column structure (the compact layout creates its own date dimension table
+    # along with its fact table below)
+    # Dimension table stores data related to people, objects, or entities involved in the fact table below
+    if not compact:
+        connection.execute('CREATE TABLE date (date_id DATE PRIMARY KEY, '+
+                           'date_year INT NOT NULL, '+
+                           'date_quarter INT NOT NULL, '+
+                           'date_month INT NOT NULL, '+
+                           'date_day INT NOT NULL, '+
+                           'date_month_name CHARACTER(9) NOT NULL, '+
+                           'date_quarter_in_year CHARACTER(7) NOT NULL, '+
+                           'date_day_of_week CHARACTER(9) NOT NULL);')
+    
+    # Create patient dimension table and define its column structure
+    connection.execute('CREATE TABLE patient (patient_id INT PRIMARY KEY,'+
+                       'patient_name TEXT NOT NULL, '+
+                       'patient_birth_date DATE NOT NULL, '+
+                       'patient_gender CHARACTER(6) NOT NULL, '+
+                       'patient_blood_type CHARACTER(3) NOT NULL, '+
+                       'patient_medical_condition TEXT NOT NULL, '+
+                       'FOREIGN KEY (patient_birth_date) REFERENCES date(date_id), '+
+                       'UNIQUE(patient_name, patient_birth_date, patient_gender, '+
+                       'patient_blood_type, patient_medical_condition));')
+    
+    # Create doctor dimension table and define its column structure
+    connection.execute('CREATE TABLE doctor (doctor_id INT PRIMARY KEY, doctor_name TEXT NOT NULL UNIQUE);')
+    
+    # Create hospital dimension table and define its column structure
+    connection.execute('CREATE TABLE hospital (hospital_id INT PRIMARY KEY, hospital_name TEXT NOT NULL, '+
+                       'hospital_room INT NOT NULL, UNIQUE(hospital_name, hospital_room));')
+    
+    # Create insurance dimension table and define its column structure
+    connection.execute('CREATE TABLE insurance (insurance_provider_id INT PRIMARY KEY, insurance_provider_name TEXT NOT '+
+                       'NULL UNIQUE);')
+    
+    # Create admission_type dimension table and define its column structure
+    connection.execute('CREATE TABLE admission_type (adm_type_id INT PRIMARY KEY, adm_type TEXT NOT NULL UNIQUE);')
+    
+    # Create medication dimension table and define its column structure
+    connection.execute('CREATE TABLE medication (medication_id INT PRIMARY KEY, medication_name TEXT NOT NULL UNIQUE);')
+    
+    # Create test_results dimension table and define its column structure
+    connection.execute('CREATE TABLE test_results (test_results_id INT PRIMARY KEY, test_results TEXT NOT NULL UNIQUE);')
+    
+    # Create hospital stay fact table (or, in the compact layout, its compact fact and date dimension tables and the views
+    # that show them like the usual tables)
+    # Fact table stores quantitative data about a business/organizational event
+    if compact:
+        create_compact_tables(connection)
+    else:
+        connection.execute('CREATE TABLE hospital_stay (stay_id INT PRIMARY KEY, '+
+                           'patient_id INT NOT NULL, '+
+                           'doctor_id INT NOT NULL, '+
+                           'hospital_id INT NOT NULL, '+
+                           'insurance_provider_id INT NOT NULL, '+
+                           'adm_type_id INT NOT NULL, '+
+                           'medication_id INT NOT NULL, '+
+                           'test_results_id INT NOT NULL, '+
+                           'admission_date DATE NOT NULL, '+
+                           'discharge_date DATE NOT NULL, '+
+                           'billing_amt NUMERIC NOT NULL, '+
+                           'FOREIGN KEY (patient_id) REFERENCES patient(patient_id), '+
+                           'FOREIGN KEY (doctor_id) REFERENCES doctor(doctor_id), '+
+                           'FOREIGN KEY (hospital_id) REFERENCES hospital(hospital_id), '+
+                           'FOREIGN KEY (insurance_provider_id) REFERENCES insurance(insurance_provider_id), '+
+                           'FOREIGN KEY (adm_type_id) REFERENCES admission_type(adm_type_id), '+
+                           'FOREIGN KEY (medication_id) REFERENCES medication(medication_id), '+
+                           'FOREIGN KEY (test_results_id) REFERENCES test_results(test_results_id), '+
+                           'FOREIGN KEY (admission_date) REFERENCES date(date_id), '+
+                           'FOREIGN KEY (discharge_date) REFERENCES date(date_id), '+
+                           'UNIQUE(patient_id, doctor_id, hospital_id, insurance_provider_id, adm_type_id, medication_id, '+
+                           'test_results_id, admission_date, discharge_date, billing_amt));')
+    
+    create_summary_tables(connection)
+    connection.commit()
+
+# Function to create the tables and views of the compact layout: date_compact, which is the date dimension table with an
+# integer day number as its ID (the text date is kept as a column, since the table only has one row per date), and
+# hospital_stay_compact, which is the fact table with day numbers instead of dates and cents instead of billing amounts
+# The IDs are INTEGER PRIMARY KEY columns, which SQLite uses as the row ID of each table rather than keeping a separate
+# index for them
+def create_compact_tables(connection):
+    connection.execute('CREATE TABLE date_compact (date_number INTEGER PRIMARY KEY, '+
+                       'date_id DATE NOT NULL UNIQUE, '+
+                       'date_year INT NOT NULL, '+
+                       'date_quarter INT NOT NULL, '+
+                       'date_month INT NOT NULL, '+
+                       'date_day INT NOT NULL, '+
+                       'date_month_name CHARACTER(9) NOT NULL, '+
+                       'date_quarter_in_year CHARACTER(7) NOT NULL, '+
+                       'date_day_of_week CHARACTER(9) NOT NULL);')
+    connection.execute('CREATE TABLE hospital_stay_compact (stay_id INTEGER PRIMARY KEY, '+
+                       'patient_id INT NOT NULL, '+
+                       'doctor_id INT NOT NULL, '+
+                       'hospital_id INT NOT NULL, '+
+                       'insurance_provider_id INT NOT NULL, '+
+                       'adm_type_id INT NOT NULL, '+
+                       'medication_id INT NOT NULL, '+
+                       'test_results_id INT NOT NULL, '+
+                       'admission_day INT NOT NULL, '+
+                       'discharge_day INT NOT NULL, '+
+                       'billing_cents INT NOT NULL, '+
+                       'FOREIGN KEY (patient_id) REFERENCES patient(patient_id), '+
+                       'FOREIGN KEY (doctor_id) REFERENCES doctor(doctor_id), '+
+                       'FOREIGN KEY (hospital_id) REFERENCES hospital(hospital_id), '+
+                       'FOREIGN KEY (insurance_provider_id) REFERENCES insurance(insurance_provider_id), '+
+                       'FOREIGN KEY (adm_type_id) REFERENCES admission_type(adm_type_id), '+
+                       'FOREIGN KEY (medication_id) REFERENCES medication(medication_id), '+
+                       'FOREIGN KEY (test_results_id) REFERENCES test_results(test_results_id), '+
+                       'FOREIGN KEY (admission_day) REFERENCES date_compact(date_number), '+
+                       'FOREIGN KEY (discharge_day) REFERENCES date_compact(date_number), '+
+                       'UNIQUE(patient_id, doctor_id, hospital_id, insurance_provider_id, adm_type_id, medication_id, '+
+                       'test_results_id, admission_day, discharge_day, billing_cents));')
+    connection.execute('CREATE VIEW date AS SELECT date_id, date_year, date_quarter, date_month, date_day, '+
+                       'date_month_name, date_quarter_in_year, date_day_of_week FROM date_compact;')
+    connection.execute('CREATE VIEW hospital_stay AS SELECT stay_id, patient_id, doctor_id, hospital_id, '+
+                       'insurance_provider_id, adm_type_id, medication_id, test_results_id, '+
+                       'date(admission_day*86400, \'unixepoch\') AS admission_date, '+
+                       'date(discharge_day*86400, \'unixepoch\') AS discharge_date, '+
+                       'billing_cents/100.0 AS billing_amt '+
+                       'FROM hospital_stay_compact;')
+
+# Function to check whether a database has the compact layout
+def is_compact(connection):
+    return connection.execute('SELECT name FROM sqlite_master WHERE name = "hospital_stay_compact";').fetchone() is not None
+
+# Function to turn a column of 'YYYY-MM-DD' dates into the compact layout's day numbers (days since 1970-01-01)
+def get_day_numbers(dates):
+    return pd.to_datetime(dates, format='%Y-%m-%d').to_numpy().astype('datetime64[D]').astype('int64')
+
+# Function to create the billing summary tables and their views if they do not exist yet
+# Each summary table has one row per combination of its grouping columns (by admission date) with the number of stays and
+# their billing total in cents, which adds up exactly however many times new stays are added to it; the views show the total
+# in dollars, like billing_amt, along with the insurance provider names; a group whose stays have all been taken away is
+# deleted
+# billing_summary_state holds the last stay ID and the number of stays included in the summary tables
+def create_summary_tables(connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS billing_insurance_month_summary (insurance_provider_id INT NOT NULL, '+
+                       'date_year INT NOT NULL, '+
+                       'date_month INT NOT NULL, '+
+                       'date_month_name CHARACTER(9) NOT NULL, '+
+                       'date_quarter INT NOT NULL, '+
+                       'date_quarter_in_year CHARACTER(7) NOT NULL, '+
+                       'stay_count INT NOT NULL, '+
+                       'billing_cents INT NOT NULL, '+
+                       'PRIMARY KEY (insurance_provider_id, date_year, date_month)) WITHOUT ROWID;')
+    connection.execute('CREATE TABLE IF NOT EXISTS billing_hospital_quarter_summary (hospital_name TEXT NOT NULL, '+
+                       'date_year INT NOT NULL, '+
+                       'date_quarter INT NOT NULL, '+
+                       'date_quarter_in_year CHARACTER(7) NOT NULL, '+
+                       'stay_count INT NOT NULL, '+
+                       'billing_cents INT NOT NULL, '+
+                       'PRIMARY KEY (hospital_name, date_year, date_quarter)) WITHOUT ROWID;')
+    connection.execute('CREATE TABLE IF NOT EXISTS billing_condition_year_summary (patient_medical_condition TEXT NOT NULL, '+
+                       'date_year INT NOT NULL, '+
+                       'stay_count INT NOT NULL, '+
+                       'billing_cents INT NOT NULL, '+
+                       'PRIMARY KEY (patient_medical_condition, date_year)) WITHOUT ROWID;')
+    connection.execute('CREATE TABLE IF NOT EXISTS billing_summary_state (last_stay_id INT NOT NULL, '+
+                       'stay_count INT NOT NULL);')
+    
+    connection.execute('CREATE VIEW IF NOT EXISTS billing_by_insurance_month AS '+
+                       'SELECT s.insurance_provider_id, i.insurance_provider_name, s.date_year, s.date_quarter, '+
+                       's.date_quarter_in_year, s.date_month, s.date_month_name, s.stay_count, '+
+                       's.billing_cents/100.0 AS total_billing_amt '+
+                       'FROM billing_insurance_month_summary s '+
+                       'JOIN insurance i ON i.insurance_provider_id = s.insurance_provider_id;')
+    connection.execute('CREATE VIEW IF NOT EXISTS billing_by_hospital_quarter AS '+
+                       'SELECT hospital_name, date_year, date_quarter, date_quarter_in_year, stay_count, '+
+                       'billing_cents/100.0 AS total_billing_amt '+
+                       'FROM billing_hospital_quarter_summary;')
+    connection.execute('CREATE VIEW IF NOT EXISTS billing_by_condition_year AS '+
+                       'SELECT patient_medical_condition, date_year, stay_count, '+
+                       'billing_cents/100.0 AS total_billing_amt '+
+                       'FROM billing_condition_year_summary;')
+    for summary_table, key_columns, source_tables, summary_statement in SUMMARY_STATEMENTS:
+        connection.execute('CREATE TRIGGER IF NOT EXISTS '+summary_table+'_empty AFTER UPDATE OF stay_count ON '+
+                           summary_table+' WHEN new.stay_count = 0 BEGIN DELETE FROM '+summary_table+' WHERE '+
+                           ' AND '.join([key_column+' = new.'+key_column for key_column in key_columns])+'; END;')
+
+# Function to create the name search tables (see NAME_SEARCH_TABLES) and the triggers that keep them up to date, if they do
+# not exist yet, and fill any new one with all the names already in its dimension table, returning the number of names
+# indexed
+# The build calls this once all the names have been loaded, since indexing them all at once is faster than one at a time as
+# they are inserted; an ingest calls it first, so a database built before the name search tables were added gets them
+# If this version of SQLite cannot build FTS5 trigram indexes, a warning is shown and name searches scan the dimension tables
+def create_name_search_tables(connection):
+    name_count = 0
+    for name_search_table, table, id_column, name_column in NAME_SEARCH_TABLES:
+        if connection.execute('SELECT name FROM sqlite_master WHERE name = ?;', (name_search_table,)).fetchone() is not None:
+            continue
+        try:
+            connection.execute('CREATE VIRTUAL TABLE '+name_search_table+' USING fts5('+name_column+', content='+table+', '+
+                               'content_rowid='+id_column+', tokenize=\'trigram\', columnsize=0);')
+        except sqlite3.OperationalError as error:
+            warnings.warn('The name search tables could not be created ('+str(error)+'), so name searches will be slower.')
+            return name_count
+        connection.execute('CREATE TRIGGER '+name_search_table+'_insert AFTER INSERT ON '+table+' BEGIN '+
+                           'INSERT INTO '+name_search_table+' (rowid, '+name_column+') '+
+                           'VALUES (new.'+id_column+', new.'+name_column+'); END;')
+        connection.execute('CREATE TRIGGER '+name_search_table+'_delete AFTER DELETE ON '+table+' BEGIN '+
+                           'INSERT INTO '+name_search_table+' ('+name_search_table+', rowid, '+name_column+') '+
+                           'VALUES (\'delete\', old.'+id_column+', old.'+name_column+'); END;')
+        connection.execute('CREATE TRIGGER '+name_search_table+'_update AFTER UPDATE OF '+id_column+', '+name_column+' ON '+
+                           table+' BEGIN '+
+                           'INSERT INTO '+name_search_table+' ('+name_search_table+', rowid, '+name_column+') '+
+                           'VALUES (\'delete\', old.'+id_column+', old.'+name_column+'); '+
+                           'INSERT INTO '+name_search_table+' (rowid, '+name_column+') '+
+                           'VALUES (new.'+id_column+', new.'+name_column+'); END;')
+        connection.execute('INSERT INTO '+name_search_table+' ('+name_search_table+') VALUES (\'rebuild\');')
+        name_count += connection.execute('SELECT COUNT(*) FROM '+table+';').fetchone()[0]
+    connection.commit()
+    return name_count
+
+# Function to add the hospital stays loaded since the billing summary tables were last refreshed to them, updating the rows
+# of the groups those stays fall in (or adding new ones) rather than recomputing the tables, and return the number of stays
+# added
+def refresh_summary_tables(connection):
+    summary_state = connection.execute('SELECT last_stay_id, stay_count FROM billing_summary_state;').fetchone()
+    if summary_state is None:
+        summary_state = (0, 0)
+    new_stays = connection.execute('SELECT MAX(stay_id), COUNT(*) FROM hospital_stay WHERE stay_id > ?;',
+                                   (summary_state[0],)).fetchone()
+    if new_stays[1] == 0:
+        return 0
+    for summary_table, key_columns, source_tables, summary_statement in SUMMARY_STATEMENTS:
+        connection.execute(summary_statement.format(sign='', condition='hs.stay_id > ?'), (summary_state[0],))
+    connection.execute('DELETE FROM billing_summary_state;')
+    connection.execute('INSERT INTO billing_summary_state VALUES (?, ?);', (new_stays[0], summary_state[1]+new_stays[1]))
+    return new_stays[1]
+
+# Function to empty the billing summary tables, so that the next refresh adds every hospital stay to them
+def clear_summary_tables(connection):
+    for summary_table in SUMMARY_TABLES:
+        connection.execute('DELETE FROM '+summary_table+';')
+
+# Function to get the names of the triggers that keep the billing summary tables up to date (see SUMMARY_TRIGGERS) in either
+# layout
+def get_summary_trigger_names():
+    return [table+'_billing_summary_'+summary_trigger[0] for source_table in SUMMARY_SOURCE_TABLES
+            for table in dict.fromkeys(source_table[:2]) for summary_trigger in SUMMARY_TRIGGERS]
+
+# Function to create the triggers that keep the billing summary tables up to date with every change made to the hospital
+# stays, patients, hospitals, and dates once they have been loaded (e.g. from the query workbench)
+def create_summary_triggers(connection):
+    compact = is_compact(connection)
+    for table, compact_table, stay_column, column, summary_columns in SUMMARY_SOURCE_TABLES:
+        trigger_table = compact_table if compact else table
+        if compact and table == 'hospital_stay':
+            summary_columns = [COMPACT_COLUMNS.get(summary_column, summary_column) for summary_column in summary_columns]
+        summary_statements = [summary_statement for summary_table, key_columns, source_tables, summary_statement
+                              in SUMMARY_STATEMENTS if table in ['hospital_stay', 'date']+source_tables]
+        for trigger_name, trigger_time, row, sign, state_change in SUMMARY_TRIGGERS:
+            trigger_statements = [summary_statement.format(sign=sign, condition='hs.'+stay_column+' = '+row+'.'+column)
+                                  for summary_statement in summary_statements]
+            if table == 'hospital_stay' and state_change is not None:
+                trigger_statements.append('UPDATE billing_summary_state SET '+state_change+';')
+            connection.execute('CREATE TRIGGER '+trigger_table+'_billing_summary_'+trigger_name+' '+
+                               trigger_time.format(columns=', '.join(summary_columns))+' ON '+trigger_table+' BEGIN '+
+                               ' '.join(trigger_statements)+' END;')
+
+# Function to drop the triggers that keep the billing summary tables up to date, returning whether there were any
+def drop_summary_triggers(connection):
+    summary_trigger_names = get_summary_trigger_names()
+    trigger_count = connection.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = "trigger" AND name IN ('+
+                                       ', '.join(['?']*len(summary_trigger_names))+');',
+                                       summary_trigger_names).fetchone()[0]
+    for summary_trigger_name in summary_trigger_names:
+        connection.execute('DROP TRIGGER IF EXISTS '+summary_trigger_name+';')
+    return trigger_count > 0
+
+# Function to make the rows of the date dimension table for every date from first_date to last_date (inclusive) at once,
+# returning a DataFrame with the date table's columns (and the compact layout's day numbers as date_number)
+def make_calendar(first_date, last_date):
+    dates = np.arange(np.datetime64(first_date, 'D'), np.datetime64(last_date, 'D')+1)
+    # NumPy dates count days since 1970-01-01 (a Thursday), and can be cut down to the year or month they are in
+    date_years = dates.astype('datetime64[Y]').astype(int)+1970
+    date_months = dates.astype('datetime64[M]').astype(int) % 12+1
+    date_quarters = (date_months-1)//3+1
+    return pd.DataFrame({'date_number': dates.astype('int64'),
+                         'date_id': np.datetime_as_string(dates, unit='D'),
+                         'date_year': date_years,
+                         'date_quarter': date_quarters,
+                         'date_month': date_months,
+                         'date_day': (dates-dates.astype('datetime64[M]')).astype(int)+1,
+                         'date_month_name': np.array(MONTH_NAMES)[date_months-1],
+                         'date_quarter_in_year': np.char.add(np.char.add('Q', date_quarters.astype(str)),
+                                                             np.char.add(' ', date_years.astype(str))),
+                         'date_day_of_week': np.array(DAY_OF_WEEK_NAMES)[(dates.astype('int64')+3) % 7]})
+
+# Function to make sure the date table has every date from the earliest patient date of birth to DATE_RANGE_MARGIN_DAYS
+# after the latest discharge date in the given hospital stay data, returning the number of dates added
+# The date table always holds one unbroken range of dates, so only the dates before or after that range are added, and most
+# loads do not need to add any; a database whose date table has gaps (i.e., one built before the whole calendar was loaded)
+# has them filled in the first time this runs on it
+# The range ends DATE_RANGE_MARGIN_DAYS after the latest discharge date of every stay loaded so far, whichever chunk (or
+# ingest) it came in, so the date table is the same whatever the chunk size is
+def load_dates(connection, stay_data):
+    date_table = 'date_compact' if is_compact(connection) else 'date'
+    first_date = min(stay_data[column].min() for column in DATE_COLUMNS)
+    last_date = str(np.datetime64(max(stay_data[column].max() for column in DATE_COLUMNS), 'D')+DATE_RANGE_MARGIN_DAYS)
+    first_loaded_date, last_loaded_date, loaded_date_count = connection.execute('SELECT MIN(date_id), MAX(date_id), '+
+                                                                                'COUNT(*) FROM '+date_table+';').fetchone()
+    gap_free = False
+    if loaded_date_count > 0:
+        gap_free = loaded_date_count == (np.datetime64(last_loaded_date)-np.datetime64(first_loaded_date)).astype(int)+1
+        if first_date >= first_loaded_date and last_date <= last_loaded_date and gap_free:
+            return 0
+        first_date = min(first_date, first_loaded_date)
+        last_date = max(last_date, last_loaded_date)
     
-    # Find the patient id matching with the patient from this row
-    cursor.execute('SELECT patient_id FROM patient WHERE patient_name = "'+stay_data.loc[df_row, 'Name']+'" AND '+
-                   'patient_birth_date = "'+stay_data.loc[df_row, 'Date of Birth']+'" AND '+
-                   'patient_gender = "'+stay_data.loc[df_row, 'Gender']+'" AND '+
-                   'patient_blood_type = "'+stay_data.loc[df_row, 'Blood Type']+'" AND '+
-                   'patient_medical_condition = "'+stay_data.loc[df_row, 'Medical Condition']+'";')
-    patient_id = cursor.fetchall()
+    calendar = make_calendar(first_date, last_date)
+    # Only the dates outside an unbroken range already in the table need to be added
+    if gap_free:
+        calendar = calendar[(calendar['date_id'] < first_loaded_date) | (calendar['date_id'] > last_loaded_date)]
+    if date_table == 'date':
+        calendar = calendar.drop('date_number', axis=1)
+    changes_before_load = connection.total_changes
+    connection.executemany('INSERT OR IGNORE INTO '+date_table+' VALUES ('+', '.join(['?']*calendar.shape[1])+');',
+                           zip(*[calendar[column].tolist() for column in calendar.columns]))
+    return connection.total_changes - changes_before_load
+
+# Function to get the natural key of every row in the given DataFrame columns (a MultiIndex if there are multiple columns)
+def get_natural_keys(stay_data, stay_data_columns):
+    if len(stay_data_columns) > 1:
+        return pd.MultiIndex.from_frame(stay_data[stay_data_columns])
+    return pd.Index(stay_data[stay_data_columns[0]])
+
+# Function to find which rows of the given DataFrame columns are already in a table, returning a Series that maps each of
+# their natural keys to its existing ID
+# The rows are put into a temporary table and joined to the table's UNIQUE index, so the work done depends on the number of
+# rows given rather than on the size of the table
+def find_existing_ids(connection, table, id_column, key_columns, key_rows, key_row_columns):
+    connection.execute('CREATE TEMP TABLE new_keys ('+', '.join(key_columns)+');')
+    connection.executemany('INSERT INTO new_keys VALUES ('+', '.join(['?']*len(key_columns))+');',
+                           zip(*[key_rows[column].tolist() for column in key_row_columns]))
+    existing_rows = pd.read_sql_query('SELECT '+', '.join(['t.'+column for column in [id_column]+key_columns])+' FROM '+
+                                      'new_keys n INNER JOIN '+table+' t ON '+
+                                      ' AND '.join(['t.'+column+' = n.'+column for column in key_columns])+';', connection)
+    connection.execute('DROP TABLE new_keys;')
+    existing_rows.columns = [id_column]+key_row_columns
+    return pd.Series(existing_rows[id_column].to_numpy(), index=get_natural_keys(existing_rows, key_row_columns))
+
+# Function to load each unique combination of values in the given DataFrame columns into a dimension table if it is not
+# already there, giving each new one the next ID number (in the order in which they first appear)
+# Returns a Series that maps each unique combination (the natural key) to its ID so the fact table can find its foreign key
+# IDs without querying the dimension table, along with the number of rows added
+def load_dimension(connection, table, id_column, key_columns, stay_data, stay_data_columns):
+    dimension_rows = stay_data[stay_data_columns].drop_duplicates()
+    last_id = connection.execute('SELECT MAX('+id_column+') FROM '+table+';').fetchone()[0]
     
-    # Find the doctor id matching with the doctor from this row
-    cursor.execute('SELECT doctor_id FROM doctor WHERE doctor_name = "'+stay_data.loc[df_row, 'Doctor']+'";')
-    doctor_id = cursor.fetchall()
+    # If the table already has data, reuse the IDs of the rows that are already in it and only add the new ones
+    if last_id is None:
+        last_id = 0
+        existing_ids = None
+    else:
+        existing_ids = find_existing_ids(connection, table, id_column, key_columns, dimension_rows, stay_data_columns)
+        dimension_rows = dimension_rows[existing_ids.index.get_indexer(get_natural_keys(dimension_rows,
+                                                                                        stay_data_columns)) == -1]
     
-    # Find the hospital id matching with the hospital from this row
-    cursor.execute('SELECT hospital_id FROM hospital WHERE hospital_name = "'+stay_data.loc[df_row, 'Hospital']+'" AND '+
-                   'hospital_room = '+str(stay_data.loc[df_row, 'Room Number'])+';')
-    hospital_id = cursor.fetchall()
+    id_list = list(range(last_id+1, last_id+dimension_rows.shape[0]+1))
+    connection.executemany('INSERT INTO '+table+' VALUES ('+', '.join(['?']*(len(stay_data_columns)+1))+');',
+                           zip(id_list, *[dimension_rows[column].tolist() for column in stay_data_columns]))
+    dimension_ids = pd.Series(id_list, index=get_natural_keys(dimension_rows, stay_data_columns), dtype='int64')
+    if existing_ids is not None:
+        dimension_ids = pd.concat([existing_ids, dimension_ids])
+    return dimension_ids, dimension_rows.shape[0]
+
+# Function to find the dimension ID of every row in the given DataFrame columns at once, using the natural key to ID map
+# returned by load_dimension
+def find_dimension_ids(stay_data, stay_data_columns, dimension_ids):
+    id_positions = dimension_ids.index.get_indexer(get_natural_keys(stay_data, stay_data_columns))
+    if (id_positions == -1).any():
+        raise KeyError('Some rows of '+', '.join(stay_data_columns)+' are missing from the dimension table.')
+    return dimension_ids.to_numpy()[id_positions]
+
+# Function to load each hospital stay that is not already in the hospital stay fact table into it, giving each new stay the
+# next stay ID, and return the number of stays added
+# In the compact layout, the stays are loaded into hospital_stay_compact with day numbers and cents instead
+def load_hospital_stays(connection, stay_data, dimension_ids):
+    # Find the foreign key IDs for all hospital stays at once using the natural key to ID maps from the dimension loads
+    fact_data = pd.DataFrame({id_column: find_dimension_ids(stay_data, stay_data_columns, dimension_ids[table])
+                              for table, id_column, key_columns, stay_data_columns in DIMENSION_TABLES})
+    if is_compact(connection):
+        fact_table, fact_key_columns = 'hospital_stay_compact', COMPACT_FACT_KEY_COLUMNS
+        fact_data['admission_day'] = get_day_numbers(stay_data['Date of Admission'])
+        fact_data['discharge_day'] = get_day_numbers(stay_data['Discharge Date'])
+        fact_data['billing_cents'] = (stay_data['Billing Amount'].round(2)*100).round().astype('int64').to_numpy()
+    else:
+        fact_table, fact_key_columns = 'hospital_stay', FACT_KEY_COLUMNS
+        fact_data['admission_date'] = stay_data['Date of Admission'].to_numpy()
+        fact_data['discharge_date'] = stay_data['Discharge Date'].to_numpy()
+        fact_data['billing_amt'] = stay_data['Billing Amount'].round(2).to_numpy()
+    fact_data = fact_data.drop_duplicates()
     
-    # Find the insurance provider id matching with the insurance provider from this row
-    cursor.execute('SELECT insurance_provider_id FROM insurance WHERE insurance_provider_name = "'+
-                   stay_data.loc[df_row, 'Insurance Provider']+'";')
-    insurance_provider_id = cursor.fetchall()
+    # If the table already has data, skip the stays that are already in it
+    last_stay_id = connection.execute('SELECT MAX(stay_id) FROM '+fact_table+';').fetchone()[0]
+    if last_stay_id is None:
+        last_stay_id = 0
+    else:
+        existing_stay_ids = find_existing_ids(connection, fact_table, 'stay_id', fact_key_columns, fact_data,
+                                              fact_key_columns)
+        fact_data = fact_data[existing_stay_ids.index.get_indexer(get_natural_keys(fact_data, fact_key_columns)) == -1]
+    fact_data.insert(loc=0, column='stay_id', value=range(last_stay_id+1, last_stay_id+fact_data.shape[0]+1))
     
-    # Find the admission type id matching with the admission type from this row
-    cursor.execute('SELECT adm_type_id FROM admission_type WHERE adm_type = "'+stay_data.loc[df_row, 'Admission Type']+'";')
-    adm_type_id = cursor.fetchall()
+    # Load the hospital stay data into the database in batches
+    for batch_start in range(0, fact_data.shape[0], FACT_BATCH_SIZE):
+        fact_batch = fact_data.iloc[batch_start:batch_start+FACT_BATCH_SIZE]
+        connection.executemany('INSERT INTO '+fact_table+' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                               zip(*[fact_batch[column].tolist() for column in fact_data.columns]))
+    return fact_data.shape[0]
+
+# Function to create the secondary indexes and gather the table and index statistics SQLite uses to plan queries
+# In the compact layout, the hospital stay indexes are created on hospital_stay_compact's matching columns
+def create_indexes(connection):
+    compact = is_compact(connection)
+    for index_name, table, index_columns in INDEXES:
+        if compact and table == 'hospital_stay':
+            table, index_columns = 'hospital_stay_compact', [COMPACT_COLUMNS.get(column, column) for column in index_columns]
+        connection.execute('CREATE INDEX IF NOT EXISTS '+index_name+' ON '+table+' ('+', '.join(index_columns)+');')
+    connection.execute('ANALYZE;')
+    connection.commit()
+
+# Function to load chunks of cleaned hospital stay data into the database one at a time within one transaction, adding only
+# the dates, dimension rows, and hospital stays that are not already there, and then add the new stays to the billing summary
+# tables
+# Adding all the new stays to the summaries at once is much faster than one at a time, so the triggers that keep them up to
+# date with each change are dropped during the load and created again after it; the summaries of a database without them
+# (built before they were added) may not have followed every change, so they are made again from all its stays
+# Returns the number of rows added to each table and the total number of hospital stays read
+def load_stay_data(connection, stay_data_chunks):
+    load_counts = dict.fromkeys(['date']+[dimension[0] for dimension in DIMENSION_TABLES]+['hospital_stay'], 0)
+    stay_count = 0
+    if not drop_summary_triggers(connection):
+        clear_summary_tables(connection)
+    for stay_data in stay_data_chunks:
+        with timed_phase('load dates') as phase_rows:
+            phase_rows['rows'] = load_dates(connection, stay_data)
+            load_counts['date'] += phase_rows['rows']
+        # The natural key to ID maps only cover the current chunk, so they stay small however big the CSV is
+        dimension_ids = {}
+        with timed_phase('load dimensions') as phase_rows:
+            for table, id_column, key_columns, stay_data_columns in DIMENSION_TABLES:
+                dimension_ids[table], dimension_count = load_dimension(connection, table, id_column, key_columns, stay_data,
+                                                                       stay_data_columns)
+                load_counts[table] += dimension_count
+                phase_rows['rows'] += dimension_count
+        with timed_phase('load hospital stays') as phase_rows:
+            phase_rows['rows'] = load_hospital_stays(connection, stay_data, dimension_ids)
+            load_counts['hospital_stay'] += phase_rows['rows']
+        stay_count += stay_data.shape[0]
+    with timed_phase('refresh summaries') as phase_rows:
+        phase_rows['rows'] = refresh_summary_tables(connection)
+        create_summary_triggers(connection)
+    with timed_phase('commit'):
+        connection.commit()
+    return load_counts, stay_count
+
+
+
+
+# Part 3: Build the database or add new hospital stays to it
+
+# Function to clean the partially cleaned hospital stay data, save it to a CSV and the cleaned data cache, and build the
+# database from scratch with it, one chunk at a time
+# If the cleaned data cache was made from the same stay data (and use_cache is True), the cleaned data is read from it instead
+# of reading and cleaning the CSV again; the fully cleaned CSV is then only written if it is missing
+# The database is built in a temporary file, which then replaces the database file in one step, so anyone querying the
+# database while it is being rebuilt sees either the old database or the new one and never has to wait for the build
+# With compact set to True, the database is built in the compact layout (see COMPACT_TABLES)
+def build_database(database_file=DATABASE_FILE, chunk_size=CHUNK_SIZE, stay_data_file=STAY_DATA_FILE,
+                   cleaned_stay_data_file=CLEANED_STAY_DATA_FILE, cleaned_stay_data_cache_file=CLEANED_STAY_DATA_CACHE_FILE,
+                   use_cache=True, compact=False):
+    phase_stats.clear()
+    build_start_time = time.perf_counter()
+    # Start from an empty temporary file, removing any left over from an interrupted build
+    build_database_file = database_file+'.building'
+    if os.path.exists(build_database_file):
+        os.remove(build_database_file)
+    connection = instrumentation.connect(build_database_file)
+    for build_pragma in BUILD_PRAGMAS:
+        connection.execute(build_pragma)
+    
+    with timed_phase('create tables'):
+        create_tables(connection, compact)
     
-    # Find the medication id matching with the medication from this row
-    cursor.execute('SELECT medication_id FROM medication WHERE medication_name = "'+stay_data.loc[df_row, 'Medication']+'";')
-    medication_id = cursor.fetchall()
+    with timed_phase('hash csv'):
+        stay_data_hash = get_stay_data_hash(stay_data_file)
+    cache_metadata = read_stay_data_cache_metadata(cleaned_stay_data_cache_file) if use_cache else None
+    used_cache = (stay_data_hash is not None and cache_metadata is not None and
+                  cache_metadata['stay_data_hash'] == stay_data_hash)
+    if used_cache:
+        stay_data_chunks = read_stay_data_cache(cleaned_stay_data_cache_file, csv_types=True)
+        if not os.path.exists(cleaned_stay_data_file):
+            stay_data_chunks = save_stay_data(stay_data_chunks, cleaned_stay_data_file)
+    else:
+        # Once each chunk of data has been fully cleaned, save it to a CSV so other data analysts can use it for various
+        # purposes, and to the cleaned data cache for loading it quickly
+        stay_data_chunks = save_stay_data_cache(save_stay_data(read_stay_data(stay_data_file, chunk_size),
+                                                               cleaned_stay_data_file),
+                                                cleaned_stay_data_cache_file, stay_data_hash)
+    load_counts = load_stay_data(connection, stay_data_chunks)[0]
     
-    # Find the test results id matching with the test results from this row
-    cursor.execute('SELECT test_results_id FROM test_results WHERE test_results = "'+stay_data.loc[df_row, 'Test Results']+
-                   '";')
-    test_results_id = cursor.fetchall()
+    with timed_phase('create name search tables') as phase_rows:
+        phase_rows['rows'] = create_name_search_tables(connection)
+    with timed_phase('create indexes'):
+        create_indexes(connection)
+    # Switch the finished database to write-ahead logging (see WAL_PRAGMAS), which is saved in the database file
+    for wal_pragma in WAL_PRAGMAS:
+        connection.execute(wal_pragma)
+    log_phase_stats(connection, 'build')
+    connection.close()
     
-    # Insert all the values from the current DataFrame row into the hospital_stay fact table
-    connection.execute('INSERT INTO hospital_stay VALUES ('+
-                       str(stay_data.loc[df_row, 'Index'])+', '+ # stay_id
-                       str(patient_id[0][0])+', '+
-                       str(doctor_id[0][0])+', '+
-                       str(hospital_id[0][0])+', '+
-                       str(insurance_provider_id[0][0])+', '+
-                       str(adm_type_id[0][0])+', '+
-                       str(medication_id[0][0])+', '+
-                       str(test_results_id[0][0])+', '+
-                       '"'+stay_data.loc[df_row, 'Date of Admission']+'", '+
-                       '"'+stay_data.loc[df_row, 'Discharge Date']+'", '+
-                       str(round(stay_data.loc[df_row, 'Billing Amount'], 2))+');')
+    # Replace the database file with the newly built one
+    try:
+        with timed_phase('replace database file'):
+            replace_database_file(build_database_file, database_file)
+    except PermissionError:
+        raise PermissionError('The database could not be replaced because it is open in another program. Please close '+
+                              'it and rename '+build_database_file+' to '+database_file+', or run this code again.')
+    instrumentation.log_event('phase', step='build', phase='replace database file', **phase_stats['replace database file'])
+    instrumentation.log_event('build', database_file=database_file, stay_data_file=stay_data_file, chunk_size=chunk_size,
+                              used_cache=used_cache, compact=compact, seconds=time.perf_counter()-build_start_time,
+                              rows_loaded=load_counts)
+    return load_counts
+
+# Function to replace the database file with a newly built one
+# A database in WAL mode keeps its most recent changes in a separate file named after it (hospital_stay_database.db-wal) and
+# shares its readers' locks through another (hospital_stay_database.db-shm), so a new file moved into its place would be read
+# together with the old database's leftovers. Instead, an existing WAL database is overwritten page by page with SQLite's
+# backup, which readers see as one more write: queries that have already started finish on the old data, and the next ones
+# see the new data. Otherwise (or if the page sizes differ, which backup cannot change in WAL mode), the old database's WAL
+# and shared memory files are removed and the new file replaces the database file.
+def replace_database_file(build_database_file, database_file):
+    if os.path.exists(database_file):
+        live_connection = sqlite3.connect(database_file)
+        build_connection = sqlite3.connect(build_database_file)
+        try:
+            (journal_mode,) = live_connection.execute('PRAGMA journal_mode;').fetchone()
+            backed_up = (journal_mode == 'wal' and live_connection.execute('PRAGMA page_size;').fetchone() ==
+                         build_connection.execute('PRAGMA page_size;').fetchone())
+            if backed_up:
+                build_connection.backup(live_connection)
+            # Copy the new pages from the WAL file into the database file and empty the WAL file, if no reader is still
+            # using the old pages (otherwise this happens on a later write or once the last connection closes)
+            if journal_mode == 'wal':
+                live_connection.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        finally:
+            build_connection.close()
+            live_connection.close()
+        if backed_up:
+            os.remove(build_database_file)
+            return
+    # Remove the WAL and shared memory files of the old database (including ones left behind by a database that was deleted,
+    # or still there because a reader has the old database open), so the new one does not read them
+    for wal_file in [database_file+'-wal', database_file+'-shm']:
+        if os.path.exists(wal_file):
+            os.remove(wal_file)
+    os.replace(build_database_file, database_file)
+
+# Function to time a query on a database, returning the fastest of LAYOUT_TIMING_RUNS runs in seconds
+def time_layout_query(connection, query):
+    run_times = []
+    for run in range(LAYOUT_TIMING_RUNS):
+        start_time = time.perf_counter()
+        connection.execute(query).fetchall()
+        run_times.append(time.perf_counter()-start_time)
+    return min(run_times)
 
-connection.commit()
+# Function to build the database in both the usual and the compact layout in a temporary folder next to the database file
+# (which is left alone) and compare them, returning a dictionary with each layout's file size in bytes and the time each
+# query in LAYOUT_SCAN_QUERIES took on it in seconds; on the compact layout, each query is timed both as written for the
+# usual layout (through the views) and as written for the compact tables
+# The second build reads the cleaned data from the cleaned data cache the first build saved, so the data is only cleaned once
+def compare_layouts(database_file=DATABASE_FILE, chunk_size=CHUNK_SIZE, stay_data_file=STAY_DATA_FILE,
+                    cleaned_stay_data_file=CLEANED_STAY_DATA_FILE,
+                    cleaned_stay_data_cache_file=CLEANED_STAY_DATA_CACHE_FILE):
+    layout_folder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(database_file)))
+    layout_comparison = {}
+    try:
+        for layout in ['usual', 'compact']:
+            layout_database_file = os.path.join(layout_folder, layout+'_'+os.path.basename(database_file))
+            build_database(layout_database_file, chunk_size, stay_data_file, cleaned_stay_data_file,
+                           cleaned_stay_data_cache_file, compact=layout == 'compact')
+            connection = sqlite3.connect(layout_database_file)
+            layout_comparison[layout] = {'bytes': os.path.getsize(layout_database_file),
+                                         'query_seconds': {query_name: time_layout_query(connection, query)
+                                                           for query_name, query, compact_query in LAYOUT_SCAN_QUERIES}}
+            if layout == 'compact':
+                layout_comparison[layout]['compact_query_seconds'] = {
+                    query_name: time_layout_query(connection, compact_query)
+                    for query_name, query, compact_query in LAYOUT_SCAN_QUERIES}
+            connection.close()
+    finally:
+        shutil.rmtree(layout_folder)
+    return layout_comparison
 
+# Function to clean a CSV of partially cleaned hospital stay data and save it to a CSV of fully cleaned data, returning the
+# number of stays cleaned
+def clean_stay_data_file(csv_path, cleaned_csv_path, chunk_size=CHUNK_SIZE):
+    stay_count = 0
+    for stay_data in save_stay_data(read_stay_data(csv_path, chunk_size), cleaned_csv_path):
+        stay_count += stay_data.shape[0]
+    return stay_count
 
+# Function to add the hospital stays from a CSV of new, fully cleaned stays to the already built database, returning the
+# number of rows added to each table and the number of stays skipped because they were already in the database
+def ingest_stays(connection, csv_path, chunk_size=CHUNK_SIZE):
+    phase_stats.clear()
+    ingest_start_time = time.perf_counter()
+    if connection.execute('SELECT name FROM sqlite_master WHERE name = "hospital_stay";').fetchone() is None:
+        raise sqlite3.OperationalError('The database has not been built yet. Please run this code without --ingest first.')
+    # Partially cleaned stays would get different random names and dates of birth each time they are cleaned, so they could
+    # not be told apart from the stays already in the database
+    if 'Date of Birth' not in pd.read_csv(csv_path, nrows=0).columns:
+        raise ValueError(csv_path+' is not fully cleaned (it has no Date of Birth column). Please clean it first with '+
+                         'python create_db.py --clean '+csv_path+' CLEANED_CSV_FILE and ingest the cleaned CSV.')
+    # A database built before the billing summary tables or the name search tables were added gets them here, filled with
+    # all of its stays and names
+    create_summary_tables(connection)
+    create_name_search_tables(connection)
+    load_counts, stay_count = load_stay_data(connection, read_stay_data(csv_path, chunk_size))
+    log_phase_stats(connection, 'ingest')
+    instrumentation.log_event('ingest', csv_file=csv_path, chunk_size=chunk_size,
+                              seconds=time.perf_counter()-ingest_start_time, rows_loaded=load_counts,
+                              stays_skipped=stay_count - load_counts['hospital_stay'])
+    return load_counts, stay_count - load_counts['hospital_stay']
 
-# Part 3: End any remaining active processes
 
-# Close the cursor and the connection
-cursor.close()
-connection.close()
\ No newline at end of file
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Build the hospital stay database, or add new hospital stays to it.')
+    argument_parser.add_argument('--ingest', metavar='CSV_FILE', help='add the hospital stays in this CSV to the already '+
+                                 'built database instead of rebuilding it')
+    argument_parser.add_argument('--clean', nargs=2, metavar=('CSV_FILE', 'CLEANED_CSV_FILE'), help='clean a CSV of '+
+                                 'partially cleaned hospital stays and save them to a fully cleaned CSV, which can then be '+
+                                 'ingested, instead of rebuilding the database')
+    argument_parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='number of hospital stays to read, '+
+                                 'clean, and load at a time (default: %(default)s)')
+    argument_parser.add_argument('--compact', action='store_true', help='build the database in the compact layout, with '+
+                                 'day numbers and cents instead of text dates and billing amounts')
+    argument_parser.add_argument('--compare-layouts', action='store_true', help='build the database in both layouts in a '+
+                                 'temporary folder and compare their file sizes and scan times, leaving the database '+
+                                 'alone')
+    argument_parser.add_argument('--no-cache', action='store_true', help='read and clean the stay data CSV even if the '+
+                                 'cleaned data cache was made from the same stay data')
+    argument_parser.add_argument('--log-file', help='log the time and number of rows of each phase and SQL statement to '+
+                                 'this file (default: the '+instrumentation.LOG_FILE_ENVIRONMENT_VARIABLE+
+                                 ' environment variable, or no log)')
+    arguments = argument_parser.parse_args()
+    if arguments.log_file:
+        instrumentation.set_log_file(arguments.log_file)
+    
+    if arguments.ingest:
+        # Create connection to the database hospital_stay_database
+        connection = instrumentation.connect(DATABASE_FILE)
+        load_counts, skipped_stay_count = ingest_stays(connection, arguments.ingest, arguments.chunk_size)
+        print('Inserted '+str(load_counts['hospital_stay'])+' hospital stays and skipped '+str(skipped_stay_count)+
+              ' already in the database')
+        print('New rows per dimension: '+', '.join([table+' '+str(load_counts[table]) for table in load_counts
+                                                     if table != 'hospital_stay']))
+        # End any remaining active processes by closing the connection
+        connection.close()
+    elif arguments.clean:
+        stay_count = clean_stay_data_file(arguments.clean[0], arguments.clean[1], arguments.chunk_size)
+        print('Cleaned '+str(stay_count)+' hospital stays and saved them to '+arguments.clean[1])
+    elif arguments.compare_layouts:
+        layout_comparison = compare_layouts(DATABASE_FILE, arguments.chunk_size)
+        usual_bytes, compact_bytes = layout_comparison['usual']['bytes'], layout_comparison['compact']['bytes']
+        print('Usual layout: '+format(usual_bytes/1000000, '.1f')+' MB; compact layout: '+
+              format(compact_bytes/1000000, '.1f')+' MB ('+format(1-compact_bytes/usual_bytes, '.0%')+' smaller)')
+        for query_name, query, compact_query in LAYOUT_SCAN_QUERIES:
+            print(query_name+': '+format(layout_comparison['usual']['query_seconds'][query_name]*1000, '.1f')+' ms usual, '+
+                  format(layout_comparison['compact']['query_seconds'][query_name]*1000, '.1f')+
+                  ' ms compact through the views, '+
+                  format(layout_comparison['compact']['compact_query_seconds'][query_name]*1000, '.1f')+
+                  ' ms on the compact tables')
+    else:
+        build_database(DATABASE_FILE, arguments.chunk_size, use_cache=not arguments.no_cache, compact=arguments.compact)
\ No newline at end of file
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# Please see Readme for more info
+
+# This code exports the result of a query on the hospital stay database to a CSV file, or to a gzip-compressed CSV file if the
+# file name ends in .gz, without showing it. The rows are fetched and written EXPORT_FETCH_SIZE at a time, so memory use stays
+# flat however big the result is (e.g. the whole hospital stay table joined to all its dimensions). The first line of the
+# file has the names of the result columns. The query workbench (run_queries.py) uses this code for its Export button.
+
+# Example: python export_query.py my_query.sql "billing export.csv.gz"
+# Instead of a file, the query can be given directly with --query, e.g. python export_query.py result.csv --query "SELECT ..."
+
+# The result is written to a temporary file next to the export file (e.g. result.csv.partial), which only replaces the
+# export file once the whole result has been written, so an export that fails or is cancelled never leaves half a file.
+
+# Import packages - sqlite3 for running the database, csv and gzip for writing the (compressed) CSV, os for replacing the
+# export file, urllib for the read-only database address, time for timing the export, and argparse for reading the command
+# line options
+import sqlite3
+import csv
+import gzip
+import os
+import urllib.request
+import time
+import argparse
+
+
+
+# Part 1: Export a query result
+
+# Database file to query
+DATABASE_FILE = 'hospital_stay_database.db'
+
+# Number of result rows fetched from the database and written at a time
+EXPORT_FETCH_SIZE = 10000
+
+# Compression level of gzip-compressed exports (from 1, fastest, to 9, smallest); level 6 makes the file nearly as small as
+# level 9 in a fraction of the time
+GZIP_COMPRESS_LEVEL = 6
+
+# Function to open a read-only connection to the database for exporting, so that an export can never change the database and
+# can run alongside the query workbench's own connection
+def open_export_connection(database_file=DATABASE_FILE):
+    return sqlite3.connect('file:'+urllib.request.pathname2url(os.path.abspath(database_file))+'?mode=ro', uri=True,
+                           check_same_thread=False)
+
+# Function to open an export file for writing text, compressing it if the export file name ends in .gz
+def open_export_file(file_path, export_file_name):
+    if export_file_name.lower().endswith('.gz'):
+        return gzip.open(file_path, 'wt', compresslevel=GZIP_COMPRESS_LEVEL, encoding='utf-8', newline='')
+    return open(file_path, 'w', encoding='utf-8', newline='')
+
+# Function to run a query and write its result to a CSV file (gzip-compressed if the file name ends in .gz), returning the
+# number of rows written
+# If report_progress is given, it is called with the number of rows written so far after each EXPORT_FETCH_SIZE rows
+def export_query(connection, query, export_file, report_progress=None):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query)
+        if cursor.description is None:
+            raise ValueError('The query has no result to export; only queries that return rows (e.g. SELECT) can be '+
+                             'exported.')
+        partial_export_file = export_file+'.partial'
+        row_count = 0
+        try:
+            with open_export_file(partial_export_file, export_file) as output:
+                csv_writer = csv.writer(output)
+                csv_writer.writerow([column[0] for column in cursor.description])
+                rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                while rows:
+                    csv_writer.writerows(rows)
+                    row_count += len(rows)
+                    if report_progress is not None:
+                        report_progress(row_count)
+                    rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            os.replace(partial_export_file, export_file)
+        except BaseException:
+            if os.path.exists(partial_export_file):
+                os.remove(partial_export_file)
+            raise
+    finally:
+        cursor.close()
+    return row_count
+
+
+
+# Part 2: Run the export from the command line
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Export the result of a query on the hospital stay database to '+
+                                              'a CSV file.')
+    argument_parser.add_argument('query_file', nargs='?', help='file containing the query to export the result of')
+    argument_parser.add_argument('export_file', help='CSV file to export the result to (gzip-compressed if its name ends '+
+                                 'in .gz)')
+    argument_parser.add_argument('--query', help='query to export the result of, instead of a query file')
+    argument_parser.add_argument('--database', default=DATABASE_FILE, help='database file (default: %(default)s)')
+    arguments = argument_parser.parse_args()
+
+    if arguments.query is not None:
+        query = arguments.query
+    elif arguments.query_file is not None:
+        with open(arguments.query_file) as query_file:
+            query = query_file.read()
+    else:
+        argument_parser.error('please give a query file or a query with --query')
+
+    connection = open_export_connection(arguments.database)
+    start_time = time.perf_counter()
+    row_count = export_query(connection, query, arguments.export_file)
+    print('Exported '+str(row_count)+' rows to '+arguments.export_file+' in '+
+          format(time.perf_counter()-start_time, '.1f')+' s ('+format(os.path.getsize(arguments.export_file)/1000000, '.1f')+
+          ' MB)')
+    connection.close()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Please see Readme for more info
+
+# This code generates a CSV of made-up hospital stays of any size with the same columns as the partially cleaned stay data
+# (hosp_stay_dataset_dr_names_cleaned.csv), so that create_db.py can be tried out (or benchmarked with benchmark.py) on far
+# more stays than the real dataset has. Each column is drawn on its own from the same kind of values as the real data: by
+# default the values and ranges of the Kaggle dataset, each equally likely, or, with the --like option, how often each value
+# appears in a given stay CSV (and the spread of its billing amounts). The number of doctors grows with the number of stays,
+# as it does in the real data.
+
+# Example: python generate_stay_data.py 1000000 "Data files/stays_1m.csv"
+# To match an existing stay CSV instead of the Kaggle dataset: python generate_stay_data.py 1000000 stays_1m.csv --like
+# "Data files/hosp_stay_dataset_dr_names_cleaned.csv"
+
+# The stays are generated and written CHUNK_SIZE at a time, so memory use stays flat no matter how many are generated, and
+# the same seed always gives the same CSV.
+
+# Import packages - pandas for writing the CSV and reading the CSV to match, NumPy for drawing all the random values at once,
+# argparse for reading the command line options, and create_db for the chunk size, seed, name dataset, and hospital list
+import pandas as pd
+import numpy as np
+import argparse
+from create_db import CHUNK_SIZE, RANDOM_SEED, NAME_DATA_FILE, hospital_list
+
+
+
+# Part 1: Describe the stay data to generate
+
+# Columns of the partially cleaned stay data, in order
+STAY_COLUMNS = ['Name', 'Age', 'Gender', 'Blood Type', 'Medical Condition', 'Date of Admission', 'Doctor', 'Hospital',
+                'Insurance Provider', 'Billing Amount', 'Room Number', 'Admission Type', 'Discharge Date', 'Medication',
+                'Test Results']
+
+# Columns whose values are drawn from a list of possible values (the length of stay is the number of days between the
+# admission and discharge dates)
+CATEGORY_COLUMNS = ['Age', 'Gender', 'Blood Type', 'Medical Condition', 'Date of Admission', 'Length of Stay',
+                    'Insurance Provider', 'Room Number', 'Admission Type', 'Medication', 'Test Results']
+
+# Possible values of each of those columns in the Kaggle dataset, which are all about equally common there
+KAGGLE_CATEGORY_VALUES = {'Age': list(range(13, 90)),
+                          'Gender': ['Male', 'Female'],
+                          'Blood Type': ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-'],
+                          'Medical Condition': ['Arthritis', 'Asthma', 'Cancer', 'Diabetes', 'Hypertension', 'Obesity'],
+                          'Date of Admission': pd.date_range('2019-05-08', '2024-05-07').strftime('%Y-%m-%d').tolist(),
+                          'Length of Stay': list(range(1, 31)),
+                          'Insurance Provider': ['Aetna', 'Blue Cross', 'Cigna', 'Medicare', 'UnitedHealthcare'],
+                          'Room Number': list(range(101, 501)),
+                          'Admission Type': ['Elective', 'Emergency', 'Urgent'],
+                          'Medication': ['Aspirin', 'Ibuprofen', 'Lipitor', 'Paracetamol', 'Penicillin'],
+                          'Test Results': ['Abnormal', 'Inconclusive', 'Normal']}
+
+# Lowest and highest billing amounts in the Kaggle dataset, between which the billing amounts are spread evenly
+KAGGLE_BILLING_AMOUNT_RANGE = (-2008.49, 52764.28)
+
+# Average number of stays per doctor in the Kaggle dataset (about 55,500 stays and 40,300 doctors)
+KAGGLE_STAYS_PER_DOCTOR = 1.38
+
+# Number of points used to describe the spread of billing amounts in a CSV to match
+BILLING_AMOUNT_QUANTILES = 1001
+
+# Function to describe the stay data to generate, returning a dictionary with the possible values of each category column
+# and how likely each one is, the billing amounts below which each of BILLING_AMOUNT_QUANTILES evenly spaced shares of the
+# stays fall, and the average number of stays per doctor
+# With no CSV, the Kaggle dataset's values and ranges are used; with a CSV of stays (with the same columns as the partially
+# cleaned stay data), they are taken from it, reading it a chunk at a time
+def describe_stay_data(csv_path=None, chunk_size=CHUNK_SIZE):
+    if csv_path is None:
+        return {'categories': {column: (np.array(values), np.full(len(values), 1/len(values)))
+                               for column, values in KAGGLE_CATEGORY_VALUES.items()},
+                'billing_amount_quantiles': np.linspace(*KAGGLE_BILLING_AMOUNT_RANGE, BILLING_AMOUNT_QUANTILES),
+                'stays_per_doctor': KAGGLE_STAYS_PER_DOCTOR}
+
+    category_counts = {column: pd.Series(dtype='int64') for column in CATEGORY_COLUMNS}
+    billing_amounts = []
+    doctors = set()
+    for stay_data in pd.read_csv(csv_path, chunksize=chunk_size):
+        stay_data['Length of Stay'] = (pd.to_datetime(stay_data['Discharge Date']) -
+                                       pd.to_datetime(stay_data['Date of Admission'])).dt.days
+        for column in CATEGORY_COLUMNS:
+            category_counts[column] = category_counts[column].add(stay_data[column].value_counts(), fill_value=0)
+        billing_amounts.append(stay_data['Billing Amount'].to_numpy())
+        doctors.update(stay_data['Doctor'])
+    billing_amounts = np.concatenate(billing_amounts)
+    return {'categories': {column: (counts.index.to_numpy(), (counts/counts.sum()).to_numpy())
+                           for column, counts in category_counts.items()},
+            'billing_amount_quantiles': np.quantile(billing_amounts, np.linspace(0, 1, BILLING_AMOUNT_QUANTILES)),
+            'stays_per_doctor': billing_amounts.shape[0]/len(doctors)}
+
+
+
+# Part 2: Generate the stay data
+
+# Function to make up the given number of distinct doctor names from the first and last names in the name dataset, adding a
+# middle initial to a name once every first and last name pair has been used
+def make_doctor_names(doctor_count, name_data, random_generator):
+    first_names = name_data['First Name'].unique()
+    last_names = name_data['Last Name'].unique()
+    name_pair_count = first_names.shape[0]*last_names.shape[0]
+    middle_names = np.array(['']+[' '+letter+'.' for letter in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'])
+    doctor_count = min(doctor_count, name_pair_count*middle_names.shape[0])
+    # Pick distinct numbers, each of which stands for one first name, middle initial, and last name combination (only using
+    # as many middle initials as needed)
+    name_numbers = random_generator.choice(name_pair_count*-(-doctor_count // name_pair_count), size=doctor_count,
+                                           replace=False)
+    return (first_names[name_numbers % first_names.shape[0]].astype(object)+
+            middle_names[name_numbers // name_pair_count].astype(object)+' '+
+            last_names[name_numbers // first_names.shape[0] % last_names.shape[0]].astype(object))
+
+# Function to find how many doctors to draw each stay's doctor from so that the given number of stays ends up with the given
+# average number of stays per doctor that has any
+# Drawing n stays' doctors from d doctors leaves d*(1-exp(-n/d)) of them with a stay, so the ratio n/d is found by bisection
+def find_doctor_count(stay_count, stays_per_doctor):
+    low_ratio, high_ratio = 0.0, 50.0
+    for step in range(60):
+        ratio = (low_ratio+high_ratio)/2
+        if ratio == 0 or ratio/(1-np.exp(-ratio)) < stays_per_doctor:
+            low_ratio = ratio
+        else:
+            high_ratio = ratio
+    return max(1, round(stay_count/max(low_ratio, 1e-9)))
+
+# Function to pick one of the given values for each of the given random numbers (between 0 and 1), with each value picked as
+# often as its probability says
+def pick_values(values, probabilities, random_numbers):
+    value_positions = np.searchsorted(np.cumsum(probabilities), random_numbers*np.sum(probabilities), side='right')
+    return values[np.minimum(value_positions, values.shape[0]-1)]
+
+# Function to generate the given number of stays, yielding them chunk_size stays at a time as DataFrames with the columns of
+# the partially cleaned stay data
+# Every stay uses the same number of random numbers (one per column), so generating the stays chunk by chunk gives the same
+# stays whatever the chunk size is
+def generate_stay_data(stay_count, stay_data_description, chunk_size=CHUNK_SIZE, random_seed=RANDOM_SEED):
+    random_generator = np.random.default_rng(random_seed)
+    name_data = pd.read_csv(NAME_DATA_FILE)
+    full_names = (name_data['First Name']+' '+name_data['Last Name']).to_numpy()
+    doctor_names = make_doctor_names(find_doctor_count(stay_count, stay_data_description['stays_per_doctor']), name_data,
+                                     random_generator)
+    category_columns = list(stay_data_description['categories'])
+    billing_amount_quantiles = stay_data_description['billing_amount_quantiles']
+
+    for chunk_start in range(0, stay_count, chunk_size):
+        chunk_stay_count = min(chunk_size, stay_count-chunk_start)
+        random_numbers = random_generator.random((chunk_stay_count, len(category_columns)+4))
+        stay_data = {column: pick_values(*stay_data_description['categories'][column], random_numbers[:, column_number])
+                     for column_number, column in enumerate(category_columns)}
+        stay_data['Name'] = full_names[(random_numbers[:, -4]*full_names.shape[0]).astype(int)]
+        stay_data['Doctor'] = doctor_names[(random_numbers[:, -3]*doctor_names.shape[0]).astype(int)]
+        stay_data['Hospital'] = np.array(hospital_list)[(random_numbers[:, -2]*len(hospital_list)).astype(int)]
+        # Draw each billing amount from the spread of billing amounts by picking a random point between the quantiles
+        stay_data['Billing Amount'] = np.interp(random_numbers[:, -1], np.linspace(0, 1, billing_amount_quantiles.shape[0]),
+                                                billing_amount_quantiles)
+        admission_dates = stay_data['Date of Admission'].astype('datetime64[D]')
+        stay_data['Discharge Date'] = (admission_dates+stay_data.pop('Length of Stay').astype('timedelta64[D]')).astype(str)
+        yield pd.DataFrame(stay_data)[STAY_COLUMNS]
+
+# Function to generate the given number of stays and save them to a CSV, one chunk at a time
+def save_generated_stay_data(stay_count, csv_path, like_csv_path=None, chunk_size=CHUNK_SIZE, random_seed=RANDOM_SEED):
+    stay_data_description = describe_stay_data(like_csv_path, chunk_size)
+    for chunk_number, stay_data in enumerate(generate_stay_data(stay_count, stay_data_description, chunk_size,
+                                                                random_seed)):
+        stay_data.to_csv(csv_path, index=False, mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0)
+
+
+
+# Part 3: Run the generator from the command line
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Generate a CSV of made-up hospital stays for create_db.py.')
+    argument_parser.add_argument('stay_count', type=int, help='number of hospital stays to generate')
+    argument_parser.add_argument('csv_file', help='CSV file to save the hospital stays to')
+    argument_parser.add_argument('--like', metavar='CSV_FILE', help='match how often each value appears in this CSV of '+
+                                 'hospital stays instead of the Kaggle dataset')
+    argument_parser.add_argument('--seed', type=int, default=RANDOM_SEED, help='seed for the random values '+
+                                 '(default: %(default)s)')
+    argument_parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='number of hospital stays to '+
+                                 'generate at a time (default: %(default)s)')
+    arguments = argument_parser.parse_args()
+
+    save_generated_stay_data(arguments.stay_count, arguments.csv_file, arguments.like, arguments.chunk_size, arguments.seed)
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+# Please see Readme for more info
+
+# This code checks how SQLite plans to run a saved query on the hospital stay database and suggests indexes that would make it
+# faster. It runs EXPLAIN QUERY PLAN on the query, flags each step that scans every row of a large table, and suggests an
+# index on the columns the query uses to filter or join that table. With the --create option, it also creates the suggested
+# indexes and times the query before and after.
+
+# Example: python index_advisor.py my_query.sql --create
+# Instead of a file, the query can be given directly with --query, e.g. python index_advisor.py --query "SELECT ..."
+
+# With the --benchmark option, the code instead times the SELECT examples from the readme and some date range billing queries
+# on the database as it is and on a copy without the secondary indexes that create_db.py creates, to show how much the indexes
+# help.
+
+# Import packages - sqlite3 for running the database, re for finding the tables and columns a query uses, time for timing the
+# queries, argparse for reading the command line options, and create_db for the list of indexes the database is built with
+import sqlite3
+import re
+import time
+import argparse
+from create_db import DATABASE_FILE, INDEXES
+
+
+
+# Part 1: Find the scans in a query plan and suggest indexes for them
+
+# Tables with at least this many rows are considered large enough for a full scan to be worth flagging
+MIN_TABLE_ROWS = 10000
+
+# Columns with fewer than this many distinct values (e.g. patient_gender or patient_blood_type) are left out of suggested
+# indexes, since looking up one of their values still reads a large share of the table
+MIN_DISTINCT_VALUES = 20
+
+# Number of times each query is run when timing it (the fastest run is reported)
+TIMING_RUNS = 3
+
+# SELECT examples from the readme, used by the --benchmark option
+README_EXAMPLE_QUERIES = ['SELECT * FROM hospital_stay;',
+                          'SELECT billing_amt FROM hospital_stay;',
+                          'SELECT * FROM hospital_stay hs, patient p WHERE hs.patient_id = p.patient_id;',
+                          'SELECT p.patient_name, hs.billing_amt FROM hospital_stay hs INNER JOIN patient p ON '+
+                          'hs.patient_id = p.patient_id INNER JOIN insurance i ON hs.insurance_provider_id = '+
+                          'i.insurance_provider_id WHERE i.insurance_provider_name = \'Blue Cross\';',
+                          'SELECT * FROM patient WHERE patient_id = 100000;']
+
+# Date range billing queries, also used by the --benchmark option since they are the other common use of the indexes
+BILLING_EXAMPLE_QUERIES = ['SELECT SUM(billing_amt) FROM hospital_stay WHERE admission_date BETWEEN \'2023-01-01\' AND '+
+                           '\'2023-03-31\';',
+                           'SELECT i.insurance_provider_name, SUM(hs.billing_amt) FROM hospital_stay hs '+
+                           'INNER JOIN insurance i ON hs.insurance_provider_id = i.insurance_provider_id '+
+                           'WHERE hs.discharge_date BETWEEN \'2023-01-01\' AND \'2023-12-31\' '+
+                           'GROUP BY i.insurance_provider_name;']
+
+# SQL keywords that can follow a table name, so they are not mistaken for table aliases
+SQL_KEYWORDS = {'WHERE', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS', 'NATURAL', 'JOIN', 'ON', 'USING', 'GROUP',
+                'ORDER', 'LIMIT', 'HAVING', 'UNION', 'EXCEPT', 'INTERSECT', 'WINDOW', 'AS', 'INDEXED', 'NOT'}
+
+# Function to find the tables a query uses, returning a dictionary that maps each table name or alias in the query to the
+# table it refers to
+# A view that reads a single table (such as the hospital_stay and date views of the compact layout) refers to that table,
+# which the query plan shows instead of the view; the table's own name is added too, so its plan steps can be matched
+def find_query_tables(connection, query):
+    table_names = {row[0].lower(): row[0] for row in connection.execute('SELECT name FROM sqlite_master WHERE type = '+
+                                                                          '"table";')}
+    view_names = {row[0].lower(): row[0] for row in connection.execute('SELECT name FROM sqlite_master WHERE type = '+
+                                                                         '"view";')}
+    query_tables = {}
+    for table, alias in re.findall(r'(?:\bFROM|\bJOIN|,)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', query, flags=re.IGNORECASE):
+        if table.lower() in table_names:
+            query_table = table_names[table.lower()]
+        elif table.lower() in view_names:
+            view_tables = {table_names[plan_table.lower()] for plan_table in
+                           re.findall(r'^(?:SCAN|SEARCH) (\w+)', '\n'.join(plan_row[3] for plan_row in connection.execute(
+                               'EXPLAIN QUERY PLAN SELECT * FROM '+view_names[table.lower()]+';')), flags=re.MULTILINE)
+                           if plan_table.lower() in table_names}
+            if len(view_tables) != 1:
+                continue
+            (query_table,) = view_tables
+            query_tables[query_table.lower()] = query_table
+        else:
+            continue
+        query_tables[table.lower()] = query_table
+        if alias and alias.upper() not in SQL_KEYWORDS:
+            query_tables[alias.lower()] = query_table
+    return query_tables
+
+# Function to find the columns of a table that a query compares with something, returning the columns compared with a value
+# for equality (=, IN), the columns compared with a value as a range (<, >, BETWEEN, etc.), and the columns compared with a
+# column of another table (joins), each in the order in which they appear
+# table_names is the set of names and aliases that refer to the table in the query; a column written without one of them only
+# counts if the query uses no other table
+def find_filter_columns(connection, query, table, table_names, single_table_query):
+    table_columns = {row[1].lower(): row[1] for row in connection.execute('PRAGMA table_info('+table+');')}
+    # Each side of a comparison can be a column (<column> or <table or alias>.<column>), a text value, a number, a parameter,
+    # or the opening bracket of a list of values or a subquery
+    operand_pattern = r"((?:\w+\.)?\w+|'[^']*'|[-+]?[\d.]+|\?|\()"
+    operator_pattern = r'(==|=|<=|>=|<>|!=|<|>|\bBETWEEN\b|\bIN\b|\bLIKE\b)'
+    comparisons = re.findall(operand_pattern+r'\s*'+operator_pattern+r'\s*'+operand_pattern, query, flags=re.IGNORECASE)
+    equality_columns = []
+    range_columns = []
+    join_columns = []
+    for left_operand, operator, right_operand in comparisons:
+        for operand, other_operand in [(left_operand, right_operand), (right_operand, left_operand)]:
+            operand_parts = operand.lower().split('.')
+            if operand_parts[-1] not in table_columns or \
+               (operand_parts[0] not in table_names if len(operand_parts) == 2 else not single_table_query):
+                continue
+            column = table_columns[operand_parts[-1]]
+            # Comparing with <table or alias>.<column> of another table is a join
+            if re.fullmatch(r'\w+\.\w+', other_operand) and other_operand.lower().split('.')[0] not in table_names:
+                column_list = join_columns if operator in ('=', '==') else None
+            elif operator in ('=', '==') or operator.upper() == 'IN':
+                column_list = equality_columns
+            elif operator in ('<=', '>=', '<', '>') or operator.upper() == 'BETWEEN':
+                column_list = range_columns
+            else:
+                column_list = None
+            if column_list is not None and column not in column_list:
+                column_list.append(column)
+    return equality_columns, [column for column in range_columns if column not in equality_columns], join_columns
+
+# Function to find the existing index of a table whose first columns are the given columns, if there is one
+def find_existing_index(connection, table, index_columns):
+    for index_row in connection.execute('PRAGMA index_list('+table+');').fetchall():
+        existing_columns = [row[2] for row in connection.execute('PRAGMA index_info('+index_row[1]+');')]
+        if [column.lower() for column in existing_columns[:len(index_columns)]] == \
+           [column.lower() for column in index_columns]:
+            return index_row[1]
+    return None
+
+# Function to check whether a column of a table has at least MIN_DISTINCT_VALUES distinct values (only reading until it has
+# found that many)
+def has_many_distinct_values(connection, table, column):
+    return connection.execute('SELECT COUNT(*) FROM (SELECT DISTINCT '+column+' FROM '+table+' LIMIT '+
+                              str(MIN_DISTINCT_VALUES)+');').fetchone()[0] >= MIN_DISTINCT_VALUES
+
+# Function to run EXPLAIN QUERY PLAN on a query and return a list of advice for each step that scans a large table
+# Each piece of advice is a dictionary with the plan step, the table, its row count, and either a suggested CREATE INDEX
+# statement or the reason no index is suggested
+def advise_indexes(connection, query, min_table_rows=MIN_TABLE_ROWS):
+    query_tables = find_query_tables(connection, query)
+    view_names = {row[0].lower() for row in connection.execute('SELECT name FROM sqlite_master WHERE type = "view";')}
+    advice_list = []
+    for plan_row in connection.execute('EXPLAIN QUERY PLAN '+query).fetchall():
+        plan_step = plan_row[3]
+        # A skip-scan (an index search starting with ANY(column)) goes through every value of the index's first column, so
+        # it reads about as much as a scan and is flagged too
+        scan_match = re.match(r'SCAN (\w+)|SEARCH (\w+) USING (?:COVERING )?INDEX \w+ \(ANY\(', plan_step)
+        if scan_match is None or (scan_match.group(1) or scan_match.group(2)).lower() not in query_tables:
+            continue
+        table = query_tables[(scan_match.group(1) or scan_match.group(2)).lower()]
+        table_rows = connection.execute('SELECT COUNT(*) FROM '+table+';').fetchone()[0]
+        if table_rows < min_table_rows:
+            continue
+
+        advice = {'plan_step': plan_step, 'table': table, 'table_rows': table_rows, 'index_statement': None}
+        # Only the names and aliases that refer to this table count when matching <table or alias>.<column> references
+        table_names = {name for name in query_tables if query_tables[name] == table}
+        equality_columns, range_columns, join_columns = find_filter_columns(connection, query, table, table_names,
+                                                                            len(set(query_tables.values())) == 1)
+        # Filters on columns with only a few distinct values do not narrow the rows down enough for an index to help
+        few_value_columns = [column for column in equality_columns+range_columns
+                             if not has_many_distinct_values(connection, table, column)]
+        equality_columns = [column for column in equality_columns if column not in few_value_columns]
+        range_columns = [column for column in range_columns if column not in few_value_columns]
+        # An index can use any number of equality columns followed by one range column; if the table is only joined to
+        # other tables, an index on the join columns lets SQLite look up the matching rows instead of scanning the table
+        index_columns = equality_columns+range_columns[:1]
+        if not index_columns and not few_value_columns:
+            index_columns = join_columns
+        if not index_columns and few_value_columns:
+            advice['reason'] = 'the query only filters '+table+' on '+', '.join(few_value_columns)+', which '+ \
+                               ('has' if len(few_value_columns) == 1 else 'have')+' fewer than '+ \
+                               str(MIN_DISTINCT_VALUES)+' distinct values, so an index would still read a large share '+ \
+                               'of the rows'
+        elif not index_columns:
+            advice['reason'] = 'the query does not filter or join '+table+' on any of its columns, so it reads every row'
+            # Columns a view computes (e.g. the dates and billing amounts of the compact layout) cannot use an index
+            query_views = sorted(name for name in table_names if name in view_names)
+            if query_views:
+                advice['reason'] += ' (filters on columns that the '+', '.join(query_views)+' view computes cannot use '+ \
+                                    'an index; filter on the columns of '+table+' itself instead)'
+        elif find_existing_index(connection, table, index_columns) is not None:
+            advice['reason'] = 'the index '+find_existing_index(connection, table, index_columns)+' already covers '+ \
+                               ', '.join(index_columns)+', so SQLite chose to read every row (e.g. because the query '+ \
+                               'needs all of them)'
+        else:
+            index_name = 'advisor_'+table+'_'+'_'.join(index_columns)+'_idx'
+            advice['index_statement'] = 'CREATE INDEX '+index_name+' ON '+table+' ('+', '.join(index_columns)+');'
+        advice_list.append(advice)
+    return advice_list
+
+# Function to time a query, returning the fastest of TIMING_RUNS runs in milliseconds
+def time_query(connection, query, timing_runs=TIMING_RUNS):
+    run_times = []
+    for run in range(timing_runs):
+        start_time = time.perf_counter()
+        connection.execute(query).fetchall()
+        run_times.append((time.perf_counter()-start_time)*1000)
+    return min(run_times)
+
+
+
+# Part 2: Benchmark the readme examples with and without the secondary indexes
+
+# Function to time each readme example and date range billing query on the database as it is and on an in-memory copy of it
+# without the secondary indexes that create_db.py creates, returning a list of (query, time without indexes, time with
+# indexes) tuples
+def benchmark_readme_examples(connection):
+    unindexed_connection = sqlite3.connect(':memory:')
+    connection.backup(unindexed_connection)
+    for index_name, table, index_columns in INDEXES:
+        unindexed_connection.execute('DROP INDEX IF EXISTS '+index_name+';')
+    unindexed_connection.execute('ANALYZE;')
+
+    # Time the indexed database from memory too so that both timings are done the same way
+    indexed_connection = sqlite3.connect(':memory:')
+    connection.backup(indexed_connection)
+    benchmark_results = [(query, time_query(unindexed_connection, query), time_query(indexed_connection, query))
+                         for query in README_EXAMPLE_QUERIES+BILLING_EXAMPLE_QUERIES]
+    unindexed_connection.close()
+    indexed_connection.close()
+    return benchmark_results
+
+
+
+# Part 3: Run the advisor from the command line
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Suggest indexes for a query on the hospital stay database.')
+    argument_parser.add_argument('query_file', nargs='?', help='file containing the query to check')
+    argument_parser.add_argument('--query', help='query to check, instead of a query file')
+    argument_parser.add_argument('--database', default=DATABASE_FILE, help='database file (default: %(default)s)')
+    argument_parser.add_argument('--min-rows', type=int, default=MIN_TABLE_ROWS, help='only flag scans of tables with at '+
+                                 'least this many rows (default: %(default)s)')
+    argument_parser.add_argument('--create', action='store_true', help='create the suggested indexes and time the query '+
+                                 'before and after')
+    argument_parser.add_argument('--benchmark', action='store_true', help='time the readme examples and date range billing '+
+                                 'queries with and without the secondary indexes instead of checking a query')
+    arguments = argument_parser.parse_args()
+
+    connection = sqlite3.connect(arguments.database)
+
+    if arguments.benchmark:
+        print('Time without indexes (ms) | time with indexes (ms) | query')
+        for query, unindexed_time, indexed_time in benchmark_readme_examples(connection):
+            print(format(unindexed_time, '.1f')+' | '+format(indexed_time, '.1f')+' | '+query)
+    else:
+        if arguments.query is not None:
+            query = arguments.query
+        elif arguments.query_file is not None:
+            with open(arguments.query_file) as query_file:
+                query = query_file.read()
+        else:
+            argument_parser.error('please give a query file or a query with --query')
+        query = query.strip().rstrip(';')
+
+        advice_list = advise_indexes(connection, query, arguments.min_rows)
+        if not advice_list:
+            print('No full scans of large tables found; no indexes needed.')
+        for advice in advice_list:
+            print(advice['plan_step']+' ('+str(advice['table_rows'])+' rows in '+advice['table']+')')
+            if advice['index_statement'] is None:
+                print('    No index suggested: '+advice['reason'])
+            else:
+                print('    Suggested index: '+advice['index_statement'])
+
+        # Create the suggested indexes and show how much faster the query got
+        index_statements = list(dict.fromkeys([advice['index_statement'] for advice in advice_list
+                                               if advice['index_statement'] is not None]))
+        if arguments.create and index_statements:
+            time_before = time_query(connection, query)
+            for index_statement in index_statements:
+                connection.execute(index_statement)
+            connection.execute('ANALYZE;')
+            connection.commit()
+            time_after = time_query(connection, query)
+            print('Created '+str(len(index_statements))+' index(es). Query time: '+format(time_before, '.1f')+' ms before, '+
+                  format(time_after, '.1f')+' ms after')
+
+    # End any remaining active processes by closing the connection
+    connection.close()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# Please see Readme for more info
+
+# This code lets create_db.py and run_queries.py record where their time goes, for finding out why a build or a query is
+# slow. It is off unless a log file is given, either with the HOSPITAL_STAY_LOG_FILE environment variable (for both) or with
+# create_db.py's --log-file option. When it is on:
+# - each phase of a build or ingest (reading the CSV, cleaning the data, loading each table, etc.) is logged with its wall
+#   clock time, CPU time, and number of rows
+# - each SQL statement create_db.py runs is logged with the number of times it was run, the total time spent running it and
+#   fetching its rows, and the number of rows it changed or returned, along with the number of times SQLite ran it (e.g.
+#   one per row for an executemany call; the statements run by triggers, such as those keeping the name search up to date,
+#   are not counted)
+# - each query run in the query workbench is logged with its wall clock time, CPU time, and number of rows on its first page
+#   of results, and queries that take more than SLOW_QUERY_SECONDS also have their query plan (from EXPLAIN QUERY PLAN)
+#   logged
+# The log file has one JSON object per line, each with the time, the program, and the kind of event, so logs from many runs
+# can be added to the same file and read with e.g. pandas.read_json(log_file, lines=True).
+
+# N.B.: Python's sqlite3 module only has a trace callback (called when a statement starts) and not SQLite's profile callback
+# (called when it ends), so statements are timed and counted by the connection and cursor classes below instead. The trace
+# callback cannot be used to count them either, since it is also called for each statement a trigger runs, with the same
+# text as the statement that fired the trigger.
+
+# Import packages - sqlite3 for the connection and cursor classes, json for writing the log, os for the environment variable
+# and the program name, sys for the program name, time for timing the statements, and datetime for the time of each event
+import sqlite3
+import json
+import os
+import sys
+import time
+import datetime as dt
+
+
+
+# Part 1: Turn the instrumentation on and write to the log file
+
+# Environment variable with the log file to write to; the instrumentation is off if it is not set
+LOG_FILE_ENVIRONMENT_VARIABLE = 'HOSPITAL_STAY_LOG_FILE'
+
+# User queries that take longer than this many seconds have their query plan logged
+SLOW_QUERY_SECONDS = 1.0
+
+# Log file the events are written to, or None if the instrumentation is off
+log_file = os.environ.get(LOG_FILE_ENVIRONMENT_VARIABLE) or None
+
+# Function to turn the instrumentation on, writing the events to the given log file (or to turn it off if None is given)
+def set_log_file(log_file_path):
+    global log_file
+    log_file = log_file_path
+
+# Function to check whether the instrumentation is on
+def is_enabled():
+    return log_file is not None
+
+# Function to add an event to the log file, if the instrumentation is on, with the given kind of event and details
+def log_event(event, **details):
+    if log_file is None:
+        return
+    log_record = {'time': dt.datetime.now().isoformat(timespec='milliseconds'), 'program': os.path.basename(sys.argv[0]),
+                  'process_id': os.getpid(), 'event': event}
+    log_record.update(details)
+    with open(log_file, 'a') as log:
+        log.write(json.dumps(log_record, default=str)+'\n')
+
+
+
+# Part 2: Time each SQL statement
+
+# Cursor class that adds the time spent running each statement and fetching its rows, the number of rows it changed or
+# returned, and the number of times SQLite ran it, to its connection's statement statistics
+class InstrumentedCursor(sqlite3.Cursor):
+    def record(self, sql, start_time, row_count):
+        statement_stats = self.connection.statement_stats.setdefault(sql, {'calls': 0, 'seconds': 0.0, 'rows': 0,
+                                                                           'sqlite_statements': 0})
+        statement_stats['seconds'] += time.perf_counter()-start_time
+        statement_stats['rows'] += max(row_count, 0)
+
+    def execute(self, sql, parameters=()):
+        self.sql = sql
+        self.connection.count_call(sql)
+        start_time = time.perf_counter()
+        super().execute(sql, parameters)
+        self.record(sql, start_time, self.rowcount)
+        return self
+
+    def executemany(self, sql, parameter_rows):
+        self.sql = sql
+        self.connection.count_call(sql, sqlite_statements=0)
+        start_time = time.perf_counter()
+        super().executemany(sql, self.connection.count_sqlite_statements(sql, parameter_rows))
+        self.record(sql, start_time, self.rowcount)
+        return self
+
+    def fetchone(self):
+        start_time = time.perf_counter()
+        row = super().fetchone()
+        self.record(self.sql, start_time, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start_time = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.record(self.sql, start_time, len(rows))
+        return rows
+
+    def fetchall(self):
+        start_time = time.perf_counter()
+        rows = super().fetchall()
+        self.record(self.sql, start_time, len(rows))
+        return rows
+
+# Connection class whose cursors time each statement, keeping a dictionary of statistics (number of calls, seconds, rows, and
+# times SQLite ran the statement) for each statement's SQL text
+# An execute call runs its statement once and an executemany call runs it once per row of values, which are counted as
+# SQLite reads them
+class InstrumentedConnection(sqlite3.Connection):
+    def __init__(self, *arguments, **keyword_arguments):
+        super().__init__(*arguments, **keyword_arguments)
+        self.statement_stats = {}
+
+    def count_call(self, sql, sqlite_statements=1):
+        statement_stats = self.statement_stats.setdefault(sql, {'calls': 0, 'seconds': 0.0, 'rows': 0,
+                                                                'sqlite_statements': 0})
+        statement_stats['calls'] += 1
+        statement_stats['sqlite_statements'] += sqlite_statements
+
+    def count_sqlite_statements(self, sql, parameter_rows):
+        for parameters in parameter_rows:
+            self.statement_stats[sql]['sqlite_statements'] += 1
+            yield parameters
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameter_rows):
+        return self.cursor().executemany(sql, parameter_rows)
+
+# Function to connect to a database, with each statement timed if the instrumentation is on
+def connect(database_file, **keyword_arguments):
+    if is_enabled():
+        keyword_arguments['factory'] = InstrumentedConnection
+    return sqlite3.connect(database_file, **keyword_arguments)
+
+# Function to log the statistics of each statement run on a connection (if it was connected with the instrumentation on) and
+# start counting again, adding the given details (e.g. whether it was a build or an ingest) to each event
+def log_statement_stats(connection, **details):
+    for sql, statement_stats in getattr(connection, 'statement_stats', {}).items():
+        log_event('statement', sql=' '.join(sql.split()), **statement_stats, **details)
+    if hasattr(connection, 'statement_stats'):
+        connection.statement_stats = {}
+
+
+
+# Part 3: Log slow user queries
+
+# Function to get the query plan of a query (with the given parameters, if any) as a list of lines like those the SQLite
+# command line shell shows, each indented to show which step it belongs to, or None if the query cannot be explained
+def get_query_plan(connection, query, parameters=()):
+    try:
+        plan_rows = connection.execute('EXPLAIN QUERY PLAN '+query, parameters).fetchall()
+    except sqlite3.Error:
+        return None
+    step_depths = {0: -1}
+    query_plan = []
+    for step_id, parent_id, not_used, step in plan_rows:
+        step_depths[step_id] = step_depths.get(parent_id, -1)+1
+        query_plan.append('  '*step_depths[step_id]+step)
+    return query_plan
+
+# Function to log a query run by the user (with the given parameters, if any), with its query plan if it took more than
+# SLOW_QUERY_SECONDS
+def log_query(connection, query, seconds, cpu_seconds, row_count, parameters=(), **details):
+    if not is_enabled():
+        return
+    slow = seconds > SLOW_QUERY_SECONDS
+    log_event('query', sql=query, seconds=seconds, cpu_seconds=cpu_seconds, rows=row_count, slow=slow,
+              query_plan=get_query_plan(connection, query, parameters) if slow else None, **details)
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+
+# Please see Readme for more info
+
+# This code runs a local query service so that several analysts and scripts can query the database at once, which the query
+# workbench (run_queries.py) cannot do since it is a single window for a single person. Queries are sent over HTTP and their
+# results are sent back as JSON or CSV, e.g.:
+#   python query_server.py
+#   curl "http://127.0.0.1:8765/query?sql=SELECT+*+FROM+billing_by_insurance_month"
+#   curl "http://127.0.0.1:8765/query?format=csv&timeout=60" --data-binary @my_query.sql -o result.csv
+# or, from Python, pandas.read_csv('http://127.0.0.1:8765/query?format=csv&sql=...').
+
+# Each query runs on one of a pool of POOL_SIZE read-only connections to the database, so the service can never change the
+# database, and up to POOL_SIZE queries run at the same time (later ones wait up to POOL_WAIT_SECONDS for a free connection).
+# The database uses write-ahead logging (WAL, see create_db.py), in which readers never wait for each other or for stays being
+# ingested, so none of these queries gets a "database is locked" error. A rebuild with create_db.py copies the new database
+# into the old one, and queries that have already started finish on the old data while the next ones see the new data.
+
+# Results are sent FETCH_SIZE rows at a time as they are fetched from the database, so even a query returning millions of
+# rows starts arriving right away and uses little memory. A query that takes longer than its timeout (QUERY_TIMEOUT_SECONDS
+# unless the request gives its own) is stopped.
+
+# The service only listens on this computer (127.0.0.1) unless the --host option is given. Anyone who can reach it can read
+# the whole database, so only open it up to a network you trust.
+
+# To find out why a query is slow, set the HOSPITAL_STAY_LOG_FILE environment variable to a log file before running this code;
+# each query is then logged with its time, CPU time, and number of rows, along with its query plan if it is slow (see
+# instrumentation.py).
+
+# Import packages - sqlite3 for running the database, http.server and urllib for the HTTP service, queue and threading for
+# the connection pool, json and csv for writing the results, io for writing CSV rows to text, os for checking whether the
+# database file has been replaced, time for the timeouts and for timing the queries, math for checking the timeouts,
+# argparse for reading the command line options, and instrumentation for logging the queries (if the HOSPITAL_STAY_LOG_FILE
+# environment variable is set)
+import sqlite3
+import http.server
+import urllib.parse
+import urllib.request
+import queue
+import threading
+import json
+import csv
+import io
+import os
+import time
+import math
+import argparse
+import instrumentation
+
+
+
+# Part 1: Settings of the query service
+
+# Database file to query
+DATABASE_FILE = 'hospital_stay_database.db'
+
+# Address and port the service listens on by default
+HOST = '127.0.0.1'
+PORT = 8765
+
+# Number of read-only connections to the database, i.e. the number of queries that can run at the same time
+POOL_SIZE = 8
+
+# Number of seconds a request waits for a free connection before it is turned away as busy (HTTP status 503)
+POOL_WAIT_SECONDS = 10.0
+
+# Number of seconds a query may take (including sending its result) before it is stopped, unless the request gives its own
+# timeout, and the most a request may give
+QUERY_TIMEOUT_SECONDS = 30.0
+MAX_QUERY_TIMEOUT_SECONDS = 600.0
+
+# Number of result rows fetched from the database and sent at a time
+FETCH_SIZE = 1000
+
+# Number of SQLite virtual machine steps between checks of whether a query has run out of time (a few milliseconds' worth)
+TIMEOUT_CHECK_STEPS = 10000
+
+# Result formats and their content types
+RESULT_FORMATS = {'json': 'application/json; charset=utf-8', 'csv': 'text/csv; charset=utf-8'}
+
+# PRAGMA statements that may be given a value, since the value only says what to look up (e.g. PRAGMA table_info(patient));
+# any other PRAGMA given a value would change the connection's settings (e.g. PRAGMA query_only = OFF), which the next query
+# on the same connection would then run with
+LOOKUP_PRAGMAS = {'table_info', 'table_xinfo', 'table_list', 'index_list', 'index_info', 'index_xinfo', 'foreign_key_list',
+                  'foreign_key_check', 'integrity_check', 'quick_check'}
+
+
+
+# Part 2: Keep a pool of read-only connections to the database
+
+# Function to open a read-only connection to the database that any thread can use
+# mode=ro makes SQLite refuse any change to the database and query_only makes it refuse any statement that would change it;
+# attaching other database files is not allowed either, so a query can only read this database, and PRAGMA statements that
+# change settings are refused, so a query cannot change the connection for the queries run on it after it
+def open_read_only_connection(database_file):
+    connection = sqlite3.connect('file:'+urllib.request.pathname2url(os.path.abspath(database_file))+'?mode=ro', uri=True,
+                                 check_same_thread=False, factory=ReadOnlyConnection)
+    connection.execute('PRAGMA query_only = ON;')
+    connection.setlimit(sqlite3.SQLITE_LIMIT_ATTACHED, 0)
+    connection.set_authorizer(authorize_action)
+    # Remember which file the connection was opened on, so it can be reopened if the database file is replaced by a new one
+    connection.database_file_id = get_database_file_id(database_file)
+    return connection
+
+# Function to tell SQLite whether a query may take an action, refusing PRAGMA statements given a value unless the value
+# only says what to look up
+def authorize_action(action, argument_1, argument_2, database_name, trigger_or_view):
+    if action == sqlite3.SQLITE_PRAGMA and argument_2 is not None and argument_1.lower() not in LOOKUP_PRAGMAS:
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+# Function to get what identifies the database file on disk (its device and inode numbers), which changes when the file is
+# replaced by a new one (e.g. when a database not yet in WAL mode is rebuilt) but not when the database is changed in place
+def get_database_file_id(database_file):
+    database_file_stats = os.stat(database_file)
+    return (database_file_stats.st_dev, database_file_stats.st_ino)
+
+# Connection class for the read-only connections, so that each one can remember which file it was opened on
+class ReadOnlyConnection(sqlite3.Connection):
+    pass
+
+# Pool of read-only connections, from which each request takes a connection and gives it back once its result is sent
+class ConnectionPool:
+    def __init__(self, database_file, pool_size=POOL_SIZE):
+        if not os.path.exists(database_file):
+            raise FileNotFoundError('The database '+database_file+' has not been built yet. Please run create_db.py first.')
+        self.database_file = database_file
+        self.pool_size = pool_size
+        self.free_connections = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.open_count = 0
+
+    # Function to take a free connection, opening a new one if fewer than pool_size are open, or to return None if none is
+    # free within the given number of seconds
+    # A connection opened on a database file that has since been replaced is reopened on the new file
+    def take(self, wait_seconds=POOL_WAIT_SECONDS):
+        try:
+            connection = self.free_connections.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                open_new = self.open_count < self.pool_size
+                if open_new:
+                    self.open_count += 1
+            if open_new:
+                return self.open_connection()
+            try:
+                connection = self.free_connections.get(timeout=wait_seconds)
+            except queue.Empty:
+                return None
+        try:
+            database_file_replaced = connection.database_file_id != get_database_file_id(self.database_file)
+        except OSError:
+            database_file_replaced = True
+        if database_file_replaced:
+            connection.close()
+            return self.open_connection()
+        return connection
+
+    # Function to open a connection for the pool (counted in open_count already), no longer counting it if it cannot be
+    # opened (e.g. because the database file is missing)
+    def open_connection(self):
+        try:
+            return open_read_only_connection(self.database_file)
+        except (sqlite3.Error, OSError):
+            with self.lock:
+                self.open_count -= 1
+            raise
+
+    # Function to give a connection back to the pool
+    def give_back(self, connection):
+        self.free_connections.put(connection)
+
+    # Function to close all the free connections
+    def close(self):
+        while True:
+            try:
+                self.free_connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+
+# Part 3: Run queries and stream their results
+
+# Error raised when the client that sent a request stops reading its result (e.g. because it was closed)
+CLIENT_GONE_ERRORS = (BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+# Request handler of the query service, with these endpoints:
+# - GET /query?sql=...: run the query in the sql parameter
+# - POST /query: run the query in the request body
+# - GET /health: check that the service is running, and see how many connections are open and free
+# Both /query endpoints take the optional parameters format (json, the default, or csv) and timeout (in seconds).
+# A JSON result looks like {"columns": [...], "rows": [[...], ...], "row_count": 2}; a CSV result has the column names as its
+# first line. A query that cannot be run gets status 400 (with its error), one that runs out of time gets 504, and one that
+# finds no free connection gets 503, each with a JSON body like {"error": "..."}.
+# N.B.: The result is sent as it is fetched, so a query that fails or runs out of time after its first FETCH_SIZE rows have
+# been sent cannot change its status any more; a JSON result then ends with an "error" entry, and a CSV result simply ends.
+class QueryRequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'HospitalStayQueryServer/1.0'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parameters = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/health':
+            self.send_json(200, {'status': 'ok', 'database': self.server.connection_pool.database_file,
+                                 'pool_size': self.server.connection_pool.pool_size,
+                                 'open_connections': self.server.connection_pool.open_count,
+                                 'free_connections': self.server.connection_pool.free_connections.qsize()})
+        elif url.path == '/query':
+            self.run_query(parameters.get('sql', ''), parameters)
+        else:
+            self.send_json(404, {'error': 'Unknown path '+url.path+'; use /query or /health.'})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        parameters = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/query':
+            try:
+                content_length = int(self.headers.get('Content-Length', 0))
+                if content_length < 0:
+                    raise ValueError('negative Content-Length')
+                query_str = self.rfile.read(content_length).decode('utf-8')
+            except ValueError: # Content-Length not a length, or a body that is not UTF-8 text (UnicodeDecodeError)
+                self.send_json(400, {'error': 'The request body must be a query in UTF-8 text, with its length in the '+
+                                     'Content-Length header.'})
+                return
+            self.run_query(query_str, parameters)
+        else:
+            self.send_json(404, {'error': 'Unknown path '+url.path+'; use /query.'})
+
+    # Function to send a whole JSON response with the given status
+    def send_json(self, status, response):
+        response_bytes = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', RESULT_FORMATS['json'])
+        self.send_header('Content-Length', str(len(response_bytes)))
+        self.end_headers()
+        self.wfile.write(response_bytes)
+
+    # Function to run a query on a connection from the pool and send its result
+    def run_query(self, query_str, parameters):
+        result_format = parameters.get('format', 'json')
+        if result_format not in RESULT_FORMATS:
+            self.send_json(400, {'error': 'Unknown format '+result_format+'; use json or csv.'})
+            return
+        if not query_str.strip():
+            self.send_json(400, {'error': 'No query given; put it in the sql parameter or the request body.'})
+            return
+        try:
+            timeout_seconds = float(parameters.get('timeout', QUERY_TIMEOUT_SECONDS))
+            if not math.isfinite(timeout_seconds) or timeout_seconds <= 0:
+                raise ValueError('timeout out of range')
+            timeout_seconds = min(timeout_seconds, MAX_QUERY_TIMEOUT_SECONDS)
+        except ValueError:
+            self.send_json(400, {'error': 'The timeout must be a positive number of seconds.'})
+            return
+
+        try:
+            connection = self.server.connection_pool.take()
+        except (sqlite3.Error, OSError) as error:
+            self.send_json(503, {'error': 'The database could not be opened: '+str(error)})
+            return
+        if connection is None:
+            self.send_json(503, {'error': 'All '+str(self.server.connection_pool.pool_size)+' connections are busy; '+
+                                 'please try again.'})
+            return
+        start_time = time.perf_counter()
+        start_cpu_time = time.thread_time()
+        deadline = time.monotonic()+timeout_seconds
+        # Have SQLite stop the query (with an "interrupted" error) once it runs past its deadline
+        connection.set_progress_handler(lambda: time.monotonic() > deadline, TIMEOUT_CHECK_STEPS)
+        cursor = connection.cursor()
+        row_count = 0
+        query_error = None
+        try:
+            try:
+                cursor.execute(query_str)
+                rows = cursor.fetchmany(FETCH_SIZE)
+            except sqlite3.Error as error:
+                query_error = get_query_error(error, deadline, timeout_seconds)
+                self.send_json(504 if time.monotonic() > deadline else 400, {'error': query_error})
+                return
+            columns = [column[0] for column in cursor.description or []]
+            self.send_response(200)
+            self.send_header('Content-Type', RESULT_FORMATS[result_format])
+            self.end_headers()
+            result_writer = JsonResultWriter(self.wfile, columns) if result_format == 'json' else \
+                CsvResultWriter(self.wfile, columns)
+            while rows:
+                result_writer.write_rows(rows)
+                row_count += len(rows)
+                try:
+                    rows = cursor.fetchmany(FETCH_SIZE)
+                except sqlite3.Error as error:
+                    query_error = get_query_error(error, deadline, timeout_seconds)
+                    break
+            result_writer.finish(row_count, query_error)
+        except CLIENT_GONE_ERRORS:
+            query_error = 'The client stopped reading the result.'
+        finally:
+            # Finish the query before giving the connection back, so that it stops holding on to the data it was reading
+            cursor.close()
+            connection.set_progress_handler(None, 0)
+            instrumentation.log_query(connection, query_str, time.perf_counter()-start_time,
+                                      time.thread_time()-start_cpu_time, row_count, client=self.client_address[0],
+                                      format=result_format, error=query_error)
+            self.server.connection_pool.give_back(connection)
+
+# Function to get the message to send for an error raised by a query, saying so if it ran out of time
+def get_query_error(error, deadline, timeout_seconds):
+    if time.monotonic() > deadline:
+        return 'The query took longer than its timeout of '+format(timeout_seconds, 'g')+' seconds and was stopped.'
+    return str(error)
+
+# Function to turn a value SQLite returned into one JSON can hold, showing BLOBs as hexadecimal text
+def to_json_value(value):
+    return value.hex() if isinstance(value, bytes) else str(value)
+
+# Class writing a JSON result a batch of rows at a time
+class JsonResultWriter:
+    def __init__(self, output, columns):
+        self.output = output
+        self.first_rows = True
+        self.output.write(('{"columns": '+json.dumps(columns)+', "rows": [').encode('utf-8'))
+
+    def write_rows(self, rows):
+        rows_json = ',\n'.join(json.dumps(row, default=to_json_value) for row in rows)
+        self.output.write(('\n' if self.first_rows else ',\n').encode('utf-8')+rows_json.encode('utf-8'))
+        self.first_rows = False
+
+    def finish(self, row_count, query_error=None):
+        self.output.write(('\n], "row_count": '+str(row_count)+
+                           ('' if query_error is None else ', "error": '+json.dumps(query_error))+'}\n').encode('utf-8'))
+
+# Class writing a CSV result a batch of rows at a time, starting with a line of column names
+class CsvResultWriter:
+    def __init__(self, output, columns):
+        self.output = output
+        self.write_rows([columns])
+
+    def write_rows(self, rows):
+        csv_text = io.StringIO()
+        csv.writer(csv_text, lineterminator='\n').writerows(rows)
+        self.output.write(csv_text.getvalue().encode('utf-8'))
+
+    def finish(self, row_count, query_error=None):
+        pass
+
+# HTTP server running each request in its own thread, with a pool of read-only connections to the database
+# The backlog of connections waiting to be accepted is raised from 5 so that many clients can connect at once
+class QueryServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, database_file=DATABASE_FILE, pool_size=POOL_SIZE):
+        self.connection_pool = ConnectionPool(database_file, pool_size)
+        super().__init__(server_address, QueryRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.connection_pool.close()
+
+
+
+# Part 4: Run the query service from the command line
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Run a local service for querying the hospital stay database '+
+                                              'over HTTP.')
+    argument_parser.add_argument('--database', default=DATABASE_FILE, help='database file to query (default: %(default)s)')
+    argument_parser.add_argument('--host', default=HOST, help='address to listen on (default: %(default)s, i.e. only '+
+                                 'this computer)')
+    argument_parser.add_argument('--port', type=int, default=PORT, help='port to listen on (default: %(default)s)')
+    argument_parser.add_argument('--pool-size', type=int, default=POOL_SIZE, help='number of read-only connections, i.e. '+
+                                 'queries that can run at the same time (default: %(default)s)')
+    arguments = argument_parser.parse_args()
+
+    query_server = QueryServer((arguments.host, arguments.port), arguments.database, arguments.pool_size)
+    print('Querying '+arguments.database+' at http://'+arguments.host+':'+str(query_server.server_address[1])+
+          '/query?sql=... (press Ctrl+C to stop)')
+    try:
+        query_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        query_server.server_close()
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+# Please see Readme for more info
+
+# This code runs the queries of the query workbench (run_queries.py) without its window: it keeps the results of recent
+# queries in a cache, so running the same query again gives its result right away unless the database has changed since,
+# answers queries that add up billing amounts or count stays by insurance provider, hospital, medical condition, and/or
+# admission date period from the billing summary views that create_db.py keeps, and builds the queries for the workbench's
+# name searches. The workbench holds one QuerySession, on which the queries typed into it run.
+
+# Import packages - sqlite3 for running the database, collections for the result cache, os for checking whether the database
+# file has been rebuilt, and re for normalizing and rewriting queries
+import sqlite3
+import collections
+import os
+import re
+
+
+
+# Part 1: Settings of the query session
+
+# Database file to query
+DATABASE_FILE = 'hospital_stay_database.db'
+
+# Number of result rows fetched from the database and displayed at a time; only the pages the user looks at (plus the next
+# one) are fetched, so even a query returning millions of rows shows its first page right away
+PAGE_SIZE = 500
+
+# Number of query results kept in the result cache (the least recently used result is dropped when it is full), and the
+# largest number of rows a result can have to be cached
+RESULT_CACHE_SIZE = 32
+RESULT_CACHE_MAX_ROWS = 10000
+
+# Only queries starting with one of these keywords are cached, and not if they use a function whose result can change
+# between runs
+CACHEABLE_QUERY_KEYWORDS = ('SELECT', 'WITH', 'VALUES')
+NON_DETERMINISTIC_FUNCTION_PATTERN = re.compile(r"\b(random|randomblob|changes|total_changes|last_insert_rowid)\s*\(|'now'",
+                                                re.IGNORECASE)
+
+# Billing summary views (smallest first) with the columns each one groups by and the tables those columns can come from in
+# a query on the hospital stay table, along with the columns each table is joined to the hospital stay table on
+# The date columns are those of the admission date
+SUMMARY_VIEWS = [('billing_by_condition_year', {'patient_medical_condition': ['patient'], 'date_year': ['date']}),
+                 ('billing_by_hospital_quarter', {'hospital_name': ['hospital'], 'date_year': ['date'],
+                                                  'date_quarter': ['date'], 'date_quarter_in_year': ['date']}),
+                 ('billing_by_insurance_month', {'insurance_provider_id': ['hospital_stay', 'insurance'],
+                                                 'insurance_provider_name': ['insurance'], 'date_year': ['date'],
+                                                 'date_quarter': ['date'], 'date_quarter_in_year': ['date'],
+                                                 'date_month': ['date'], 'date_month_name': ['date']})]
+SUMMARY_JOIN_COLUMNS = {'date': ('admission_date', 'date_id'),
+                        'insurance': ('insurance_provider_id', 'insurance_provider_id'),
+                        'hospital': ('hospital_id', 'hospital_id'),
+                        'patient': ('patient_id', 'patient_id')}
+
+# Triggers that keep the billing summary views up to date with every change to the hospital stays (see create_db.py's
+# SUMMARY_TRIGGERS), in the usual and the compact layout
+SUMMARY_TRIGGERS = ('hospital_stay_billing_summary_insert', 'hospital_stay_compact_billing_summary_insert')
+
+# Parts of a query that can be answered from a billing summary view: a GROUP BY query on the hospital stay table (joined to
+# the tables above), whose only aggregates are billing totals, averages, and stay counts
+SUMMARY_QUERY_PATTERN = re.compile(r'^SELECT\s+(?P<select>.+?)\s+FROM\s+(?P<from>.+?)(?:\s+WHERE\s+(?P<where>.+?))?'+
+                                   r'\s+GROUP\s+BY\s+(?P<rest>.+)$', re.IGNORECASE | re.DOTALL)
+SUMMARY_JOIN_PATTERN = re.compile(r'\s+(?:INNER\s+)?JOIN\s+(\w+)(?:\s+(?:AS\s+)?(?!ON\b)(\w+))?\s+ON\s+'+
+                                  r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', re.IGNORECASE)
+SUMMARY_AGGREGATE_PATTERN = re.compile(r'\b(?:(SUM|TOTAL|AVG)\s*\(\s*(?:\w+\s*\.\s*)?billing_amt\s*\)|'+
+                                       r'COUNT\s*\(\s*\*\s*\))', re.IGNORECASE)
+SUMMARY_AGGREGATE_REPLACEMENTS = {'SUM': 'SUM(total_billing_amt)', 'TOTAL': 'TOTAL(total_billing_amt)',
+                                  'AVG': '(SUM(total_billing_amt)/SUM(stay_count))', None: 'SUM(stay_count)'}
+# Words that can appear in the rest of such a query without being column names
+SQL_KEYWORDS = {'AND', 'OR', 'NOT', 'IN', 'IS', 'NULL', 'LIKE', 'GLOB', 'BETWEEN', 'AS', 'ASC', 'DESC', 'HAVING', 'ORDER',
+                'BY', 'LIMIT', 'OFFSET', 'CASE', 'WHEN', 'THEN', 'ELSE', 'END', 'COLLATE', 'NOCASE', 'GROUP'}
+
+# Name searches for each kind of name: the name search table indexing the names (see create_db.py's NAME_SEARCH_TABLES), the
+# dimension table and its ID and name columns
+NAME_SEARCHES = {'patient': ('patient_name_search', 'patient', 'patient_id', 'patient_name'),
+                 'doctor': ('doctor_name_search', 'doctor', 'doctor_id', 'doctor_name')}
+
+# Name search tables only find parts of names at least this many characters long (one trigram); shorter ones are looked for
+# by scanning the dimension table instead
+NAME_SEARCH_MIN_LENGTH = 3
+
+# Query showing every stay of the patients or doctors found by a name search (the matches query, giving their IDs), with the
+# number of stays and the billing total of each patient or doctor, grouped by patient or doctor
+NAME_SEARCH_QUERY = ('WITH matches AS ({matches}) '+
+                     'SELECT p.patient_name, p.patient_birth_date, d.doctor_name, h.hospital_name, hs.admission_date, '+
+                     'hs.discharge_date, hs.billing_amt, '+
+                     'COUNT(*) OVER (PARTITION BY hs.{id_column}) AS {kind}_stay_count, '+
+                     'SUM(hs.billing_amt) OVER (PARTITION BY hs.{id_column}) AS {kind}_total_billing_amt '+
+                     'FROM matches m JOIN hospital_stay hs ON hs.{id_column} = m.id '+
+                     'JOIN patient p ON p.patient_id = hs.patient_id '+
+                     'JOIN doctor d ON d.doctor_id = hs.doctor_id '+
+                     'JOIN hospital h ON h.hospital_id = hs.hospital_id '+
+                     'ORDER BY {name_column}, hs.{id_column}, hs.admission_date;')
+
+
+
+# Part 2: Normalize queries for the result cache
+
+# Function to normalize a query so that queries differing only in whitespace or comments (outside of quoted text) or a
+# trailing semicolon share a result cache entry, returning None if the query should not be cached
+# Comments are removed along with the whitespace around them, since a -- comment ends at the end of its line and collapsing
+# the line break first would comment out the rest of the query
+def normalize_query(query):
+    normalized_query = re.sub(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\[[^\]]*\]|`[^`]*`)|(?:\s|--[^\n]*|/\*.*?(?:\*/|$))+",
+                              lambda match: match.group(1) or ' ', query, flags=re.DOTALL).strip().rstrip(';').strip()
+    if (not normalized_query.upper().startswith(CACHEABLE_QUERY_KEYWORDS) or
+            NON_DETERMINISTIC_FUNCTION_PATTERN.search(normalized_query)):
+        return None
+    return normalized_query
+
+
+
+# Part 3: Run queries on the database
+
+# Query session holding the connection the queries run on, with a cursor for the results, along with the result cache,
+# which maps each normalized query to the names of its result columns and all pages of its result (least recently used
+# query first), the database stamp the cached results belong to, the number of queries found (hits) and not found (misses)
+# in the cache, and whether the billing summary views include every hospital stay, with the database stamp this was last
+# checked for
+# Queries run in a background thread so that the workbench window stays responsive, so the connection is allowed to be used
+# from threads other than the one that created it (only one query runs at a time)
+class QuerySession:
+    def __init__(self, database_file=DATABASE_FILE):
+        self.database_file = database_file
+        self.connection = sqlite3.connect(database_file, check_same_thread=False)
+        self.cursor = self.connection.cursor()
+        self.result_cache = collections.OrderedDict()
+        self.result_cache_stamp = None
+        self.result_cache_hits = 0
+        self.result_cache_misses = 0
+        self.summary_state = {'stamp': None, 'up_to_date': False}
+
+    # Function to get the database stamp, which changes whenever the data in the database may have changed: the data version
+    # changes when another connection commits a change, and the database file's inode and modification time change when the
+    # file is written or rebuilt by create_db.py
+    def get_database_stamp(self):
+        database_file_stats = os.stat(self.database_file)
+        return (self.connection.execute('PRAGMA data_version').fetchone()[0], database_file_stats.st_ino,
+                database_file_stats.st_mtime_ns)
+
+    # Function to empty the result cache if the database has changed since the cached results were stored
+    def check_result_cache(self):
+        database_stamp = self.get_database_stamp()
+        if database_stamp != self.result_cache_stamp:
+            self.result_cache.clear()
+            self.result_cache_stamp = database_stamp
+
+    # Function to get the cached result (its column names and pages) of a normalized query, or None if it is not in the
+    # result cache, counting the hit or miss
+    def get_cached_result(self, query_key):
+        self.check_result_cache()
+        if query_key not in self.result_cache:
+            self.result_cache_misses += 1
+            return None
+        self.result_cache_hits += 1
+        self.result_cache.move_to_end(query_key)
+        return self.result_cache[query_key]
+
+    # Function to add a complete result to the result cache, dropping the least recently used result if it is full
+    def add_to_result_cache(self, query_key, result_columns, pages):
+        if sum(len(page) for page in pages) > RESULT_CACHE_MAX_ROWS:
+            return
+        self.result_cache[query_key] = (result_columns, list(pages))
+        self.result_cache.move_to_end(query_key)
+        while len(self.result_cache) > RESULT_CACHE_SIZE:
+            self.result_cache.popitem(last=False)
+
+    # Function to check whether the billing summary views are up to date with the hospital stay table, i.e. the triggers
+    # that keep them up to date with every change are there and they include as many stays as the table has, none of them
+    # with a stay ID above the last one they include (a database built before the views or the triggers were added has no
+    # summaries or may have changed without them)
+    def summaries_up_to_date(self):
+        database_stamp = self.get_database_stamp()
+        if database_stamp != self.summary_state['stamp']:
+            try:
+                summarized_stays = self.connection.execute('SELECT last_stay_id, stay_count FROM '+
+                                                           'billing_summary_state;').fetchone()
+                stays = self.connection.execute('SELECT MAX(stay_id), COUNT(*) FROM hospital_stay;').fetchone()
+                summary_trigger_count = self.connection.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = "trigger" '+
+                                                                'AND name IN (?, ?);', SUMMARY_TRIGGERS).fetchone()[0]
+                self.summary_state['up_to_date'] = (summary_trigger_count > 0 and summarized_stays is not None and
+                                                    summarized_stays[1] == stays[1] and
+                                                    (stays[0] or 0) <= summarized_stays[0])
+            except sqlite3.OperationalError:
+                self.summary_state['up_to_date'] = False
+            self.summary_state['stamp'] = database_stamp
+        return self.summary_state['up_to_date']
+
+    # Function to get the names of the columns of a table or view, in lower case
+    def get_table_columns(self, table):
+        return {column[1].lower() for column in self.connection.execute('PRAGMA table_info('+table+');').fetchall()}
+
+    # Function to rewrite a query so that it reads the smallest billing summary view that can answer it instead of the
+    # hospital stay table, returning the rewritten query and the view's name (or None and None if no view can answer it)
+    # The aggregates are changed to add up the view's stay counts and billing totals, and each result column keeps the name
+    # it would have had in the original query
+    def rewrite_summary_query(self, query):
+        # Set any quoted text aside (replacing it with its number in quotes) so that it is left as is
+        quoted_texts = []
+        def set_quoted_text_aside(quoted_text_match):
+            quoted_texts.append(quoted_text_match.group(0))
+            return "'"+str(len(quoted_texts)-1)+"'"
+        masked_query = re.sub(r"'(?:[^']|'')*'", set_quoted_text_aside, query.strip().rstrip(';').strip())
+        query_match = SUMMARY_QUERY_PATTERN.match(masked_query)
+        if (query_match is None or any('"' in quoted_text for quoted_text in quoted_texts) or
+                re.search(r'["`\[*]|--|/\*|\(\s*SELECT\b|\b(UNION|INTERSECT|EXCEPT|WINDOW|OVER|DISTINCT)\b',
+                          SUMMARY_AGGREGATE_PATTERN.sub('', masked_query), re.IGNORECASE)):
+            return None, None
+
+        # Find the tables in the FROM clause by name and alias, making sure each one is joined to the hospital stay table
+        # on the column the summary views use
+        from_match = re.match(r'hospital_stay(?:\s+(?:AS\s+)?(?!(?:INNER|JOIN)\b)(\w+))?(.*)$', query_match.group('from'),
+                              re.IGNORECASE | re.DOTALL)
+        if from_match is None:
+            return None, None
+        table_aliases = {'hospital_stay': 'hospital_stay', (from_match.group(1) or 'hospital_stay').lower(): 'hospital_stay'}
+        joins_end = 0
+        for join_match in SUMMARY_JOIN_PATTERN.finditer(from_match.group(2)):
+            table = join_match.group(1).lower()
+            if join_match.start() != joins_end or table not in SUMMARY_JOIN_COLUMNS:
+                return None, None
+            joins_end = join_match.end()
+            table_aliases[table] = table
+            table_aliases[(join_match.group(2) or table).lower()] = table
+            join_sides = {(table_aliases.get(join_match.group(3).lower()), join_match.group(4).lower()),
+                          (table_aliases.get(join_match.group(5).lower()), join_match.group(6).lower())}
+            if join_sides != {('hospital_stay', SUMMARY_JOIN_COLUMNS[table][0]), (table, SUMMARY_JOIN_COLUMNS[table][1])}:
+                return None, None
+        if from_match.group(2)[joins_end:].strip() != '':
+            return None, None
+        joined_tables = set(table_aliases.values())
+
+        # Split the select list into its result columns, finding the ones that have been given a name
+        select_items = re.findall(r'(?:[^,(]|\((?:[^()]|\([^()]*\))*\))+', query_match.group('select'))
+        select_item_names = [re.search(r'(?:\bAS\s+|[\w)\']\s+)(\w+)\s*$', select_item, re.IGNORECASE)
+                             for select_item in select_items]
+        select_item_names = [item_name.group(1) if item_name and item_name.group(1).upper() not in SQL_KEYWORDS else None
+                             for item_name in select_item_names]
+        result_column_names = {item_name.lower() for item_name in select_item_names if item_name is not None}
+
+        # Every column in the query other than the aggregated billing amounts must be one that a summary view groups by,
+        # coming from a joined table that has it
+        column_tables = {}
+        for query_part in [query_match.group('select'), query_match.group('where') or '', query_match.group('rest')]:
+            for table_alias, column, function in re.findall(r'(?:\b(\w+)\s*\.\s*)?\b([A-Za-z_]\w*)\b(\s*\()?',
+                                                            SUMMARY_AGGREGATE_PATTERN.sub('', query_part)):
+                if function or column.upper() in SQL_KEYWORDS or (column.lower() in result_column_names and not table_alias):
+                    continue
+                if table_alias and table_alias.lower() not in table_aliases:
+                    return None, None
+                column_tables.setdefault(column.lower(), set())
+                if table_alias:
+                    column_tables[column.lower()].add(table_aliases[table_alias.lower()])
+        for view, view_columns in SUMMARY_VIEWS:
+            # A column given without a table name must be in only one of the joined tables
+            if all(column in view_columns and (tables <= set(view_columns[column]) if tables else
+                                               len(joined_tables & set(view_columns[column])) == 1)
+                   for column, tables in column_tables.items()):
+                break
+        else:
+            return None, None
+        # A result column named like a column of one of the tables or of the view would stand for something else once the
+        # query is rewritten (e.g. d.date_year AS date_month grouped by date_month groups by the real date_month column in
+        # the query but by the date_year result column on a view without one), so such a query is run as written
+        if any(result_column_names & self.get_table_columns(table) for table in joined_tables | {view}):
+            return None, None
+
+        # Build the rewritten query on the view, with the aggregates replaced and the table names and aliases removed from
+        # the column names; result columns that change this way are named after what they were in the original query
+        def rewrite_query_part(query_part):
+            query_part = SUMMARY_AGGREGATE_PATTERN.sub(lambda aggregate_match: SUMMARY_AGGREGATE_REPLACEMENTS[
+                aggregate_match.group(1) and aggregate_match.group(1).upper()], query_part)
+            return re.sub(r'\b(\w+)\s*\.\s*(?=[A-Za-z_])',
+                          lambda alias_match: '' if alias_match.group(1).lower() in table_aliases else alias_match.group(0),
+                          query_part)
+        rewritten_select_items = []
+        for select_item, select_item_name in zip(select_items, select_item_names):
+            rewritten_select_item = rewrite_query_part(select_item)
+            if (select_item_name is None and rewritten_select_item != select_item and
+                    not re.fullmatch(r'\s*\w+\s*\.\s*\w+\s*', select_item)):
+                rewritten_select_item += ' AS "'+select_item.strip()+'"'
+            rewritten_select_items.append(rewritten_select_item)
+        rewritten_query = 'SELECT '+','.join(rewritten_select_items)+' FROM '+view
+        if query_match.group('where') is not None:
+            rewritten_query += ' WHERE '+rewrite_query_part(query_match.group('where'))
+        rewritten_query += ' GROUP BY '+rewrite_query_part(query_match.group('rest'))
+        # Put the quoted text back
+        return (re.sub(r"'(\d+)'", lambda quoted_text_match: quoted_texts[int(quoted_text_match.group(1))], rewritten_query),
+                view)
+
+    # Function to build the query for a name search of the given kind ('patient' or 'doctor'), returning the query and its
+    # parameters
+    # The name search table is used if the database has one and the name is long enough; otherwise the dimension table is
+    # scanned for names containing it
+    def make_name_search_query(self, kind, name):
+        name_search_table, table, id_column, name_column = NAME_SEARCHES[kind]
+        has_name_search_table = self.connection.execute('SELECT name FROM sqlite_master WHERE name = ?;',
+                                                        (name_search_table,)).fetchone() is not None
+        if has_name_search_table and len(name) >= NAME_SEARCH_MIN_LENGTH:
+            # Search for the name as one phrase (in double quotes), so that it is found as is, spaces and all
+            matches_query = 'SELECT rowid AS id FROM '+name_search_table+' WHERE '+name_search_table+' MATCH ?'
+            parameters = ('"'+name.replace('"', '""')+'"',)
+        else:
+            matches_query = 'SELECT '+id_column+' AS id FROM '+table+' WHERE instr(lower('+name_column+'), lower(?)) > 0'
+            parameters = (name,)
+        return NAME_SEARCH_QUERY.format(matches=matches_query, id_column=id_column, kind=kind,
+                                        name_column=('p.' if kind == 'patient' else 'd.')+name_column), parameters
+
+    # Function to execute a query (with the given parameters, if any) and fetch the first page of its result, returning the
+    # names of the result columns and the first page of rows
+    # Statements such as INSERT and DELETE have no result columns, so their changes are committed, the result cache is
+    # emptied and its database stamp forgotten, the billing summary views are checked again before they are next used, and
+    # the number of rows they changed is returned instead (the database stamp does not change when this connection writes to
+    # a database in WAL mode)
+    def execute_query(self, query, parameters=()):
+        self.cursor.execute(query, parameters)
+        if self.cursor.description is None:
+            self.connection.commit()
+            self.result_cache.clear()
+            self.result_cache_stamp = None
+            self.summary_state['stamp'] = None
+            return ['Result'], [('Statement executed; '+str(self.cursor.rowcount)+' row(s) changed',)]
+        return [column[0] for column in self.cursor.description], self.cursor.fetchmany(PAGE_SIZE)
+
+    # Function to fetch the next page of the result of the last query executed
+    def fetch_page(self):
+        return self.cursor.fetchmany(PAGE_SIZE)
+
+    # Function to close the cursor and the connection
+    def close(self):
+        self.cursor.close()
+        self.connection.close()
@@ -3,8 +3,23 @@
 # Please see Readme for more info
 
 # This code causes the database to be built if it has not been already and then creates and displays a user interface window
-# in which the user can type a query. If the query is written correctly, the data will be displayed in a new interface window.
-# Then the user can choose to run as many additional queries as they would like or to quit.
+# (the query workbench) in which the user can type a query. If the query is written correctly, the data will be displayed
+# below it in the same window; if not, the error is shown above the result. The user can then run as many additional queries
+# as they would like or quit. Queries run in the background, so the window shows how long a query has been running and the
+# Cancel button stops a query that is taking too long. Each query that runs successfully is added to the history list on the
+# left, and clicking a query there puts it back in the query box. Results of recent queries are kept in a cache, so running
+# the same query again shows its result right away unless the database has changed since. Queries that add up billing amounts
+# or count stays by insurance provider, hospital, medical condition, and/or admission date period are answered from the billing
+# summary views that create_db.py keeps, which is much faster than going through every hospital stay. The Export button saves
+# the whole result of the query in the query box to a CSV file (compressed if its name ends in .gz) without showing it, a
+# batch of rows at a time, so even results far too big to page through can be exported (see export_query.py). To look up a
+# patient or doctor by part of their name, type it in the name box and click Find patients or Find doctors; every stay of
+# the matching patients (or doctors) is shown along with each one's number of stays and billing total, using the name search
+# tables create_db.py builds.
+
+# To find out why a query is slow, set the HOSPITAL_STAY_LOG_FILE environment variable to a log file before running this code;
+# each query is then logged with its time, CPU time, and number of rows, along with its query plan if it is slow (see
+# instrumentation.py).
 
 # If you run this code (or any code that connects to the database) but have an error pop up, make sure both the cursor and the
 # connection are closed before you run any code again. You can do this by running cursor.close() and then connection.close()
@@ -20,11 +35,23 @@
 # N.B.: Only uncomment the subprocess lines if you would like to rebuild the database! Keep the code as is if you simply wish
 # to query the already built and loaded database.
 
-# Import packages - subprocess for running the database creation code (if applicable), sqlite3 for running the database, and
-# tkinter for creating and running the user interface
+# Import packages - subprocess for running the database creation code (if applicable), sqlite3 for running the database,
+# tkinter (including its ttk module for the result grid) for creating and running the user interface, threading and time
+# for running queries in the background and showing how long they have been running, os for the name of the export file,
+# query_session for running the queries (with the result cache and the billing summary views), instrumentation for logging
+# the queries (if the HOSPITAL_STAY_LOG_FILE environment variable is set), and export_query (along with tkinter's filedialog
+# module for choosing the file) for exporting query results
 #import subprocess
 import sqlite3
 import tkinter as tk
+from tkinter import ttk
+from tkinter import filedialog
+import threading
+import time
+import os
+import query_session
+import instrumentation
+import export_query
 
 
 
@@ -35,104 +62,407 @@ import tkinter as tk
 
 # Part 2: Enable user to run queries on the database
 
-# Create connection to the database hospital_stay_database
-connection = sqlite3.connect('hospital_stay_database.db') 
-# Also create a cursor from this connection to collect user query results
-cursor = connection.cursor()
-
-# Define variable to indicate whether a Quit button has been clicked
-quit_button_clicked = False
-# Define function to set this variable to true; each Quit button will execute this function when clicked
-def set_quit_var_to_true():
-    global quit_button_clicked
-    quit_button_clicked = True
-
-# Keep running interface windows until a Quit button is clicked
-while quit_button_clicked == False:
-    # Create the window where the user will enter the query
-    enter_query_window = tk.Tk()
-    enter_query_window.wm_iconbitmap('Icon/database_exe_icon.ico')
-    enter_query_window.title('Enter a query')
-    enter_query_window.geometry('500x250+500+250')
-    window_text = tk.Label(enter_query_window, text='Please enter a SQL query below.\nTo exit the program, click Quit at any'+
-                           ' time.', font=('Arial', 15))
-    window_text.place(x=60, y=30)
-    # Text box for query entry
-    query_entry_box = tk.Text(enter_query_window, width=55, height=6)
-    query_entry_box.place(x=18, y=85)
-    
-    # Define a variable and a function to get the query that has been entered in the text box; activated by clicking OK button
-    def get_query():
-        global query_str
-        query_str = query_entry_box.get('1.0', 'end-1c')
-    ok_button = tk.Button(enter_query_window, text='OK', width=15, command=lambda: [get_query(),
-                                                                                    enter_query_window.destroy()])
-    ok_button.place(x=70, y=200)
-    quit_button = tk.Button(enter_query_window, text='Quit', width=15, command=lambda: [set_quit_var_to_true(),
-                                                                                 enter_query_window.destroy()])
-    quit_button.place(x=290, y=200)
-    enter_query_window.mainloop()
-    
-    # If Quit has been clicked, end all interface window processes
-    if quit_button_clicked == True:
-        break
-    
-    # Try to execute the query given by the user; if the query is invalid, an error window will pop up
-    try:
-        if query_str == '': # If no query given, prompt the user again
-            continue
-        cursor.execute(query_str)
-    except:
-        # Create error window
-        invalid_query_window = tk.Tk()
-        invalid_query_window.wm_iconbitmap('Icon/database_exe_icon.ico')
-        invalid_query_window.title('Invalid query')
-        invalid_query_window.geometry('500x200+500+250')
-        window_text = tk.Label(invalid_query_window, text="Unfortunately, the query you entered was invalid.\nPlease "+
-                               "enter a valid one instead.\n(See readme for query examples)", font=('Arial', 15))
-        window_text.place(x=30, y=20)
-        ok_button = tk.Button(invalid_query_window, text='OK', width=15, command=invalid_query_window.destroy)
-        ok_button.place(x=70, y=160)
-        quit_button = tk.Button(invalid_query_window, text='Quit', width=15, command=lambda: [set_quit_var_to_true(),
-                                                                                     invalid_query_window.destroy()])
-        quit_button.place(x=290, y=160)
-        invalid_query_window.mainloop()
-        
-        if quit_button_clicked == True:
-            break
-        
-        continue # Skip trying to display the query result if the query was invalid
-    
-    # Store query result rows in text form in query_result_text
-    data = cursor.fetchall()
-    query_result_text = ''
-    for record in data:
-        query_result_text += str(record) + '\n'
-    
-    # Create the query result display window
-    result_display_window = tk.Tk()
-    result_display_window.wm_iconbitmap('Icon/database_exe_icon.ico')
-    result_display_window.title('Query result')
-    result_display_window.geometry('700x500+400+200')
-    result_display_box = tk.Text(result_display_window, state='normal', width=86, height=27)
-    result_display_box.insert('1.0', query_result_text)
-    result_display_box.config(state='disabled') # Make the textbox for displaying the result read-only
-    result_display_box.grid(row=0, column=0)
-    connection.commit()
-    ok_button = tk.Button(result_display_window, text='OK', width=15, command=result_display_window.destroy)
-    ok_button.place(x=170, y=450)
-    quit_button = tk.Button(result_display_window, text='Quit', width=15, command=lambda: [set_quit_var_to_true(),
-                                                                                 result_display_window.destroy()])
-    quit_button.place(x=390, y=450)
-    result_display_window.mainloop()
+# Number of SQLite virtual machine instructions between calls to the progress handler, and number of milliseconds between
+# checks on a query running in the background
+PROGRESS_HANDLER_INSTRUCTIONS = 100000
+POLL_INTERVAL = 20
+
+# Number of queries kept in the query history list
+HISTORY_SIZE = 50
+
+DATABASE_FILE = 'hospital_stay_database.db'
+
+# Create the query session on the database hospital_stay_database, which holds the connection the queries run on, the cursor
+# that collects their results, and the result cache (see query_session.py)
+session = query_session.QuerySession(DATABASE_FILE)
+connection = session.connection
+cursor = session.cursor
+
+# Define variable to count the progress handler calls for the query running in the background, and the progress handler
+# itself, which SQLite calls every PROGRESS_HANDLER_INSTRUCTIONS instructions while running a query
+progress_handler_calls = 0
+def count_progress():
+    global progress_handler_calls
+    progress_handler_calls += 1
+    return 0 # Returning anything other than 0 would stop the query
+connection.set_progress_handler(count_progress, PROGRESS_HANDLER_INSTRUCTIONS)
+
+# Define function to run a job (e.g. executing a query) in a background thread, returning a dictionary that will hold the
+# thread, the start time, the job's result or the error it raised, and, once it has finished, the time and the CPU time (of
+# the background thread) it took in seconds
+def start_background_job(job):
+    global progress_handler_calls
+    progress_handler_calls = 0
+    background_job = {'result': None, 'error': None, 'start_time': time.perf_counter()}
+    def run_job():
+        start_cpu_time = time.thread_time()
+        try:
+            background_job['result'] = job()
+        except Exception as error:
+            background_job['error'] = error
+        background_job['seconds'] = time.perf_counter()-background_job['start_time']
+        background_job['cpu_seconds'] = time.thread_time()-start_cpu_time
+    background_job['thread'] = threading.Thread(target=run_job, daemon=True)
+    background_job['thread'].start()
+    return background_job
+
+# Define function to check on a background job every POLL_INTERVAL milliseconds, calling show_progress with the elapsed time
+# in seconds while it is running and on_done with the job once it has finished
+def wait_for_background_job(window, background_job, show_progress, on_done):
+    if background_job['thread'].is_alive():
+        show_progress(time.perf_counter()-background_job['start_time'])
+        window.after(POLL_INTERVAL, wait_for_background_job, window, background_job, show_progress, on_done)
+    else:
+        on_done(background_job)
+
+# Define function to stop a background job that is still running and wait for its thread to finish; a job running on a
+# connection other than the main one (e.g. an export) has it stored as the job's connection
+def stop_background_job(background_job):
+    if background_job is not None and background_job['thread'].is_alive():
+        background_job.get('connection', connection).interrupt()
+        background_job['thread'].join()
+
+# Create the query workbench window, which stays open until the Quit button is clicked
+workbench_window = tk.Tk()
+workbench_window.wm_iconbitmap('Icon/database_exe_icon.ico')
+workbench_window.title('Hospital stay database')
+workbench_window.geometry('1000x650+250+100')
+workbench_window.minsize(700, 500)
+workbench_window.grid_rowconfigure(5, weight=1)
+workbench_window.grid_columnconfigure(1, weight=1)
+
+# Query history list on the left, with the most recent query at the top
+history_label = tk.Label(workbench_window, text='Query history', font=('Arial', 11))
+history_label.grid(row=0, column=0, sticky='w', padx=10, pady=(10, 0))
+history_list = tk.Listbox(workbench_window, width=35, exportselection=False)
+history_list.grid(row=1, column=0, rowspan=6, sticky='nsew', padx=10, pady=(0, 10))
+
+# Text box for query entry, with the buttons for running the query, cancelling it, and quitting below it
+window_text = tk.Label(workbench_window, text='Please enter a SQL query below and click Run (or press Ctrl+Enter), or '+
+                       'click Export to save its whole result to a CSV file.\nTo exit the program, click Quit at any time.',
+                       font=('Arial', 13), justify='left')
+window_text.grid(row=0, column=1, sticky='w', pady=(10, 0))
+query_entry_box = tk.Text(workbench_window, height=6)
+query_entry_box.grid(row=1, column=1, sticky='ew', padx=(0, 10))
+button_frame = tk.Frame(workbench_window)
+button_frame.grid(row=2, column=1, sticky='ew', pady=5)
+run_button = tk.Button(button_frame, text='Run', width=12)
+run_button.grid(row=0, column=0, padx=(0, 10))
+export_button = tk.Button(button_frame, text='Export...', width=12)
+export_button.grid(row=0, column=1, padx=(0, 10))
+cancel_button = tk.Button(button_frame, text='Cancel', width=12, state='disabled', command=connection.interrupt)
+cancel_button.grid(row=0, column=2, padx=(0, 10))
+quit_button = tk.Button(button_frame, text='Quit', width=12)
+quit_button.grid(row=0, column=3, padx=(0, 10))
+# Label for showing how long the query has been running, or how long it took
+progress_label = tk.Label(button_frame, text='', font=('Arial', 10))
+progress_label.grid(row=0, column=4, sticky='w')
+# Box for entering part of a name to search for, with the buttons for finding the patients or doctors with that name
+name_label = tk.Label(button_frame, text='Name:', font=('Arial', 11))
+name_label.grid(row=1, column=0, sticky='e', padx=(0, 10), pady=(5, 0))
+name_entry_box = tk.Entry(button_frame, width=30)
+name_entry_box.grid(row=1, column=1, columnspan=2, sticky='ew', padx=(0, 10), pady=(5, 0))
+find_patients_button = tk.Button(button_frame, text='Find patients', width=12)
+find_patients_button.grid(row=1, column=3, padx=(0, 10), pady=(5, 0))
+find_doctors_button = tk.Button(button_frame, text='Find doctors', width=12)
+find_doctors_button.grid(row=1, column=4, sticky='w', pady=(5, 0))
+
+# Label for showing the error if the query was invalid
+error_label = tk.Label(workbench_window, text='', font=('Arial', 11), fg='red', justify='left', anchor='w')
+error_label.grid(row=3, column=1, sticky='ew')
+
+# Label and buttons for moving between pages of the result
+page_frame = tk.Frame(workbench_window)
+page_frame.grid(row=4, column=1, sticky='ew')
+previous_page_button = tk.Button(page_frame, text='< Previous', width=12, state='disabled')
+previous_page_button.grid(row=0, column=0)
+page_label = tk.Label(page_frame, text='', font=('Arial', 11))
+page_label.grid(row=0, column=1, padx=10)
+next_page_button = tk.Button(page_frame, text='Next >', width=12, state='disabled')
+next_page_button.grid(row=0, column=2)
+# Label for showing how many queries have been found in the result cache
+result_cache_label = tk.Label(page_frame, text='Result cache: 0 hits, 0 misses', font=('Arial', 10))
+result_cache_label.grid(row=0, column=3, padx=(30, 0))
+
+# Create the grid for displaying the result, with one column per result column and scrollbars in both directions
+result_grid_frame = tk.Frame(workbench_window)
+result_grid_frame.grid_rowconfigure(0, weight=1)
+result_grid_frame.grid_columnconfigure(0, weight=1)
+result_grid_frame.grid(row=5, column=1, rowspan=2, sticky='nsew', padx=(0, 10), pady=(5, 10))
+result_grid = ttk.Treeview(result_grid_frame, show='headings')
+result_grid_vertical_scrollbar = ttk.Scrollbar(result_grid_frame, orient='vertical', command=result_grid.yview)
+result_grid_horizontal_scrollbar = ttk.Scrollbar(result_grid_frame, orient='horizontal', command=result_grid.xview)
+result_grid.configure(yscrollcommand=result_grid_vertical_scrollbar.set, xscrollcommand=result_grid_horizontal_scrollbar.set)
+result_grid.grid(row=0, column=0, sticky='nsew')
+result_grid_vertical_scrollbar.grid(row=0, column=1, sticky='ns')
+result_grid_horizontal_scrollbar.grid(row=1, column=0, sticky='ew')
+
+# Define variables for the background jobs running the current query, fetching the next page of its result, and exporting a
+# query result, the number of rows the export has written so far, the queries in the history list, the names of the current
+# result columns, the pages of the current result fetched so far, and the result cache key of the current query (None once
+# its result has been cached or if it should not be cached)
+query_job = None
+page_job = None
+export_job = None
+export_progress = {'rows': 0}
+query_history = []
+result_columns = []
+result_pages = []
+result_cache_key = None
+
+# Define function to add a query to the top of the history list (moving it there if it is already in the list)
+def add_to_history(query):
+    if query in query_history:
+        history_list.delete(query_history.index(query))
+        query_history.remove(query)
+    query_history.insert(0, query)
+    history_list.insert(0, ' '.join(query.split()))
+    if len(query_history) > HISTORY_SIZE:
+        query_history.pop()
+        history_list.delete(HISTORY_SIZE)
+
+# Define function to put the query clicked in the history list back in the query box
+def load_query_from_history(event=None):
+    if history_list.curselection():
+        query_entry_box.delete('1.0', 'end')
+        query_entry_box.insert('1.0', query_history[history_list.curselection()[0]])
+
+# Define function to display a new result in the grid, setting up one column per result column; pages holds the pages of
+# the result fetched so far (all of them for a cached result)
+def show_result(columns, pages):
+    result_columns[:] = columns
+    result_pages[:] = pages
+    result_grid.delete(*result_grid.get_children())
+    result_grid.configure(columns=[str(column_number) for column_number in range(len(result_columns))],
+                          displaycolumns='#all')
+    for column_number, column_name in enumerate(result_columns):
+        # Make each column wide enough for its name and the values on the first page (within limits)
+        column_text_length = max([len(str(column_name))]+[len(str(record[column_number])) for record in result_pages[0]])
+        result_grid.heading(str(column_number), text=column_name)
+        result_grid.column(str(column_number), width=min(max(column_text_length*8+20, 60), 400), stretch=False)
+    show_result_page(0)
+
+# Define function to display a page of the result in the grid; the page after it is then fetched from the database ahead of
+# time (if the current page is full) so that the Next button is only enabled when there are more rows
+# Fetching a page can take a while for a slow query, so it is done in the background and the Next button is enabled once it
+# is ready
+# Once the last page has been fetched (i.e., one that is not full), the whole result is added to the result cache
+def show_result_page(page_number):
+    global page_job
+    result_grid.delete(*result_grid.get_children())
+    for record in result_pages[page_number]:
+        result_grid.insert('', 'end', values=record)
+    first_row_number = page_number*query_session.PAGE_SIZE
+    if len(result_pages[page_number]) == 0:
+        page_label.config(text='No rows')
+    else:
+        page_label.config(text='Rows '+str(first_row_number+1)+'-'+str(first_row_number+len(result_pages[page_number])))
+    previous_page_button.config(state='normal' if page_number > 0 else 'disabled',
+                                command=lambda: show_result_page(page_number-1))
+    next_page_button.config(state='disabled', command=lambda: show_result_page(page_number+1))
     
-    if quit_button_clicked == True:
-        break
+    def enable_next_page_button(background_job=None):
+        global result_cache_key
+        if background_job is not None and background_job is not page_job: # Page of a result no longer shown
+            return
+        if background_job is not None:
+            result_pages.append(background_job['result'] or [])
+        if page_number+1 < len(result_pages) and len(result_pages[page_number+1]) > 0:
+            next_page_button.config(state='normal')
+        if result_cache_key is not None and len(result_pages[-1]) < query_session.PAGE_SIZE:
+            session.add_to_result_cache(result_cache_key, result_columns, result_pages)
+            result_cache_key = None
+    if page_number+1 == len(result_pages) and len(result_pages[page_number]) == query_session.PAGE_SIZE:
+        page_job = start_background_job(session.fetch_page)
+        wait_for_background_job(workbench_window, page_job, lambda elapsed_time: None, enable_next_page_button)
+    else:
+        enable_next_page_button()
+
+# Define functions to show the progress of the query running in the background and to show its result (or error) once it
+# has finished
+def show_query_progress(elapsed_time):
+    progress_label.config(text='Running query... '+format(elapsed_time, '.1f')+' s, '+
+                               format(progress_handler_calls*PROGRESS_HANDLER_INSTRUCTIONS/1000000, '.1f')+' million steps')
+def finish_query(background_job):
+    global result_cache_key
+    set_query_buttons_state('normal')
+    cancel_button.config(state='disabled')
+    if background_job['error'] is None:
+        if background_job['name_search'] is None:
+            progress_label.config(text='Query finished in '+format(background_job['seconds'], '.2f')+' s'+
+                                       (' (answered from '+background_job['summary_view']+')'
+                                        if background_job['summary_view'] else ''))
+            add_to_history(background_job['query'])
+        else:
+            progress_label.config(text='Name search finished in '+format(background_job['seconds'], '.2f')+' s')
+        # Only results with columns are cached, since a write statement (which can also start with WITH) must run every time
+        result_cache_key = background_job['cache_key'] if cursor.description is not None else None
+        result_columns, first_result_page = background_job['result']
+        # Log the query (with its query plan if it was slow) before the next page is fetched in the background
+        instrumentation.log_query(connection, background_job['query_run'], background_job['seconds'],
+                                  background_job['cpu_seconds'], len(first_result_page), background_job['parameters'],
+                                  summary_view=background_job['summary_view'], name_search=background_job['name_search'])
+        show_result(result_columns, [first_result_page])
+    # If the query was cancelled, let the user edit it or enter another one
+    elif isinstance(background_job['error'], sqlite3.OperationalError) and str(background_job['error']) == 'interrupted':
+        progress_label.config(text='Query cancelled')
+        instrumentation.log_query(connection, background_job['query_run'], background_job['seconds'],
+                                  background_job['cpu_seconds'], 0, background_job['parameters'], cancelled=True)
+    # If the query was invalid, show the error
+    else:
+        instrumentation.log_event('query', sql=background_job['query_run'], error=str(background_job['error']))
+        progress_label.config(text='')
+        error_label.config(text='Unfortunately, the query you entered was invalid ('+str(background_job['error'])+
+                                ').\nPlease enter a valid one instead. (See readme for query examples)')
+
+# Define function to enable or disable the buttons that start a query, an export, or a name search, so that only one runs
+# at a time
+def set_query_buttons_state(state):
+    for query_button in [run_button, export_button, find_patients_button, find_doctors_button]:
+        query_button.config(state=state)
+
+# Define function to run the query entered in the text box in the background; activated by clicking the Run button
+# If the query's result is in the result cache (and the database has not changed since it was stored), it is shown right
+# away instead
+def run_query(event=None):
+    global query_job, page_job, result_cache_key
+    query_str = query_entry_box.get('1.0', 'end-1c')
+    if query_str.strip() == '' or str(run_button.cget('state')) == 'disabled': # If no query given, wait for one
+        return 'break'
+    # Stop fetching the next page of the previous result, since the cursor is about to be reused
+    stop_background_job(page_job)
+    page_job = None
+    result_cache_key = None
+    error_label.config(text='')
+    query_key = query_session.normalize_query(query_str)
+    if query_key is not None:
+        cached_result = session.get_cached_result(query_key)
+        result_cache_label.config(text='Result cache: '+str(session.result_cache_hits)+' hits, '+
+                                       str(session.result_cache_misses)+' misses')
+        if cached_result is not None:
+            progress_label.config(text='Result taken from the result cache')
+            instrumentation.log_event('query', sql=query_str, seconds=0.0, cpu_seconds=0.0,
+                                      rows=sum(len(page) for page in cached_result[1]), from_result_cache=True)
+            add_to_history(query_str)
+            show_result(*cached_result)
+            return 'break'
+    # Run the query on a billing summary view instead if one can answer it
+    query_to_run, summary_view = None, None
+    if query_key is not None and session.summaries_up_to_date():
+        query_to_run, summary_view = session.rewrite_summary_query(query_str)
+    set_query_buttons_state('disabled')
+    cancel_button.config(state='normal')
+    query_job = start_background_job(lambda: session.execute_query(query_to_run or query_str))
+    query_job['query'] = query_str
+    query_job['query_run'] = query_to_run or query_str
+    query_job['parameters'] = ()
+    query_job['summary_view'] = summary_view
+    query_job['cache_key'] = query_key
+    query_job['name_search'] = None
+    wait_for_background_job(workbench_window, query_job, show_query_progress, finish_query)
+    return 'break' # Keep Ctrl+Enter from adding a new line to the query
+
+# Define function to show every stay of the patients or doctors (depending on kind) whose names contain the text entered in
+# the name box, running the search in the background like a query; activated by clicking the Find patients or Find doctors
+# button (or pressing Enter in the name box to find patients)
+def find_name(kind, event=None):
+    global query_job, page_job, result_cache_key
+    name = name_entry_box.get().strip()
+    if name == '' or str(run_button.cget('state')) == 'disabled': # If no name given, wait for one
+        return 'break'
+    # Stop fetching the next page of the previous result, since the cursor is about to be reused
+    stop_background_job(page_job)
+    page_job = None
+    result_cache_key = None
+    error_label.config(text='')
+    name_search_query, parameters = session.make_name_search_query(kind, name)
+    set_query_buttons_state('disabled')
+    cancel_button.config(state='normal')
+    query_job = start_background_job(lambda: session.execute_query(name_search_query, parameters))
+    query_job['query'] = name_search_query
+    query_job['query_run'] = name_search_query
+    query_job['parameters'] = parameters
+    query_job['summary_view'] = None
+    query_job['cache_key'] = None
+    query_job['name_search'] = name
+    wait_for_background_job(workbench_window, query_job, show_query_progress, finish_query)
+    return 'break'
+
+# Define functions to show the progress of the export running in the background and to show how it went once it has finished
+def show_export_progress(elapsed_time):
+    progress_label.config(text='Exporting... '+format(elapsed_time, '.1f')+' s, '+str(export_progress['rows'])+' rows')
+def finish_export(background_job):
+    set_query_buttons_state('normal')
+    cancel_button.config(state='disabled', command=connection.interrupt)
+    if background_job['error'] is None:
+        progress_label.config(text='Exported '+str(background_job['result'])+' rows to '+
+                                   os.path.basename(background_job['export_file'])+' in '+
+                                   format(background_job['seconds'], '.2f')+' s')
+        add_to_history(background_job['query'])
+        instrumentation.log_query(background_job['connection'], background_job['query'], background_job['seconds'],
+                                  background_job['cpu_seconds'], background_job['result'],
+                                  export_file=background_job['export_file'])
+    elif isinstance(background_job['error'], sqlite3.OperationalError) and str(background_job['error']) == 'interrupted':
+        progress_label.config(text='Export cancelled')
+    else:
+        instrumentation.log_event('query', sql=background_job['query'], error=str(background_job['error']),
+                                  export_file=background_job['export_file'])
+        progress_label.config(text='')
+        error_label.config(text='Unfortunately, the result of the query you entered could not be exported ('+
+                                str(background_job['error'])+').\nPlease enter a valid one instead. (See readme for '+
+                                'query examples)')
+    background_job['connection'].close()
+
+# Define function to export the whole result of the query entered in the text box to a CSV file chosen by the user, in the
+# background; activated by clicking the Export button
+# The export runs on its own read-only connection, so the result shown in the grid can still be paged through meanwhile, and
+# the Cancel button stops the export instead of a query
+def export_result(event=None):
+    global export_job
+    query_str = query_entry_box.get('1.0', 'end-1c')
+    if query_str.strip() == '' or str(export_button.cget('state')) == 'disabled': # If no query given, wait for one
+        return 'break'
+    export_file = filedialog.asksaveasfilename(parent=workbench_window, title='Export query result',
+                                               defaultextension='.csv',
+                                               filetypes=[('CSV file', '*.csv'), ('Compressed CSV file', '*.csv.gz'),
+                                                          ('All files', '*.*')])
+    if not export_file:
+        return 'break'
+    error_label.config(text='')
+    export_connection = export_query.open_export_connection(DATABASE_FILE)
+    export_progress['rows'] = 0
+    set_query_buttons_state('disabled')
+    cancel_button.config(state='normal', command=export_connection.interrupt)
+    export_job = start_background_job(lambda: export_query.export_query(
+        export_connection, query_str, export_file, lambda row_count: export_progress.update(rows=row_count)))
+    export_job['connection'] = export_connection
+    export_job['query'] = query_str
+    export_job['export_file'] = export_file
+    wait_for_background_job(workbench_window, export_job, show_export_progress, finish_export)
+    return 'break'
+
+# Define function to stop any background jobs and close the window; activated by clicking the Quit button
+def quit_workbench():
+    stop_background_job(query_job)
+    stop_background_job(page_job)
+    stop_background_job(export_job)
+    workbench_window.destroy()
+
+run_button.config(command=run_query)
+export_button.config(command=export_result)
+find_patients_button.config(command=lambda: find_name('patient'))
+find_doctors_button.config(command=lambda: find_name('doctor'))
+name_entry_box.bind('<Return>', lambda event: find_name('patient', event))
+quit_button.config(command=quit_workbench)
+query_entry_box.bind('<Control-Return>', run_query)
+history_list.bind('<<ListboxSelect>>', load_query_from_history)
+workbench_window.protocol('WM_DELETE_WINDOW', quit_workbench)
+query_entry_box.focus_set()
+workbench_window.mainloop()
 
 
 
 # Part 3: End any remaining active processes
 
 # Close the cursor and the connection
-cursor.close()
-connection.close()
+session.close()
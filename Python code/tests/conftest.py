@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Shared setup for the tests: the code in the "Python code" folder is imported as is, and the tests run from the project
+# folder, since the code reads the name dataset from "Data files/name_dataset.csv" there
+
+# Import packages - os and sys for finding the code and the project folder, pytest for the fixtures, and create_db and
+# generate_stay_data for building a test database
+import os
+import sys
+import pytest
+
+CODE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_FOLDER = os.path.dirname(CODE_FOLDER)
+sys.path.insert(0, CODE_FOLDER)
+import create_db
+import generate_stay_data
+
+# Number of made-up stays the shared test database is built from
+TEST_DATABASE_STAY_COUNT = 5000
+
+# Run each test from the project folder
+@pytest.fixture(autouse=True)
+def project_folder(monkeypatch):
+    monkeypatch.chdir(PROJECT_FOLDER)
+    return PROJECT_FOLDER
+
+# Database built once for all the tests that only read it, from TEST_DATABASE_STAY_COUNT made-up stays
+@pytest.fixture(scope='session')
+def test_database(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('test_database')
+    working_folder = os.getcwd()
+    os.chdir(PROJECT_FOLDER)
+    try:
+        generate_stay_data.save_generated_stay_data(TEST_DATABASE_STAY_COUNT, str(folder/'stays.csv'))
+        create_db.build_database(str(folder/'hospital_stay_database.db'), create_db.CHUNK_SIZE, str(folder/'stays.csv'),
+                                 str(folder/'cleaned.csv'), str(folder/'cleaned.npz'))
+    finally:
+        os.chdir(working_folder)
+    return str(folder/'hospital_stay_database.db')
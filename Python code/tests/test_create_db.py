@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Tests of building the database with create_db.py, on made-up stays from generate_stay_data.py
+
+# Import packages - os for finding the test database's stay data, sqlite3 for reading the built databases, pytest for
+# checking errors, and the code being tested
+import os
+import sqlite3
+import pytest
+import create_db
+import generate_stay_data
+
+# Number of made-up stays to build the test databases from
+STAY_COUNT = 20000
+
+# Function to build a database from the given stay CSV in the given folder with the given chunk size, returning its path
+def build_test_database(folder, stay_data_file, chunk_size):
+    database_file = str(folder/('hospital_stay_database_'+str(chunk_size)+'.db'))
+    create_db.build_database(database_file, chunk_size, stay_data_file, str(folder/'cleaned.csv'), str(folder/'cleaned.npz'),
+                             use_cache=False)
+    return database_file
+
+# The date table covers the same dates whether the stays are loaded in one chunk or many
+def test_date_table_does_not_depend_on_chunk_size(tmp_path):
+    stay_data_file = str(tmp_path/'stays.csv')
+    generate_stay_data.save_generated_stay_data(STAY_COUNT, stay_data_file)
+    date_tables = []
+    for chunk_size in [100000, 3000]:
+        connection = sqlite3.connect(build_test_database(tmp_path, stay_data_file, chunk_size))
+        date_tables.append(connection.execute('SELECT * FROM date ORDER BY date_id;').fetchall())
+        connection.close()
+    assert len(date_tables[0]) > 0
+    assert date_tables[0] == date_tables[1]
+
+# A build that fails while saving the cleaned data cache does not leave the cache's temporary file behind
+def test_failed_build_removes_temporary_cache_file(tmp_path):
+    stay_data_file = str(tmp_path/'stays.csv')
+    generate_stay_data.save_generated_stay_data(1000, stay_data_file)
+    def fail_partway(stay_data_chunks):
+        yield next(stay_data_chunks)
+        raise ValueError('failed partway')
+    stay_data_chunks = create_db.save_stay_data_cache(fail_partway(create_db.read_stay_data(stay_data_file, 500)),
+                                                      str(tmp_path/'cleaned.npz'), None)
+    with pytest.raises(ValueError):
+        for stay_data in stay_data_chunks:
+            pass
+    assert not (tmp_path/'cleaned.npz.building').exists()
+    assert not (tmp_path/'cleaned.npz').exists()
+
+# A cleaned data cache made by an older version of the cleaning code is not used; the data is cleaned again and the cache
+# replaced
+def test_cache_from_older_cleaning_code_is_not_used(tmp_path, monkeypatch):
+    stay_data_file = str(tmp_path/'stays.csv')
+    generate_stay_data.save_generated_stay_data(1000, stay_data_file)
+    cache_file = str(tmp_path/'cleaned.npz')
+    def build_with_cache():
+        create_db.build_database(str(tmp_path/'hospital_stay_database.db'), create_db.CHUNK_SIZE, stay_data_file,
+                                 str(tmp_path/'cleaned.csv'), cache_file)
+        return create_db.read_stay_data_cache_metadata(cache_file)['stay_data_hash']
+    old_stay_data_hash = build_with_cache()
+    assert build_with_cache() == old_stay_data_hash
+    monkeypatch.setattr(create_db, 'CLEANED_DATA_VERSION', create_db.CLEANED_DATA_VERSION+1)
+    assert build_with_cache() == create_db.get_stay_data_hash(stay_data_file) != old_stay_data_hash
+
+# Ingesting the same cleaned stays a second time adds nothing, and partially cleaned stays are not ingested at all
+def test_ingest_adds_cleaned_stays_once(tmp_path):
+    stay_data_file = str(tmp_path/'stays.csv')
+    generate_stay_data.save_generated_stay_data(5000, stay_data_file)
+    database_file = build_test_database(tmp_path, stay_data_file, create_db.CHUNK_SIZE)
+    new_stay_data_file = str(tmp_path/'new_stays.csv')
+    generate_stay_data.save_generated_stay_data(1000, new_stay_data_file, random_seed=1)
+    cleaned_new_stay_data_file = str(tmp_path/'new_stays_cleaned.csv')
+    assert create_db.clean_stay_data_file(new_stay_data_file, cleaned_new_stay_data_file, 300) == 1000
+    connection = sqlite3.connect(database_file)
+    with pytest.raises(ValueError):
+        create_db.ingest_stays(connection, new_stay_data_file)
+    load_counts, skipped_stay_count = create_db.ingest_stays(connection, cleaned_new_stay_data_file)
+    assert load_counts['hospital_stay'] == 1000 and skipped_stay_count == 0
+    load_counts, skipped_stay_count = create_db.ingest_stays(connection, cleaned_new_stay_data_file)
+    assert load_counts['hospital_stay'] == 0 and skipped_stay_count == 1000
+    assert connection.execute('SELECT COUNT(*) FROM hospital_stay;').fetchone()[0] == 6000
+    connection.close()
+
+# The billing summaries follow every change made to the stays after they are loaded, not only the stays an ingest adds
+def test_billing_summaries_follow_changes_to_stays(tmp_path):
+    stay_data_file = str(tmp_path/'stays.csv')
+    generate_stay_data.save_generated_stay_data(STAY_COUNT, stay_data_file)
+    connection = sqlite3.connect(build_test_database(tmp_path, stay_data_file, create_db.CHUNK_SIZE))
+    summary_query = ('SELECT date_year, SUM(stay_count), ROUND(SUM(total_billing_amt), 2) FROM billing_by_condition_year '+
+                     'GROUP BY date_year ORDER BY date_year;')
+    stay_query = ('SELECT d.date_year, COUNT(*), ROUND(SUM(hs.billing_amt), 2) FROM hospital_stay hs '+
+                  'JOIN date d ON d.date_id = hs.admission_date GROUP BY d.date_year ORDER BY d.date_year;')
+    for change in ['DELETE FROM hospital_stay WHERE stay_id <= 5000;',
+                   'UPDATE hospital_stay SET billing_amt = billing_amt+1000000 WHERE stay_id = 6000;',
+                   'UPDATE patient SET patient_medical_condition = \'Flu\' WHERE patient_id % 7 = 0;']:
+        connection.execute(change)
+        assert connection.execute(summary_query).fetchall() == connection.execute(stay_query).fetchall()
+    assert (connection.execute('SELECT SUM(stay_count) FROM billing_by_insurance_month;').fetchone() ==
+            connection.execute('SELECT COUNT(*) FROM hospital_stay;').fetchone())
+    connection.close()
+
+# A WAL database that cannot be overwritten page by page (here because its page size differs) is replaced by the new file,
+# and the WAL and shared memory files it leaves behind while a reader still has it open are removed
+def test_replacing_database_removes_old_wal_files(tmp_path):
+    database_file = str(tmp_path/'hospital_stay_database.db')
+    build_database_file = str(tmp_path/'hospital_stay_database.db.build')
+    reader_connection = sqlite3.connect(database_file)
+    reader_connection.execute('PRAGMA journal_mode = WAL;')
+    reader_connection.execute('CREATE TABLE old_table (old_column);')
+    build_connection = sqlite3.connect(build_database_file)
+    build_connection.execute('PRAGMA page_size = 8192;')
+    build_connection.execute('CREATE TABLE new_table (new_column);')
+    build_connection.close()
+    try:
+        create_db.replace_database_file(build_database_file, database_file)
+        assert not (tmp_path/'hospital_stay_database.db-wal').exists()
+        assert not (tmp_path/'hospital_stay_database.db-shm').exists()
+    finally:
+        reader_connection.close()
+    connection = sqlite3.connect(database_file)
+    assert connection.execute('SELECT name FROM sqlite_master;').fetchall() == [('new_table',)]
+    connection.close()
+
+# The views of the compact layout show the same rows as the tables of the usual layout, so queries written for the usual
+# layout give the same results on either
+def test_compact_layout_views_match_usual_layout(test_database, tmp_path):
+    test_database_folder = os.path.dirname(test_database)
+    compact_database_file = str(tmp_path/'hospital_stay_database_compact.db')
+    create_db.build_database(compact_database_file, create_db.CHUNK_SIZE, os.path.join(test_database_folder, 'stays.csv'),
+                             os.path.join(test_database_folder, 'cleaned.csv'),
+                             os.path.join(test_database_folder, 'cleaned.npz'), compact=True)
+    connection = sqlite3.connect(test_database)
+    compact_connection = sqlite3.connect(compact_database_file)
+    assert compact_connection.execute("SELECT type FROM sqlite_master WHERE name = 'hospital_stay';").fetchone() == ('view',)
+    for query in ['SELECT * FROM hospital_stay ORDER BY stay_id;', 'SELECT * FROM date ORDER BY date_id;',
+                  'SELECT d.date_year, h.hospital_name, COUNT(*), ROUND(SUM(hs.billing_amt), 2) FROM hospital_stay hs '+
+                  'JOIN date d ON d.date_id = hs.discharge_date JOIN hospital h ON h.hospital_id = hs.hospital_id '+
+                  "WHERE hs.admission_date >= '2021-01-01' GROUP BY d.date_year, h.hospital_name ORDER BY 1, 2;"]:
+        assert compact_connection.execute(query).fetchall() == connection.execute(query).fetchall()
+    compact_connection.close()
+    connection.close()
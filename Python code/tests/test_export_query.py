@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Tests of exporting query results with export_query.py
+
+# Import packages - csv and gzip for reading the exported files, pytest for checking errors, and the code being tested
+import csv
+import gzip
+import pytest
+import export_query
+
+# Error raised to stop an export part way through
+class ExportStopped(Exception):
+    pass
+
+# A result is exported with its column names (as the query names them) on the first line and every row after them, and is
+# compressed if the file name ends in .gz
+def test_export_writes_column_names_and_every_row(test_database, tmp_path):
+    connection = export_query.open_export_connection(test_database)
+    export_file = str(tmp_path/'result.csv.gz')
+    row_count = export_query.export_query(connection, 'SELECT hs.stay_id AS id, p.patient_name FROM hospital_stay hs '+
+                                          'JOIN patient p ON p.patient_id = hs.patient_id ORDER BY hs.stay_id;', export_file)
+    stay_count = connection.execute('SELECT COUNT(*) FROM hospital_stay;').fetchone()[0]
+    connection.close()
+    with gzip.open(export_file, 'rt', newline='') as export_input:
+        exported_rows = list(csv.reader(export_input))
+    assert exported_rows[0] == ['id', 'patient_name']
+    assert row_count == stay_count == len(exported_rows)-1
+    assert exported_rows[1][0] == '1'
+
+# An export that stops part way through leaves neither the export file nor its partial file behind
+def test_stopped_export_removes_partial_file(test_database, tmp_path):
+    connection = export_query.open_export_connection(test_database)
+    export_file = str(tmp_path/'result.csv')
+    def stop_export(row_count):
+        raise ExportStopped()
+    with pytest.raises(ExportStopped):
+        export_query.export_query(connection, 'SELECT * FROM hospital_stay;', export_file, stop_export)
+    connection.close()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+# Tests of suggesting indexes with index_advisor.py
+
+# Import packages - os for finding the test database's stay data, sqlite3 for changing the test databases, and the code being
+# tested
+import os
+import sqlite3
+import create_db
+import index_advisor
+
+# On the compact layout, a query through the hospital_stay view is advised on the hospital_stay_compact table it reads
+def test_advice_looks_through_compact_layout_views(test_database, tmp_path):
+    test_database_folder = os.path.dirname(test_database)
+    compact_database_file = str(tmp_path/'hospital_stay_database_compact.db')
+    create_db.build_database(compact_database_file, create_db.CHUNK_SIZE, os.path.join(test_database_folder, 'stays.csv'),
+                             os.path.join(test_database_folder, 'cleaned.csv'),
+                             os.path.join(test_database_folder, 'cleaned.npz'), compact=True)
+    connection = sqlite3.connect(compact_database_file)
+    connection.execute('DROP INDEX hospital_stay_doctor_idx;')
+    (advice,) = index_advisor.advise_indexes(connection, 'SELECT * FROM hospital_stay hs WHERE hs.doctor_id = 5', 100)
+    assert advice['table'] == 'hospital_stay_compact'
+    assert advice['index_statement'] == 'CREATE INDEX advisor_hospital_stay_compact_doctor_id_idx ON '+ \
+                                        'hospital_stay_compact (doctor_id);'
+    (advice,) = index_advisor.advise_indexes(connection, 'SELECT * FROM hospital_stay hs WHERE hs.billing_amt > 100', 100)
+    assert advice['index_statement'] is None and 'hospital_stay view' in advice['reason']
+    connection.close()
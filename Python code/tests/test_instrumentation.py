@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+# Tests of timing and counting SQL statements with instrumentation.py
+
+# Import packages - json for reading the log, and the code being tested
+import json
+import instrumentation
+
+# Statements run by triggers are not counted as statements run by SQLite, only the statements that fired them
+def test_statement_count_leaves_out_trigger_statements(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'log_file', str(tmp_path/'log.jsonl'))
+    connection = instrumentation.connect(':memory:')
+    connection.execute('CREATE TABLE patient (patient_name TEXT);')
+    connection.execute('CREATE TABLE patient_log (patient_name TEXT);')
+    connection.execute('CREATE TRIGGER patient_insert AFTER INSERT ON patient BEGIN '+
+                       'INSERT INTO patient_log VALUES (new.patient_name); INSERT INTO patient_log VALUES (NULL); END;')
+    insert_sql = 'INSERT INTO patient VALUES (?);'
+    connection.executemany(insert_sql, (('Patient '+str(row),) for row in range(2000)))
+    connection.execute(insert_sql, ('Patient 2000',))
+    assert connection.statement_stats[insert_sql]['calls'] == 2
+    assert connection.statement_stats[insert_sql]['sqlite_statements'] == 2001
+    assert connection.statement_stats[insert_sql]['rows'] == 2001
+    connection.close()
+
+# A slow query with parameters is logged with its query plan, which is explained with the same parameters
+def test_slow_query_with_parameters_is_logged_with_its_plan(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'log_file', str(tmp_path/'log.jsonl'))
+    connection = instrumentation.connect(':memory:')
+    connection.execute('CREATE TABLE patient (patient_name TEXT);')
+    instrumentation.log_query(connection, 'SELECT * FROM patient WHERE patient_name = ?;',
+                              instrumentation.SLOW_QUERY_SECONDS+1, 0.0, 0, ('Patient 1',))
+    connection.close()
+    (log_record,) = [json.loads(line) for line in open(tmp_path/'log.jsonl')]
+    assert log_record['slow'] and log_record['query_plan'] == ['SCAN patient']
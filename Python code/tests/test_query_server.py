@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Tests of the query service in query_server.py, run on this computer on a free port
+
+# Import packages - sqlite3 for checking the results, threading and concurrent.futures for running the service and several
+# clients at once, urllib and json for sending the requests and reading their results, pytest for the fixtures, and the
+# code being tested
+import sqlite3
+import threading
+import concurrent.futures
+import urllib.parse
+import urllib.request
+import urllib.error
+import json
+import pytest
+import query_server
+
+# Service querying the test database, with the URL of its /query endpoint
+@pytest.fixture
+def query_url(test_database):
+    server = query_server.QueryServer(('127.0.0.1', 0), test_database, pool_size=4)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    yield 'http://127.0.0.1:'+str(server.server_address[1])+'/query'
+    server.shutdown()
+    server_thread.join()
+    server.server_close()
+
+# Function to send a query (in the sql parameter, or as the body of a POST if body is given) and return the status and body
+# of the response
+def send_query(query_url, parameters, body=None):
+    try:
+        with urllib.request.urlopen(query_url+'?'+urllib.parse.urlencode(parameters), data=body, timeout=30) as response:
+            return response.status, response.read().decode('utf-8')
+    except urllib.error.HTTPError as error:
+        return error.code, error.read().decode('utf-8')
+
+# Function to get the rows of a query run directly on the test database
+def get_rows(test_database, query):
+    connection = sqlite3.connect(test_database)
+    rows = connection.execute(query).fetchall()
+    connection.close()
+    return rows
+
+# Results are sent as JSON by default, or as CSV with the column names on the first line
+def test_query_results_as_json_and_csv(query_url, test_database):
+    query = 'SELECT stay_id, billing_amt FROM hospital_stay ORDER BY stay_id LIMIT 3;'
+    expected_rows = get_rows(test_database, query)
+    status, body = send_query(query_url, {'sql': query})
+    assert status == 200
+    assert json.loads(body) == {'columns': ['stay_id', 'billing_amt'], 'rows': [list(row) for row in expected_rows],
+                                'row_count': 3}
+    status, body = send_query(query_url, {'format': 'csv'}, query.encode('utf-8'))
+    assert status == 200
+    assert body.splitlines() == ['stay_id,billing_amt']+[str(stay_id)+','+str(billing_amt)
+                                                          for stay_id, billing_amt in expected_rows]
+
+# Statements that would change the database or the connection's settings, and request bodies that are not UTF-8 text, are
+# refused
+def test_writes_and_bad_requests_are_refused(query_url, test_database):
+    stay_count = get_rows(test_database, 'SELECT COUNT(*) FROM hospital_stay;')
+    for query in ('DELETE FROM hospital_stay;', 'PRAGMA query_only = OFF;', "ATTACH 'other.db' AS other;"):
+        status, body = send_query(query_url, {'sql': query})
+        assert status == 400 and 'error' in json.loads(body)
+    assert get_rows(test_database, 'SELECT COUNT(*) FROM hospital_stay;') == stay_count
+    status, body = send_query(query_url, {}, b'SELECT \xff;')
+    assert status == 400 and 'error' in json.loads(body)
+    assert send_query(query_url, {'sql': 'PRAGMA table_info(patient);'})[0] == 200
+
+# A query taking longer than its timeout is stopped and gets status 504
+def test_slow_query_times_out(query_url):
+    status, body = send_query(query_url, {'timeout': '0.2', 'sql': 'WITH RECURSIVE numbers(n) AS (SELECT 1 UNION ALL '+
+                                          'SELECT n+1 FROM numbers) SELECT MAX(n) FROM numbers;'})
+    assert status == 504
+    assert 'timeout' in json.loads(body)['error']
+
+# Several clients querying at once all get the whole result, including more than the pool has connections
+def test_concurrent_queries(query_url, test_database):
+    query = 'SELECT insurance_provider_id, COUNT(*) FROM hospital_stay GROUP BY insurance_provider_id;'
+    expected_rows = [list(row) for row in get_rows(test_database, query)]
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        responses = list(executor.map(lambda _: send_query(query_url, {'sql': query}), range(8)))
+    for status, body in responses:
+        assert status == 200
+        assert json.loads(body)['rows'] == expected_rows
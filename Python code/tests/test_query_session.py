@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Tests of the query workbench's query handling in query_session.py
+
+# Import packages - shutil for copying the test database, sqlite3 for adding stays to it, create_db and generate_stay_data
+# for making and ingesting new stays, and the code being tested
+import shutil
+import sqlite3
+import create_db
+import generate_stay_data
+import query_session
+
+# A query on the hospital stay table that a billing summary view can answer is rewritten to read it, with the same result
+def test_summary_rewrite_gives_the_same_result(test_database):
+    session = query_session.QuerySession(test_database)
+    query = ('SELECT d.date_year, COUNT(*), SUM(hs.billing_amt) FROM hospital_stay hs '+
+             'JOIN date d ON d.date_id = hs.admission_date GROUP BY d.date_year;')
+    rewritten_query, view = session.rewrite_summary_query(query)
+    assert view == 'billing_by_condition_year'
+    connection = session.connection
+    assert ([(year, count, round(total, 2)) for year, count, total in connection.execute(query).fetchall()] ==
+            [(year, count, round(total, 2)) for year, count, total in connection.execute(rewritten_query).fetchall()])
+    session.close()
+
+# A result column named like a real column (here d.date_year named date_month, and grouped by the real date_month column)
+# is not rewritten, since the view would group by the result column instead
+def test_summary_rewrite_skips_aliases_named_like_columns(test_database):
+    session = query_session.QuerySession(test_database)
+    query = ('SELECT d.date_year AS date_month, COUNT(*) FROM hospital_stay hs '+
+             'JOIN date d ON d.date_id = hs.admission_date GROUP BY date_month;')
+    rewritten_query, view = session.rewrite_summary_query(query)
+    assert rewritten_query is None
+    session.close()
+
+# Queries answered from a billing summary view after the session itself has changed the stays give the new totals
+def test_summary_query_after_write_gives_the_new_result(test_database, tmp_path):
+    database_file = str(tmp_path/'hospital_stay_database.db')
+    shutil.copy(test_database, database_file)
+    session = query_session.QuerySession(database_file)
+    query = ('SELECT d.date_year, COUNT(*) FROM hospital_stay hs JOIN date d ON d.date_id = hs.admission_date '+
+             'GROUP BY d.date_year ORDER BY d.date_year;')
+    assert session.summaries_up_to_date()
+    session.execute_query('DELETE FROM hospital_stay WHERE stay_id <= 1000;')
+    assert session.summaries_up_to_date()
+    rewritten_query, view = session.rewrite_summary_query(query)
+    assert view is not None
+    assert session.execute_query(rewritten_query)[1] == session.execute_query(query)[1]
+    session.close()
+
+# Queries differing only in whitespace and comments share a result cache entry, but a line break that ends a -- comment is
+# not lost, so a query whose comment hides the rest of its line is not taken for one whose comment ends before it
+def test_normalize_query_handles_comments():
+    normalize_query = query_session.normalize_query
+    assert normalize_query('SELECT a, b\n  FROM t;') == normalize_query('SELECT a, /* note */ b FROM t -- note')
+    assert normalize_query('SELECT a -- c\n, b FROM t') != normalize_query('SELECT a -- c , b FROM t')
+    assert normalize_query("SELECT '--  x' FROM t") == "SELECT '--  x' FROM t"
+
+# A write statement starting with WITH has no result columns, and empties the result cache so that the results cached before
+# it are not shown again
+def test_write_starting_with_with_empties_result_cache(test_database, tmp_path):
+    database_file = str(tmp_path/'hospital_stay_database.db')
+    shutil.copy(test_database, database_file)
+    session = query_session.QuerySession(database_file)
+    query = 'SELECT COUNT(*) FROM hospital_stay;'
+    query_key = query_session.normalize_query(query)
+    assert session.get_cached_result(query_key) is None
+    result_columns, first_result_page = session.execute_query(query)
+    session.add_to_result_cache(query_key, result_columns, [first_result_page])
+    assert session.get_cached_result(query_key) == (result_columns, [first_result_page])
+    session.execute_query('WITH old_stays AS (SELECT stay_id FROM hospital_stay WHERE stay_id <= 10) '+
+                          'DELETE FROM hospital_stay WHERE stay_id IN old_stays;')
+    assert session.cursor.description is None
+    assert session.get_cached_result(query_key) is None
+    assert session.execute_query(query)[1] == [(first_result_page[0][0]-10,)]
+    session.close()
+
+# A name search finds every patient whose name contains the text entered, in any case, including patients added by an ingest
+# after the database was built
+def test_name_search_finds_ingested_patients(test_database, tmp_path):
+    database_file = str(tmp_path/'hospital_stay_database.db')
+    shutil.copy(test_database, database_file)
+    new_stay_data_file = str(tmp_path/'new_stays.csv')
+    generate_stay_data.save_generated_stay_data(500, new_stay_data_file, random_seed=1)
+    cleaned_new_stay_data_file = str(tmp_path/'new_stays_cleaned.csv')
+    create_db.clean_stay_data_file(new_stay_data_file, cleaned_new_stay_data_file, 300)
+    connection = sqlite3.connect(database_file)
+    last_patient_id = connection.execute('SELECT MAX(patient_id) FROM patient;').fetchone()[0]
+    create_db.ingest_stays(connection, cleaned_new_stay_data_file)
+    (new_patient_name,) = connection.execute('SELECT patient_name FROM patient WHERE patient_id > ? ORDER BY patient_id '+
+                                             'LIMIT 1;', (last_patient_id,)).fetchone()
+    name = new_patient_name[1:5].swapcase()
+    expected_patient_names = {patient_name for (patient_name,) in connection.execute(
+        'SELECT patient_name FROM patient WHERE instr(lower(patient_name), lower(?)) > 0 AND patient_id IN '+
+        '(SELECT patient_id FROM hospital_stay);', (name,))}
+    connection.close()
+    session = query_session.QuerySession(database_file)
+    name_search_query, parameters = session.make_name_search_query('patient', name)
+    assert 'patient_name_search' in name_search_query
+    first_result_page = session.execute_query(name_search_query, parameters)[1]
+    found_patient_names = {row[0] for row in first_result_page+session.cursor.fetchall()}
+    assert new_patient_name in found_patient_names
+    session.close()
+    assert found_patient_names == expected_patient_names